@@ -1,56 +1,150 @@
-from fastapi import APIRouter, Query, HTTPException
+from fastapi import APIRouter, Query, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
 from typing import List
-from models import Product, LoginData, CustomerChart, BusinessInsight, BusinessChart
-from service import search_products_service, authenticate_user_service, get_business_insight, get_business_kpi
-from recommendations import get_product_recommendations
-from database import get_customer_by_cid, get_category_and_payment_summary, get_business_by_bid
-from loan_recommendation import recommend_loan
+from models import Product, ProductRecord, CustomerRecommendationsRecord, LoginData, CustomerChart, BusinessInsight, BusinessChart, BatchRecommendationRequest, CustomerRecommendations, BatchLoanRecommendationRequest, CustomerLoanRecommendations, LoanModelInfo, ExecutorStats, InsightCacheStats, StartupReport, Readiness
+from service import search_products_service, authenticate_user_service, get_business_insight, stream_business_insight, get_business_kpi, get_insight_cache_stats
+from recommendations import get_product_recommendations, get_batch_recommendations
+from database import SEARCH_RESULT_LIMIT, get_customer_by_cid, get_customers_by_cids, get_category_and_payment_summary, get_business_by_bid, get_precomputed_recommendations
+from loan_recommendation import recommend_loan, recommend_loans_batch
+from model_registry import get_loan_model, loan_model_info
+from executor import run_blocking, run_cpu_bound, executor_stats
+from startup import startup_report, readiness
 import datetime
 
 router = APIRouter()
 
+PRODUCT_LIST_ADAPTER = TypeAdapter(List[ProductRecord])
+CUSTOMER_RECOMMENDATIONS_LIST_ADAPTER = TypeAdapter(List[CustomerRecommendationsRecord])
+
+def json_records_response(adapter, records, headers=None):
+    """Serializes records built by the services straight to JSON with the schema of the response model.
+    Returning a Response skips FastAPI's validation of the records into models and their re-encoding,
+    which dominate the cost of long lists; fields missing from the schema are left out.
+
+    Keyword arguments:
+    adapter -- TypeAdapter of the list of records
+    records -- list of dictionaries
+    headers -- additional response headers (default: None)
+    Return: the JSON response
+    """
+
+    return Response(adapter.dump_json(records), media_type='application/json', headers=headers)
+
 @router.get("/search_products", response_model=List[Product])
-async def search_products(query: str = Query(..., min_length=1)):
-    return search_products_service(query)
+async def search_products(query: str = Query(..., min_length=1), limit: int = Query(SEARCH_RESULT_LIMIT, ge=1, le=500)):
+    records = await run_blocking(search_products_service, query, limit=limit)
+    return json_records_response(PRODUCT_LIST_ADAPTER, records)
 
 @router.get("/recommend", response_model=List[Product])
-async def recommend_product(cid: int = Query(...)):
-    customer = get_customer_by_cid(cid, as_df=True)
-    if customer.empty:
+async def recommend_product(cid: int = Query(...), precomputed: bool = Query(False), max_age: int = Query(None, ge=0)):
+    customer = await run_blocking(get_customer_by_cid, cid)
+    if customer is None:
         raise HTTPException(status_code=404, detail="Customer not found")
 
-    df = get_product_recommendations(cid)
-    return df.to_dict('records')
+    # serve the nightly precomputed recommendations when asked for and fresh enough
+    if precomputed:
+        records = await run_blocking(get_precomputed_recommendations, cid, as_dict=True)
+        if records:
+            generated_at = records[0]['generated_at']
+            age = (datetime.datetime.now() - datetime.datetime.strptime(generated_at, '%Y-%m-%d %H:%M:%S')).total_seconds()
+            if max_age is None or age <= max_age:
+                headers = {'X-Recommendations-Source': 'precomputed', 'X-Recommendations-Generated-At': generated_at}
+                return json_records_response(PRODUCT_LIST_ADAPTER, records, headers)
+
+    df = await run_cpu_bound(get_product_recommendations, cid)
+    headers = {'X-Recommendations-Source': 'online', 'X-Recommendations-Generated-At': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
+    return json_records_response(PRODUCT_LIST_ADAPTER, df.to_dict('records'), headers)
+
+@router.post("/recommend/batch", response_model=List[CustomerRecommendations])
+async def recommend_products_batch(request: BatchRecommendationRequest):
+    customers = await run_blocking(get_customers_by_cids, request.cids, as_dict=True)
+    missing = sorted(set(request.cids) - {customer['cid'] for customer in customers})
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Customers not found: {missing}")
+
+    results = await run_cpu_bound(get_batch_recommendations, request.cids, n_recommendations=request.n_recommendations)
+    return json_records_response(CUSTOMER_RECOMMENDATIONS_LIST_ADAPTER, [{'cid': cid, 'products': df.to_dict('records')} for (cid, df) in results.items()])
 
 @router.post("/login", response_model=None)
 async def login(login_data: LoginData):
-    is_valid_username, user_object = authenticate_user_service(login_data)
+    is_valid_username, user_object = await run_blocking(authenticate_user_service, login_data)
     if is_valid_username and user_object:
         return user_object
     raise HTTPException(status_code=401, detail="Incorrect username or password")
 
 @router.get("/customer_chart", response_model = CustomerChart)
 async def generate_customer_chart(cid: int = Query(...)):
-    customer_chart = get_category_and_payment_summary(cid)
+    customer_chart = await run_blocking(get_category_and_payment_summary, cid)
     return customer_chart
 
 @router.get("/loan_recommend")
 async def generate_loan_recommendation(cid: int = Query(...)):
-    df = recommend_loan(cid)
+    df = await run_cpu_bound(recommend_loan, cid)
     return df.to_dict('records')
 
+@router.post("/loan_recommend/batch", response_model=List[CustomerLoanRecommendations])
+async def generate_loan_recommendations_batch(request: BatchLoanRecommendationRequest):
+    df = await run_cpu_bound(recommend_loans_batch, request.cids, n_recommendations=request.n_recommendations)
+    missing = sorted(set(request.cids) - set(df['cid']))
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Customers not found: {missing}")
+
+    results = {}
+    for record in df.to_dict('records'):
+        results.setdefault(record.pop('cid'), []).append(record)
+    return [{'cid': cid, 'loans': loans} for (cid, loans) in results.items()]
+
+@router.get("/loan_model", response_model=LoanModelInfo)
+async def get_loan_model_info():
+    await run_blocking(get_loan_model)
+    return loan_model_info()
+
 @router.get("/business_insight", response_model=BusinessInsight)
-async def generate_business_insight(bid: int = Query(...)):
-    business = get_business_by_bid(bid, as_df=True)
-    if business.empty:
+async def generate_business_insight(bid: int = Query(...), force_refresh: bool = Query(False)):
+    business = await run_blocking(get_business_by_bid, bid)
+    if business is None:
         raise HTTPException(status_code=404, detail="Business not found")
-    insight = get_business_insight(bid)
+    insight = await get_business_insight(bid, force_refresh=force_refresh)
     return insight
 
+@router.get("/business_insight/stream")
+async def stream_business_insight_events(bid: int = Query(...), force_refresh: bool = Query(False)):
+    business = await run_blocking(get_business_by_bid, bid)
+    if business is None:
+        raise HTTPException(status_code=404, detail="Business not found")
+    return StreamingResponse(stream_business_insight(bid, force_refresh=force_refresh), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.get("/business_insight/cache_stats", response_model=InsightCacheStats)
+async def get_business_insight_cache_stats():
+    return await run_blocking(get_insight_cache_stats)
+
 @router.get("/business_chart", response_model = BusinessChart)
 async def generate_business_chart(bid: int = Query(...)):
-    business = get_business_by_bid(bid, as_df=True)
-    if business.empty:
+    business = await run_blocking(get_business_by_bid, bid)
+    if business is None:
         raise HTTPException(status_code=404, detail="Business not found")
-    business_chart = get_business_kpi(bid)
-    return business_chart
\ No newline at end of file
+    business_chart = await run_blocking(get_business_kpi, bid)
+    return business_chart
+
+@router.get("/executor_stats", response_model=ExecutorStats)
+async def get_executor_stats():
+    return executor_stats()
+
+@router.get("/startup_report", response_model=StartupReport)
+async def get_startup_report():
+    return startup_report()
+
+@router.get("/healthz")
+async def healthz():
+    # liveness: the process answers requests, warm or not
+    return {'status': 'ok'}
+
+@router.get("/readyz", response_model=Readiness)
+async def readyz(response: Response):
+    # readiness: traffic should only be routed here once every warmup stage is warm
+    status = readiness()
+    if not status['ready']:
+        response.status_code = 503
+    return status
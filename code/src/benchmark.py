@@ -0,0 +1,340 @@
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from typing import List
+from models import Product
+from api import PRODUCT_LIST_ADAPTER, json_records_response
+from database import init_connection, close_connection, init_db, execute_and_fetch_one, get_category_and_payment_summary, get_top_customers_by_business_spend
+from recommendations import get_product_recommendations, product_similarity, customer_similarity, rebuild_product_similarity_store
+from loan_recommendation import recommend_loan
+from service import get_business_kpi
+import numpy as np
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# synthetic databases built by build_benchmark_database, kept between runs so that commits are compared on the same data
+BENCHMARK_DATA_DIR = os.environ.get('BENCHMARK_DATA_DIR', os.path.join(tempfile.gettempdir(), 'prifinity_benchmark'))
+# rows generated for each scale; the loan application generator samples every applicant from all the customers,
+# so the largest scale keeps 10k applications
+BENCHMARK_SCALES = {
+    '10k': {'customers': 10000, 'transactions': 10000, 'loan_applications': 10000},
+    '100k': {'customers': 100000, 'transactions': 100000, 'loan_applications': 100000},
+    '1M': {'customers': 1000000, 'transactions': 1000000, 'loan_applications': 10000},
+}
+# customer_similarity builds a dense customers x customers matrix, so it is only timed on databases with at most this many customers
+CUSTOMER_SIMILARITY_MAX_CUSTOMERS = 20000
+# data files read by init_db that are not generated per scale
+_STATIC_DATA_FILES = ('business_data.csv', 'product_data.csv', 'loan_product_data.csv', 'social_media_posts.csv')
+_INITIAL_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'initial_data')
+
+def synthetic_product_records(n_rows:int, seed:int=0):
+    """Product dictionaries shaped like the results of search_products_service
+
+    Keyword arguments:
+    n_rows -- number of records
+    seed -- seed of the random values (default: 0)
+    Return: list of product dictionaries
+    """
+
+    rng = random.Random(seed)
+    return [
+        {
+            'pid': pid,
+            'bid': rng.randint(1, 1000),
+            'product_name': rng.choice(['Smartphone', 'Smartwatch', 'Laptop', 'Gaming Console', 'Organic Tea']),
+            'popularity': round(rng.uniform(0, 10), 1),
+            'price': round(rng.uniform(1, 2000), 2),
+            'geo_demand': f'Town {rng.randint(1, 500)}',
+            'category': rng.choice(['Electronics', 'Food', 'Clothing']),
+            'business_name': f'Business {rng.randint(1, 1000)}',
+        }
+        for pid in range(1, n_rows + 1)
+    ]
+
+def _time_calls(func, repeat:int, inputs=((),)):
+    # the calls take the argument tuples of inputs in turn
+    timings = []
+    for i in range(repeat):
+        args = inputs[i % len(inputs)]
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def benchmark_serialization(n_rows:int=10000, repeat:int=20):
+    """Compares the cost of turning a list of product records into a JSON response body with FastAPI's
+    response_model handling (validation into Product models, encoding, json.dumps) and with json_records_response.
+
+    Keyword arguments:
+    n_rows -- number of records of the response (default: 10000)
+    repeat -- number of timed serializations of each mode (default: 20)
+    Return: dictionary with the median time of a response and of a row for each mode, in milliseconds and microseconds
+    """
+
+    records = synthetic_product_records(n_rows)
+    field = create_model_field(name='Response', type_=List[Product], mode='serialization')
+    loop = asyncio.new_event_loop()
+
+    def response_model_body():
+        content = loop.run_until_complete(serialize_response(field=field, response_content=records))
+        return JSONResponse(content).body
+
+    def json_records_body():
+        return json_records_response(PRODUCT_LIST_ADAPTER, records).body
+
+    # both modes send the same document
+    assert PRODUCT_LIST_ADAPTER.validate_json(response_model_body()) == PRODUCT_LIST_ADAPTER.validate_json(json_records_body())
+
+    results = {}
+    try:
+        for (mode, func) in (('response_model', response_model_body), ('json_records_response', json_records_body)):
+            median = statistics.median(_time_calls(func, repeat))
+            results[mode] = {'response_ms': median * 1e3, 'row_us': median * 1e6 / n_rows}
+    finally:
+        loop.close()
+    return results
+
+def _run_generator(script, cwd, **args):
+    command = [sys.executable, os.path.join(_INITIAL_DATA_DIR, script)]
+    for (name, value) in args.items():
+        command += [f'--{name}', str(value)]
+    subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+
+def build_benchmark_database(scale:str, directory:str=None, rebuild:bool=False):
+    """Builds a synthetic database of the given scale with the initial_data generators and init_db.
+    The generators are not seeded, so a database is built once and reused by the following runs.
+
+    Keyword arguments:
+    scale -- name of BENCHMARK_SCALES
+    directory -- directory of the databases (default: BENCHMARK_DATA_DIR)
+    rebuild -- build the database even if it already exists (default: False)
+    Return: path of the database
+    """
+
+    counts = BENCHMARK_SCALES[scale]
+    directory = directory or BENCHMARK_DATA_DIR
+    path = os.path.join(directory, f'benchmark_{scale}.db')
+    if os.path.exists(path) and not rebuild:
+        return path
+
+    os.makedirs(directory, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix=f'build_{scale}_', dir=directory)
+    data_dir = os.path.join(workdir, 'initial_data')
+    os.makedirs(data_dir)
+    for name in _STATIC_DATA_FILES:
+        shutil.copy(os.path.join(_INITIAL_DATA_DIR, name), data_dir)
+
+    cwd = os.getcwd()
+    try:
+        _run_generator('customer_dataset_gen.py', data_dir, filename='customers.csv', num_customers=counts['customers'])
+        _run_generator('transactions_gen.py', data_dir, num_records=counts['transactions'], num_customers=counts['customers'])
+        _run_generator('loan_data_gen.py', data_dir, num_customers=counts['customers'], num_applications=counts['loan_applications'])
+
+        # init_db reads the data files relative to the working directory
+        os.chdir(workdir)
+        init_connection(os.path.join(workdir, 'database.db'))
+        init_db()
+        close_connection()
+        os.replace(os.path.join(workdir, 'database.db'), path)
+    finally:
+        os.chdir(cwd)
+        close_connection()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return path
+
+def _sample_ids(table, column, n, seed):
+    (low, high) = execute_and_fetch_one(f'select min({column}), max({column}) from {table}')
+    if low is None:
+        return []
+    rng = random.Random(seed)
+    return [rng.randint(low, high) for _ in range(n)]
+
+def _max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# hot paths timed by run_hot_path_benchmarks: (function, table and column of the ids it is called with,
+# maximum number of rounds, maximum number of customers of the database)
+BENCHMARK_HOT_PATHS = {
+    'get_product_recommendations': (get_product_recommendations, ('customers', 'cid'), None, None),
+    'product_similarity': (product_similarity, None, None, None),
+    'customer_similarity': (customer_similarity, None, 3, CUSTOMER_SIMILARITY_MAX_CUSTOMERS),
+    'recommend_loan': (recommend_loan, ('customers', 'cid'), None, None),
+    'get_category_and_payment_summary': (get_category_and_payment_summary, ('customers', 'cid'), None, None),
+    'get_business_kpi': (get_business_kpi, ('businesses', 'bid'), None, None),
+    'get_top_customers_by_business_spend': (get_top_customers_by_business_spend, ('businesses', 'bid'), None, None),
+}
+
+def benchmark_call(func, inputs, repeat:int=20):
+    """Times a hot path the way pytest-benchmark does, with a first call building the caches reported apart
+    from the following rounds.
+
+    Keyword arguments:
+    func -- function to time
+    inputs -- argument tuples of the calls, used in turn, e.g. [(cid,), ...]; [()] for a function without arguments
+    repeat -- number of timed rounds after the first call (default: 20)
+    Return: dictionary with the first call, the percentiles, mean, min and max of the rounds in milliseconds,
+    the number of rounds, the peak memory allocated by one call (Python and numpy, traced by tracemalloc)
+    and the peak resident memory of the process so far, in megabytes
+    """
+
+    inputs = list(inputs)
+    start = time.perf_counter()
+    func(*inputs[0])
+    first = time.perf_counter() - start
+
+    timings = np.array(_time_calls(func, repeat, inputs)) * 1e3
+
+    tracemalloc.start()
+    try:
+        func(*inputs[0])
+        (_, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'first_ms': first * 1e3,
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'mean_ms': float(timings.mean()),
+        'min_ms': float(timings.min()),
+        'max_ms': float(timings.max()),
+        'rounds': len(timings),
+        'peak_memory_mb': peak / 2**20,
+        'max_rss_mb': _max_rss_mb(),
+    }
+
+def run_hot_path_benchmarks(path:str, repeat:int=20, names=None, seed:int=0):
+    """Times the hot paths on a database
+
+    Keyword arguments:
+    path -- database file, e.g. built by build_benchmark_database
+    repeat -- number of timed rounds of each hot path (default: 20)
+    names -- names of BENCHMARK_HOT_PATHS to time (default: all)
+    seed -- seed of the customers and businesses the hot paths are called for (default: 0)
+    Return: dictionary with the benchmark_call results of every hot path, except those skipped because the database
+    has too many customers
+    """
+
+    init_connection(path)
+    (n_customers,) = execute_and_fetch_one('select count(*) from customers')
+    # the store of another database, or of the API, must not be reused; keep its file next to the database
+    rebuild_product_similarity_store(path=os.path.splitext(path)[0] + '_product_similarity.npz')
+
+    results = {}
+    for name in names or BENCHMARK_HOT_PATHS:
+        (func, ids, max_rounds, max_customers) = BENCHMARK_HOT_PATHS[name]
+        if max_customers is not None and n_customers > max_customers:
+            logging.warning('Skipping %s on %d customers (at most %d)', name, n_customers, max_customers)
+            continue
+        rounds = min(repeat, max_rounds) if max_rounds else repeat
+        inputs = [(i,) for i in _sample_ids(*ids, rounds, seed)] if ids else [()]
+        results[name] = benchmark_call(func, inputs, rounds)
+    return results
+
+def _git_commit():
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def benchmark_suite(scales=('10k',), repeat:int=20, names=None, directory:str=None, rebuild:bool=False):
+    """Builds (or reuses) the synthetic database of every scale and times the hot paths on it
+
+    Keyword arguments:
+    scales -- names of BENCHMARK_SCALES (default: ('10k',))
+    repeat -- number of timed rounds of each hot path (default: 20)
+    names -- names of BENCHMARK_HOT_PATHS to time (default: all)
+    directory -- directory of the databases (default: BENCHMARK_DATA_DIR)
+    rebuild -- rebuild the databases even if they exist (default: False)
+    Return: JSON-like dictionary with the commit, the environment and the results of every scale
+    """
+
+    report = {
+        'commit': _git_commit(),
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': repeat,
+        'scales': {},
+    }
+    for scale in scales:
+        start = time.perf_counter()
+        path = build_benchmark_database(scale, directory, rebuild)
+        report['scales'][scale] = {
+            'rows': BENCHMARK_SCALES[scale],
+            'build_s': time.perf_counter() - start,
+            'results': run_hot_path_benchmarks(path, repeat, names),
+        }
+    close_connection()
+    return report
+
+def compare_benchmarks(baseline, current, metric:str='p50_ms'):
+    """Compares two benchmark_suite reports, e.g. of two commits
+
+    Keyword arguments:
+    baseline -- report of the reference run
+    current -- report of the new run
+    metric -- result compared (default: 'p50_ms')
+    Return: list of (scale, hot path, baseline value, current value, current / baseline) of the results found in both
+    """
+
+    comparison = []
+    for (scale, scale_report) in current['scales'].items():
+        baseline_results = baseline['scales'].get(scale, {}).get('results', {})
+        for (name, result) in scale_report['results'].items():
+            if name in baseline_results:
+                (before, after) = (baseline_results[name][metric], result[metric])
+                comparison.append((scale, name, before, after, after / before if before else float('inf')))
+    return comparison
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the API response serialization, or the recommendation and loan hot paths.")
+    parser.add_argument("--suite", choices=['serialization', 'hot_paths'], default='serialization', help="Benchmark to run")
+    parser.add_argument("--rows", type=int, default=10000, help="Number of product records per response")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of timed serializations of each mode, or rounds of each hot path")
+    parser.add_argument("--scale", action='append', choices=list(BENCHMARK_SCALES), help="Scale of the synthetic database, can be repeated (default: 10k)")
+    parser.add_argument("--hot_path", action='append', choices=list(BENCHMARK_HOT_PATHS), help="Hot path to time, can be repeated (default: all)")
+    parser.add_argument("--data_dir", default=BENCHMARK_DATA_DIR, help="Directory of the synthetic databases")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the synthetic databases")
+    parser.add_argument("--output", help="JSON file to write the hot path results to")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare the hot path results with")
+    parser.add_argument("--threshold", type=float, default=1.1, help="Ratio of the p50 latencies reported as a regression")
+    args = parser.parse_args()
+
+    if args.suite == 'hot_paths':
+        report = benchmark_suite(args.scale or ['10k'], args.repeat, args.hot_path, args.data_dir, args.rebuild)
+        for (scale, scale_report) in report['scales'].items():
+            print(f"scale {scale} ({scale_report['build_s']:.1f}s to build or open)")
+            for (name, result) in scale_report['results'].items():
+                print(f"  {name:36s} first {result['first_ms']:9.2f} ms p50 {result['p50_ms']:9.2f} ms p95 {result['p95_ms']:9.2f} ms"
+                      f" peak {result['peak_memory_mb']:8.1f} MB rss {result['max_rss_mb']:8.1f} MB")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)
+            print(f"p50 compared with commit {baseline.get('commit')}")
+            for (scale, name, before, after, ratio) in compare_benchmarks(baseline, report):
+                flag = 'REGRESSION' if ratio > args.threshold else ''
+                print(f"  {scale:5s} {name:36s} {before:9.2f} ms -> {after:9.2f} ms {ratio:6.2f}x {flag}")
+    else:
+        results = benchmark_serialization(args.rows, args.repeat)
+        for (mode, timings) in results.items():
+            print(f"{mode:24s} {timings['response_ms']:9.2f} ms per response {timings['row_us']:8.2f} us per row")
+        print(f"speedup {results['response_model']['response_ms'] / results['json_records_response']['response_ms']:.1f}x")
@@ -1,8 +1,19 @@
-import pandas as pd
 import argparse
-from transformers import pipeline
-from llm_chat import prompt_model
-from database import get_df_from_table
+import hashlib
+import os
+import threading
+from llm_chat import prompt_model, prompt_model_async, stream_model
+from executor import run_blocking
+from database import get_business_by_bid, get_products_by_bid, get_avg_category_sentiment, get_top_customers_by_business_spend, get_cached_insight, save_cached_insight, count_cached_insights
+
+# generated insights are reused while the prompt (i.e. the business's data) is unchanged
+INSIGHT_CACHE_TTL = float(os.environ.get('INSIGHT_CACHE_TTL', 24 * 3600))  # seconds
+INSIGHT_CACHE_MAX_ENTRIES = int(os.environ.get('INSIGHT_CACHE_MAX_ENTRIES', 1000))
+# lines of the output format requested in the prompt; shorter answers are not cached
+INSIGHT_OUTPUT_LINES = 7
+
+_insight_cache_stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
+_insight_cache_lock = threading.Lock()
 
 gender_map = {
     'm': "Male",
@@ -17,32 +28,23 @@ education_map = {
     "p": "phd",
 }
 
-def generate_insights(bid):
-    business_df = get_df_from_table("businesses")
-    my_business = business_df[business_df["bid"] == bid].iloc[0]
-    product_df = get_df_from_table("products")
-    product_df = product_df[product_df["bid"] == bid]
-    social_media_df = get_df_from_table("social_media")
-    social_media_df = social_media_df[social_media_df["category"] == my_business.category]["sentiment_score"].mean()
-
-    social_context = f"The average sentiment score on social media for the category in which this business operates is {social_media_df:.2f}."
-    business_context = business_df[business_df["bid"] == bid].to_string(index=False)
-    product_context = product_df.to_string(index=False)
-
-    customer_df = get_df_from_table("customers")
-    my_product_ids = product_df["pid"].tolist()
-
-    transactions_df = get_df_from_table("transactions")
-    transactions_df = transactions_df[transactions_df["pid"].isin(my_product_ids)]
+def build_insight_prompt(bid):
+    """Assembles the LLM prompt for a business from its aggregated data
+    """
 
-    customer_spend = transactions_df.groupby("cid")["amount"].sum().reset_index()
-    customer_spend = customer_spend.sort_values("amount", ascending=False)
+    business_df = get_business_by_bid(bid, as_df=True)
+    my_business = business_df.iloc[0]
+    product_df = get_products_by_bid(bid, as_df=True)
+    avg_sentiment = get_avg_category_sentiment(my_business.category)
+    if avg_sentiment is None:
+        avg_sentiment = float('nan')
 
-    total_customers = customer_spend.shape[0]
-
-    top_customers = customer_spend[:int(0.05*total_customers)+1]
+    social_context = f"The average sentiment score on social media for the category in which this business operates is {avg_sentiment:.2f}."
+    business_context = business_df.to_string(index=False)
+    product_context = product_df.to_string(index=False)
 
-    top_customers = top_customers.merge(customer_df, on="cid", how="left")
+    # top 5% of the business's customers by spend, with their profile
+    top_customers = get_top_customers_by_business_spend(bid, fraction=0.05, as_df=True)
 
     age_mean = top_customers["age"].mean()
     gender_mode = top_customers["gender"].mode()[0]
@@ -84,17 +86,112 @@ def generate_insights(bid):
         "Aggregated Data Context:\n" + aggregated_context
     )
 
+    return prompt
+
+def _count(stat):
+    with _insight_cache_lock:
+        _insight_cache_stats[stat] += 1
+
+def _lookup_insight(bid, force_refresh):
+    """Builds the prompt of a business and looks up its cached insight
+
+    Return: tuple of (prompt, cache key, cached insight or None)
+    """
+
+    prompt = build_insight_prompt(bid)
+    cache_key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+    if force_refresh:
+        _count('refreshes')
+        return prompt, cache_key, None
+    cached = get_cached_insight(cache_key, INSIGHT_CACHE_TTL)
+    _count('hits' if cached is not None else 'misses')
+    return prompt, cache_key, cached
+
+def _store_insight(cache_key, bid, generation_status, result):
+    if generation_status and len(result.split('\n')) >= INSIGHT_OUTPUT_LINES:
+        save_cached_insight(cache_key, bid, result, INSIGHT_CACHE_TTL, INSIGHT_CACHE_MAX_ENTRIES)
+
+def generate_insights(bid, force_refresh=False):
+    """Generates the actionable items and follow-up questions for a business, served from the insight cache
+    when the same prompt was answered within INSIGHT_CACHE_TTL.
+
+    Keyword arguments:
+    bid -- id of the business
+    force_refresh -- ignore the cached insight and generate a new one (default: False)
+    Return: tuple of (generation status, insight text or error message)
+    """
+
+    prompt, cache_key, cached = _lookup_insight(bid, force_refresh)
+    if cached is not None:
+        return True, cached
+
     # Use a free model that is more capable, comparable to ChatGPT-style performance:
     # "google/flan-ul2" is one of the most advanced free instruction-following models.
     
     generation_status, result = prompt_model(prompt)
+    _store_insight(cache_key, bid, generation_status, result)
+    return generation_status, result
+
+async def generate_insights_async(bid, force_refresh=False):
+    """Same as generate_insights for the API: the database work runs on the worker threads, and no thread
+    is held while waiting for the model.
+    """
+
+    prompt, cache_key, cached = await run_blocking(_lookup_insight, bid, force_refresh)
+    if cached is not None:
+        return True, cached
+
+    generation_status, result = await prompt_model_async(prompt)
+    await run_blocking(_store_insight, cache_key, bid, generation_status, result)
     return generation_status, result
 
+async def stream_insights(bid, force_refresh=False):
+    """Streams the lines of a business's insight as soon as the model completes each of them, or all at once
+    when the insight is cached. The complete answer is cached like the one of generate_insights.
+
+    Keyword arguments:
+    bid -- id of the business
+    force_refresh -- ignore the cached insight and generate a new one (default: False)
+    Return: async iterator of the insight lines; raises llm_chat.LLMError if the model fails
+    """
+
+    prompt, cache_key, cached = await run_blocking(_lookup_insight, bid, force_refresh)
+    if cached is not None:
+        for line in cached.split('\n'):
+            yield line
+        return
+
+    chunks = []
+    pending = ''
+    async for chunk in stream_model(prompt):
+        chunks.append(chunk)
+        *lines, pending = (pending + chunk).split('\n')
+        for line in lines:
+            yield line
+    yield pending
+
+    await run_blocking(_store_insight, cache_key, bid, True, ''.join(chunks))
+
+def insight_cache_stats():
+    """Hit and miss counts of the insight cache since startup, and its size
+
+    Return: dictionary with the hits, misses, forced refreshes, cached entries and cache settings
+    """
+
+    with _insight_cache_lock:
+        stats = dict(_insight_cache_stats)
+    stats['entries'] = count_cached_insights()
+    stats['ttl_seconds'] = INSIGHT_CACHE_TTL
+    stats['max_entries'] = INSIGHT_CACHE_MAX_ENTRIES
+    return stats
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Generate AI-powered financial advisor insights using aggregated context from multiple datasets."
     )
     parser.add_argument("--bid", type=int, required=True, help="Business ID")
+    parser.add_argument("--force_refresh", action="store_true", help="Ignore the cached insight")
     args = parser.parse_args()
     
-    print(generate_insights(args.bid))
+    print(generate_insights(args.bid, force_refresh=args.force_refresh))
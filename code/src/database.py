@@ -1,24 +1,137 @@
+from startup import lazy_import
 import sqlite3
-import pandas as pd
 from models import UserType
 
+import contextlib
 import datetime
+import io
+import json
+import re
+import threading
+import time
+
+DATABASE_PATH = 'database.db'
+
+# applied to every pooled connection. WAL lets readers run while another connection writes,
+# and synchronous=normal is durable in WAL mode except for the last commits on power loss.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64000,  # in KiB, i.e. 64 MB per connection
+    'mmap_size': 268435456,
+    'temp_store': 'memory',
+    'busy_timeout': 5000,  # ms
+}
+
+# secondary indexes of the hot query paths, as (name, table, columns)
+SCHEMA_INDEXES = [
+    ('idx_transactions_cid_purchase_date', 'transactions', 'cid, purchase_date desc'),
+    ('idx_transactions_pid', 'transactions', 'pid'),
+    ('idx_products_bid', 'products', 'bid'),
+    # lets search_products_by_name walk the products from the most popular
+    ('idx_products_popularity', 'products', 'popularity desc, pid'),
+    ('idx_loan_applications_cid_application_date', 'loan_applications', 'cid, application_date desc'),
+    ('idx_social_media_timestamp', 'social_media', 'timestamp'),
+    ('idx_social_media_category_timestamp', 'social_media', 'category, timestamp'),
+]
+
+# rollup tables of the business KPIs, as {table: grouping column of transactions}. They hold the revenue and
+# transaction count by (bid, column), maintained by triggers as transactions and products change
+KPI_ROLLUPS = {
+    'business_product_revenue': 'pid',
+    'business_payment_mode_revenue': 'payment_mode',
+}
+
+# aggregation of the raw transactions that a rollup table materializes. Missing keys are stored as '',
+# as the rows of a null key would not conflict with each other in the primary key
+KPI_ROLLUP_AGGREGATION = '''
+select p.bid, ifnull(t.{column}, ''), sum(t.amount), count(*)
+from transactions t
+join products p on t.pid = p.pid
+{where}
+group by p.bid, ifnull(t.{column}, '')
+'''
+
+# spend summary tables of the customers, as {table: key columns}. They hold the spend and transaction count of
+# every customer by category and by payment mode (the dimension), in total and by day of purchase
+CUSTOMER_SPEND_TABLES = {
+    'customer_spend': ('cid', 'dimension', 'key'),
+    'customer_daily_spend': ('cid', 'day', 'dimension', 'key'),
+}
+
+# key expression of each dimension, and the joins it needs from transactions t
+CUSTOMER_SPEND_DIMENSIONS = {
+    'category': ('b.category', 'join products p on t.pid = p.pid join businesses b on p.bid = b.bid'),
+    'payment_mode': ('t.payment_mode', ''),
+}
+
+# default number of results of search_products_by_name
+SEARCH_RESULT_LIMIT = 50
+# matches that search_products_by_name sorts by popularity. Sorting every match of a one letter prefix among a million
+# products takes a second, so broader queries walk the products from the most popular until they have enough matches
+SEARCH_CANDIDATE_LIMIT = 1000
+
+# rows per chunk read from the CSV files and inserted with one executemany by bulk_load_csv
+BULK_LOAD_CHUNK_SIZE = 50000
+
+# one connection per thread, keyed by thread id
+_connections = {}
+_connections_lock = threading.Lock()
+
+_transaction_listeners = []
+
+# tables whose writes are counted in data_versions, used to detect stale derived data
+VERSIONED_TABLES = ['customers', 'businesses', 'products', 'transactions', 'social_media', 'loan_products', 'loan_applications']
+
+def _open_connection():
+    conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+    for (pragma, value) in SQLITE_PRAGMAS.items():
+        conn.execute(f'pragma {pragma}={value}')
+    return conn
+
+def get_connection():
+    """Get the calling thread's connection to the database, opening it on first use.
+    Connections are never shared between threads, so concurrent requests do not serialize on one cursor.
+
+    Return: sqlite3 Connection
+    """
 
-conn = sqlite3.connect('database.db')
-c = conn.cursor()
+    conn = _connections.get(threading.get_ident())
+    if conn is None:
+        conn = init_connection()
+    return conn
 
-def init_connection():
-    """initiate a new connection with the database
+def init_connection(path=None):
+    """initiate a new connection with the database for the calling thread
+    
+    Keyword arguments:
+    path -- database file used by the connections opened from now on (default: unchanged)
+    Return: sqlite3 Connection
     """
 
-    global conn, c
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
+    global DATABASE_PATH
+
+    if path:
+        DATABASE_PATH = path
+    conn = _open_connection()
+    with _connections_lock:
+        # drop the connections of threads that have exited
+        alive = {thread.ident for thread in threading.enumerate()}
+        for thread_id in [thread_id for thread_id in _connections if thread_id not in alive]:
+            _connections.pop(thread_id).close()
+        previous = _connections.get(threading.get_ident())
+        _connections[threading.get_ident()] = conn
+    if previous is not None:
+        previous.close()
+    return conn
 
 def drop_existing_tables():
     """drop the existing tables in the database
     """
 
+    conn = get_connection()
+    c = conn.cursor()
+
     c.execute('drop table if exists transactions')
     c.execute('drop table if exists loan_applications')
     c.execute('drop table if exists products')
@@ -26,13 +139,62 @@ def drop_existing_tables():
     c.execute('drop table if exists customers')
     c.execute('drop table if exists social_media')
     c.execute('drop table if exists loan_products')
+    c.execute('drop table if exists data_versions')
+    c.execute('drop table if exists recommendations')
+    c.execute('drop table if exists insight_cache')
+    c.execute('drop table if exists business_product_revenue')
+    c.execute('drop table if exists business_payment_mode_revenue')
+    c.execute('drop table if exists customer_spend')
+    c.execute('drop table if exists customer_daily_spend')
+    c.execute('drop table if exists product_search')
     conn.commit()
     print('Tables dropped')
 
+def bulk_load_csv(table_name, csv_path, columns, chunksize=BULK_LOAD_CHUNK_SIZE):
+    """Stream a CSV file into a table in chunks, inserting each chunk with executemany inside a single transaction.
+    Durability is relaxed during the load since a failed load is simply rerun.
+    
+    Keyword arguments:
+    table_name -- Name of the table to fill
+    csv_path -- Path of the CSV file, with a column for each of the given columns
+    columns -- Columns to insert
+    chunksize -- Number of rows read and inserted at once (default: BULK_LOAD_CHUNK_SIZE)
+    Return: number of rows inserted
+    """
+
+    pd = lazy_import('pandas')
+    conn = get_connection()
+    c = conn.cursor()
+
+    query = f'''
+    insert into {table_name} ({', '.join(columns)})
+    values ({', '.join('?' * len(columns))})'''
+
+    start_time = datetime.datetime.now()
+    n_rows = 0
+    c.execute('pragma synchronous=off')
+    try:
+        for chunk in pd.read_csv(csv_path, usecols=columns, chunksize=chunksize):
+            c.executemany(query, chunk[columns].itertuples(index=False, name=None))
+            n_rows += len(chunk)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        c.execute(f"pragma synchronous={SQLITE_PRAGMAS['synchronous']}")
+
+    seconds = (datetime.datetime.now() - start_time).total_seconds()
+    print(f'{table_name}: {n_rows} rows loaded in {seconds:.2f}s ({n_rows / max(seconds, 1e-6):,.0f} rows/s)')
+    return n_rows
+
 def init_customers():
     """Create the customers table
     """
 
+    conn = get_connection()
+    c = conn.cursor()
+
     c.execute('''
     create table if not exists customers (
     cid integer primary key autoincrement,
@@ -45,20 +207,18 @@ def init_customers():
     occupation text
     )''')
     
-    customers_df = pd.read_csv('initial_data/customers_usa.csv')
-    for (_, row) in customers_df.iterrows():
-        c.execute('''
-        insert into customers (name, age, gender, location, annual_income, education, occupation)
-        values (?, ?, ?, ?, ?, ?, ?)''',
-        (row['name'], row['age'], row['gender'], row['location'], row['annual_income'], row['education'], row['occupation']))
-    
     conn.commit()
+
+    bulk_load_csv('customers', 'initial_data/customers_usa.csv', ['name', 'age', 'gender', 'location', 'annual_income', 'education', 'occupation'])
     print('Customers initialized')
 
 def init_businesses():
     """Create the businesses table
     """
 
+    conn = get_connection()
+    c = conn.cursor()
+
     c.execute('''
     create table if not exists businesses (
     bid integer primary key autoincrement,
@@ -68,20 +228,18 @@ def init_businesses():
     num_employees integer
     )''')
     
-    businesses_df = pd.read_csv('initial_data/business_data.csv')
-    for (_, row) in businesses_df.iterrows():
-        c.execute('''
-        insert into businesses (category, business_name, revenue, num_employees)
-        values (?, ?, ?, ?)''',
-        (row['category'], row['business_name'], row['revenue'], row['num_employees']))
-    
     conn.commit()
+
+    bulk_load_csv('businesses', 'initial_data/business_data.csv', ['category', 'business_name', 'revenue', 'num_employees'])
     print('Businesses initialized')
 
 def init_products():
     """Create the products table
     """
 
+    conn = get_connection()
+    c = conn.cursor()
+
     c.execute('''
     create table if not exists products (
     pid integer primary key autoincrement,
@@ -93,20 +251,18 @@ def init_products():
     foreign key (bid) references businesses(bid)
     )''')
 
-    products_df = pd.read_csv('initial_data/product_data.csv')
-    for (_, row) in products_df.iterrows():
-        c.execute('''
-        insert into products (bid, product_name, popularity, price, geo_demand)
-        values (?, ?, ?, ?, ?)''',
-        (row['bid'], row['product_name'], row['popularity'], row['price'], row['geo_demand']))
-    
     conn.commit()
+
+    bulk_load_csv('products', 'initial_data/product_data.csv', ['bid', 'product_name', 'popularity', 'price', 'geo_demand'])
     print('Products initialized')
 
 def init_transactions():
     """Create the transactions table
     """
 
+    conn = get_connection()
+    c = conn.cursor()
+
     c.execute('''
     create table if not exists transactions (
     tid integer primary key autoincrement,
@@ -119,20 +275,18 @@ def init_transactions():
     foreign key (pid) references products(pid)
     )''')
 
-    transactions_df = pd.read_csv('initial_data/transactions.csv')
-    for (_, row) in transactions_df.iterrows():
-        c.execute('''
-        insert into transactions (cid, pid, amount, purchase_date, payment_mode)
-        values (?, ?, ?, ?, ?)''',
-        (row['cid'], row['pid'], row['amount'], row['purchase_date'], row['payment_mode']))
-    
     conn.commit()
+
+    bulk_load_csv('transactions', 'initial_data/transactions.csv', ['cid', 'pid', 'amount', 'purchase_date', 'payment_mode'])
     print('Transactions initialized')
 
 def init_social_media():
     """Create the social media table
     """
 
+    conn = get_connection()
+    c = conn.cursor()
+
     c.execute('''
     create table if not exists social_media (
     post_ID integer primary key autoincrement,
@@ -142,20 +296,18 @@ def init_social_media():
     sentiment_score real,
     category text)''')
 
-    social_media_df = pd.read_csv('initial_data/social_media_posts.csv')
-    for (_, row) in social_media_df.iterrows():
-        c.execute('''
-        insert into social_media (platform, content, timestamp, sentiment_score, category)
-        values (?, ?, ?, ?, ?)''',
-        (row['platform'], row['content'], row['timestamp'], row['sentiment_score'], row['category']))
-    
     conn.commit()
+
+    bulk_load_csv('social_media', 'initial_data/social_media_posts.csv', ['platform', 'content', 'timestamp', 'sentiment_score', 'category'])
     print('Social media initialized')
 
 def init_loan_products():
     """Create the loan_products table
     """
 
+    conn = get_connection()
+    c = conn.cursor()
+
     c.execute('''
     create table if not exists loan_products (
         loan_product_id INTEGER PRIMARY KEY autoincrement,
@@ -170,20 +322,18 @@ def init_loan_products():
         processing_fee REAL
     )''')
     
-    loan_products_df = pd.read_csv('initial_data/loan_product_data.csv')
-    for (_, row) in loan_products_df.iterrows():
-        c.execute('''
-        insert into loan_products (loan_product_id, loan_type, purchase_category, min_interest_rate, max_interest_rate, min_term_months, max_term_months, min_loan_amount, max_loan_amount, processing_fee)
-        values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-        (row['loan_product_id'], row['loan_type'], row['purchase_category'], row['min_interest_rate'], row['max_interest_rate'], row['min_term_months'], row['max_term_months'], row['min_loan_amount'], row['max_loan_amount'], row['processing_fee']))
-    
     conn.commit()
+
+    bulk_load_csv('loan_products', 'initial_data/loan_product_data.csv', ['loan_product_id', 'loan_type', 'purchase_category', 'min_interest_rate', 'max_interest_rate', 'min_term_months', 'max_term_months', 'min_loan_amount', 'max_loan_amount', 'processing_fee'])
     print('Loan products initialized')
 
 def init_loan_applications():
     """Create the loan applications table
     """
 
+    conn = get_connection()
+    c = conn.cursor()
+
     c.execute('''
     create table if not exists loan_applications (
     application_id integer primary key autoincrement,
@@ -201,25 +351,339 @@ def init_loan_applications():
     foreign key (loan_product_id) references loan_products(loan_product_id)
     )''')
     
-    loan_applications_df = pd.read_csv('initial_data/loan_applications.csv')
-    for (_, row) in loan_applications_df.iterrows():
+    conn.commit()
+
+    bulk_load_csv('loan_applications', 'initial_data/loan_applications.csv', ['application_id', 'cid', 'loan_product_id', 'loan_amount', 'interest_rate', 'loan_term_months', 'credit_score', 'annual_income', 'debt_to_income_ratio', 'application_date', 'status'])
+    print('Loan applications initialized')
+
+def init_recommendations():
+    """Create the recommendations table, filled by the offline precompute job in recommendations.py
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    c.execute('''
+    create table if not exists recommendations (
+    cid integer,
+    rank integer,
+    pid integer,
+    score real,
+    generated_at timestamp,
+    primary key (cid, rank),
+    foreign key (cid) references customers(cid),
+    foreign key (pid) references products(pid)
+    )''')
+
+    conn.commit()
+    print('Recommendations initialized')
+
+def init_insight_cache():
+    """Create the insight_cache table holding the generated business insights, used by business_insightgen.py
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    c.execute('''
+    create table if not exists insight_cache (
+    cache_key text primary key,
+    bid integer,
+    result text,
+    created_at real,
+    last_used_at real
+    )''')
+    c.execute('create index if not exists idx_insight_cache_last_used_at on insight_cache (last_used_at)')
+
+    conn.commit()
+    print('Insight cache initialized')
+
+def init_data_versions():
+    """Create the data_versions table and the triggers that bump a table's version on every write.
+    Each table gets a random epoch when it is first registered, so a rebuilt database never repeats a version.
+    Safe to call on every startup; tables that do not exist yet are skipped.
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    c.execute('''
+    create table if not exists data_versions (
+    table_name text primary key,
+    epoch text,
+    version integer
+    )''')
+
+    existing_tables = {row[0] for row in c.execute("select name from sqlite_master where type = 'table'").fetchall()}
+    for table_name in VERSIONED_TABLES:
+        if table_name not in existing_tables:
+            continue
         c.execute('''
-        insert into loan_applications (application_id, cid, loan_product_id, loan_amount, interest_rate, 
-                                       loan_term_months, credit_score, annual_income, debt_to_income_ratio, 
-                                       application_date, status)
-        values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-        (row['application_id'], row['cid'], row['loan_product_id'], row['loan_amount'], row['interest_rate'],
-         row['loan_term_months'], row['credit_score'], row['annual_income'], row['debt_to_income_ratio'],
-         row['application_date'], row['status']))
+        insert or ignore into data_versions (table_name, epoch, version)
+        values (?, lower(hex(randomblob(8))), 0)''', (table_name,))
+        for event in ('insert', 'update', 'delete'):
+            c.execute(f'''
+            create trigger if not exists {table_name}_{event}_version after {event} on {table_name}
+            begin
+                update data_versions set version = version + 1 where table_name = '{table_name}';
+            end''')
+
+    conn.commit()
+    print('Data versions initialized')
+
+def init_indexes(analyze=False):
+    """Schema migration creating the secondary indexes of SCHEMA_INDEXES that do not exist yet,
+    then refreshing the query planner statistics with ANALYZE if any was created.
+    Safe to call on every startup; tables that do not exist yet are skipped.
     
+    Keyword arguments:
+    analyze -- run ANALYZE even if no index was created (default: False)
+    Return: names of the created indexes
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    existing_tables = {row[0] for row in c.execute("select name from sqlite_master where type = 'table'").fetchall()}
+    existing_indexes = {row[0] for row in c.execute("select name from sqlite_master where type = 'index'").fetchall()}
+    created = []
+    for (index_name, table_name, columns) in SCHEMA_INDEXES:
+        if table_name not in existing_tables or index_name in existing_indexes:
+            continue
+        c.execute(f'create index if not exists {index_name} on {table_name} ({columns})')
+        created.append(index_name)
+
+    if created or analyze:
+        c.execute('analyze')
     conn.commit()
-    print('Loan applications initialized')
+    print(f'Indexes initialized ({len(created)} created)')
+    return created
+
+def init_kpi_rollups():
+    """Create the KPI rollup tables and the triggers maintaining them, and fill the new tables from the transactions.
+    Safe to call on every startup.
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    existing_tables = {row[0] for row in c.execute("select name from sqlite_master where type = 'table'").fetchall()}
+    for (table_name, column) in KPI_ROLLUPS.items():
+        c.execute(f'''
+        create table if not exists {table_name} (
+        bid integer,
+        {column},
+        revenue real,
+        n_transactions integer,
+        primary key (bid, {column})
+        )''')
+
+        # transactions are added to and removed from the rollup of their product's business
+        add_transaction = f'''
+            insert into {table_name} (bid, {column}, revenue, n_transactions)
+            select bid, ifnull(new.{column}, ''), new.amount, 1 from products where pid = new.pid
+            on conflict (bid, {column}) do update set revenue = revenue + excluded.revenue, n_transactions = n_transactions + 1;'''
+        remove_transaction = f'''
+            update {table_name} set revenue = revenue - old.amount, n_transactions = n_transactions - 1
+            where bid = (select bid from products where pid = old.pid) and {column} = ifnull(old.{column}, '');
+            delete from {table_name}
+            where bid = (select bid from products where pid = old.pid) and {column} = ifnull(old.{column}, '') and n_transactions = 0;'''
+        # products moving between businesses are rare, so the affected businesses are aggregated again
+        def refresh_businesses(bids):
+            return f'''
+            delete from {table_name} where bid in ({bids});
+            insert into {table_name} (bid, {column}, revenue, n_transactions)
+            {KPI_ROLLUP_AGGREGATION.format(column=column, where=f'where p.bid in ({bids})')};'''
+
+        triggers = {
+            'transactions_insert': ('after insert on transactions', add_transaction),
+            'transactions_delete': ('after delete on transactions', remove_transaction),
+            'transactions_update': ('after update of pid, amount, payment_mode on transactions', remove_transaction + add_transaction),
+            'products_insert': ('after insert on products', refresh_businesses('new.bid')),
+            'products_delete': ('after delete on products', refresh_businesses('old.bid')),
+            'products_update': ('after update of pid, bid on products', refresh_businesses('old.bid, new.bid')),
+        }
+        for (trigger_name, (event, body)) in triggers.items():
+            c.execute(f'''
+            create trigger if not exists {table_name}_{trigger_name} {event}
+            begin{body}
+            end''')
+
+    conn.commit()
+    print('KPI rollups initialized')
+
+    new_tables = [table_name for table_name in KPI_ROLLUPS if table_name not in existing_tables]
+    if new_tables:
+        rebuild_kpi_rollups(new_tables)
+
+def _customer_spend_aggregation(table_name, dimension, source='transactions', where='', sign=''):
+    # spend of the transactions of source by the key columns of a customer spend table, with '' for missing keys
+    # like KPI_ROLLUP_AGGREGATION
+    key, joins = CUSTOMER_SPEND_DIMENSIONS[dimension]
+    day = ", ifnull(substr(t.purchase_date, 1, 10), '')" if 'day' in CUSTOMER_SPEND_TABLES[table_name] else ''
+    return f'''
+    select t.cid{day}, '{dimension}', ifnull({key}, ''), {sign}sum(t.amount), {sign}count(*)
+    from {source} t {joins}
+    {where}
+    group by t.cid{day}, ifnull({key}, '')'''
+
+def init_customer_spend_summary():
+    """Create the customer spend summary tables and the triggers maintaining them, and fill the new tables from the transactions.
+    Safe to call on every startup.
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    existing_tables = {row[0] for row in c.execute("select name from sqlite_master where type = 'table'").fetchall()}
+    # the changed transaction, as a one row table that the aggregations can read like transactions
+    changed_rows = {
+        row: f'(select {row}.cid as cid, {row}.pid as pid, {row}.amount as amount, {row}.purchase_date as purchase_date, {row}.payment_mode as payment_mode)'
+        for row in ('new', 'old')
+    }
+    for (table_name, key_columns) in CUSTOMER_SPEND_TABLES.items():
+        columns = ', '.join(key_columns)
+        c.execute(f'''
+        create table if not exists {table_name} (
+        {columns},
+        spend real,
+        n_transactions integer,
+        primary key ({columns})
+        )''')
+
+        # a removed transaction is added with a negative spend and count, and the emptied rows are deleted
+        def apply_transaction(row, sign):
+            return ''.join(f'''
+            insert into {table_name} ({columns}, spend, n_transactions)
+            {_customer_spend_aggregation(table_name, dimension, changed_rows[row], 'where true', sign)}
+            on conflict ({columns}) do update set spend = spend + excluded.spend, n_transactions = n_transactions + excluded.n_transactions;'''
+                for dimension in CUSTOMER_SPEND_DIMENSIONS)
+        remove_transaction = apply_transaction('old', '-') + f'''
+            delete from {table_name} where cid = old.cid and n_transactions = 0;'''
+        # changes of the category of products are rare, so the affected customers are aggregated again
+        def refresh_categories(cids):
+            return f'''
+            delete from {table_name} where dimension = 'category' and cid in ({cids});
+            insert into {table_name} ({columns}, spend, n_transactions)
+            {_customer_spend_aggregation(table_name, 'category', where=f'where t.cid in ({cids})')};'''
+        product_customers = 'select cid from transactions where pid in ({pids})'
+        business_customers = 'select t.cid from transactions t join products p on t.pid = p.pid where p.bid in ({bids})'
+
+        triggers = {
+            'transactions_insert': ('after insert on transactions', apply_transaction('new', '')),
+            'transactions_delete': ('after delete on transactions', remove_transaction),
+            'transactions_update': ('after update of cid, pid, amount, purchase_date, payment_mode on transactions', remove_transaction + apply_transaction('new', '')),
+            'products_insert': ('after insert on products', refresh_categories(product_customers.format(pids='new.pid'))),
+            'products_delete': ('after delete on products', refresh_categories(product_customers.format(pids='old.pid'))),
+            'products_update': ('after update of pid, bid on products', refresh_categories(product_customers.format(pids='old.pid, new.pid'))),
+            'businesses_insert': ('after insert on businesses', refresh_categories(business_customers.format(bids='new.bid'))),
+            'businesses_delete': ('after delete on businesses', refresh_categories(business_customers.format(bids='old.bid'))),
+            'businesses_update': ('after update of bid, category on businesses', refresh_categories(business_customers.format(bids='old.bid, new.bid'))),
+        }
+        for (trigger_name, (event, body)) in triggers.items():
+            c.execute(f'''
+            create trigger if not exists {table_name}_{trigger_name} {event}
+            begin{body}
+            end''')
+
+    conn.commit()
+    print('Customer spend summary initialized')
+
+    new_tables = [table_name for table_name in CUSTOMER_SPEND_TABLES if table_name not in existing_tables]
+    if new_tables:
+        rebuild_kpi_rollups(new_tables)
+
+def _rollup_definitions():
+    # {table: (key columns, value column, aggregation of the raw transactions)} of every rollup table
+    definitions = {}
+    for (table_name, column) in KPI_ROLLUPS.items():
+        definitions[table_name] = (('bid', column), 'revenue', KPI_ROLLUP_AGGREGATION.format(column=column, where=''))
+    for (table_name, key_columns) in CUSTOMER_SPEND_TABLES.items():
+        aggregation = ' union all '.join(_customer_spend_aggregation(table_name, dimension) for dimension in CUSTOMER_SPEND_DIMENSIONS)
+        definitions[table_name] = (key_columns, 'spend', aggregation)
+    return definitions
+
+def rebuild_kpi_rollups(table_names=None):
+    """Recompute the business KPI rollups and the customer spend summary from the raw transactions
+    
+    Keyword arguments:
+    table_names -- rollup tables to rebuild (default: all of KPI_ROLLUPS and CUSTOMER_SPEND_TABLES)
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    definitions = _rollup_definitions()
+    start = time.perf_counter()
+    for table_name in table_names or definitions:
+        key_columns, value_column, aggregation = definitions[table_name]
+        c.execute(f'delete from {table_name}')
+        c.execute(f'''
+        insert into {table_name} ({', '.join(key_columns)}, {value_column}, n_transactions)
+        {aggregation}''')
+    conn.commit()
+    print(f'KPI rollups rebuilt in {time.perf_counter() - start:.2f}s')
+
+def init_product_search():
+    """Create the full-text search index of the products (product name, business name and category) and the triggers
+    maintaining it, and fill it from the products if it is new. Safe to call on every startup.
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    is_new = c.execute("select count(*) from sqlite_master where name = 'product_search'").fetchone()[0] == 0
+    # the rowid of an indexed product is its pid. prefix indexes make the short autocomplete prefixes cheap
+    c.execute('''
+    create virtual table if not exists product_search using fts5 (
+    product_name,
+    business_name,
+    category,
+    tokenize = 'unicode61 remove_diacritics 2',
+    prefix = '1 2 3 4'
+    )''')
+
+    add_product = '''
+        insert into product_search (rowid, product_name, business_name, category)
+        select new.pid, new.product_name, b.business_name, b.category from (select 1) left join businesses b on b.bid = new.bid;'''
+    remove_product = '''
+        delete from product_search where rowid = old.pid;'''
+    # the products of a changed business are indexed again
+    refresh_businesses = '''
+        delete from product_search where rowid in (select pid from products where bid in ({bids}));
+        insert into product_search (rowid, product_name, business_name, category)
+        select p.pid, p.product_name, b.business_name, b.category from products p left join businesses b on b.bid = p.bid
+        where p.bid in ({bids});'''
+    triggers = {
+        'products_insert': ('after insert on products', add_product),
+        'products_delete': ('after delete on products', remove_product),
+        'products_update': ('after update of pid, bid, product_name on products', remove_product + add_product),
+        'businesses_insert': ('after insert on businesses', refresh_businesses.format(bids='new.bid')),
+        'businesses_delete': ('after delete on businesses', refresh_businesses.format(bids='old.bid')),
+        'businesses_update': ('after update of bid, business_name, category on businesses', refresh_businesses.format(bids='old.bid, new.bid')),
+    }
+    for (trigger_name, (event, body)) in triggers.items():
+        c.execute(f'''
+        create trigger if not exists product_search_{trigger_name} {event}
+        begin{body}
+        end''')
+
+    if is_new:
+        c.execute('''
+        insert into product_search (rowid, product_name, business_name, category)
+        select p.pid, p.product_name, b.business_name, b.category from products p left join businesses b on b.bid = p.bid''')
+        # merge the index segments written by the bulk insert
+        c.execute("insert into product_search (product_search) values ('optimize')")
+    conn.commit()
+    print('Product search initialized')
 
 def init_db():
     """
     Drops (if existing) and re-initializes all the tables in the database
     """
 
+    c = get_connection().cursor()
+
     c.execute('pragma foreign_keys=on')
     drop_existing_tables()
     init_customers()
@@ -229,14 +693,24 @@ def init_db():
     init_social_media()
     init_loan_products()
     init_loan_applications()
+    init_recommendations()
+    init_insight_cache()
+    init_indexes(analyze=True)
+    init_data_versions()
+    init_kpi_rollups()
+    init_customer_spend_summary()
+    init_product_search()
     print("initialization complete")
 
 def close_connection():
-    """Close the connection
+    """Close the connections of every thread
     """
 
-    conn.close()
-    c = None
+    with _connections_lock:
+        connections = list(_connections.values())
+        _connections.clear()
+    for conn in connections:
+        conn.close()
     print('Connection closed')
 
 def get_first_n(table_name, n):
@@ -248,6 +722,8 @@ def get_first_n(table_name, n):
     Return: List of tuples with required number of rows
     """
 
+    c = get_connection().cursor()
+
     c.execute(f'select * from {table_name} limit {n}')
     rows = c.fetchall()
     return rows
@@ -264,10 +740,10 @@ def get_df_from_table(table_name, limit=None, order_by=None, order=None, index_c
 
     Return: DataFrame
     """
-    
-    if not c:
-        init_connection()
 
+    pd = lazy_import('pandas')
+    conn = get_connection()
+    
     query = f'select * from {table_name}'
     if order_by:
         query += f' order by {order_by}'
@@ -278,44 +754,210 @@ def get_df_from_table(table_name, limit=None, order_by=None, order=None, index_c
     
     return pd.read_sql_query(query, conn, index_col=index_col)
 
-def execute_and_fetch_rows(query, as_df=False, index_col=None):
-    """Executes a query and fetches all the rows, optionally as a DataFrame
+def execute_and_fetch_rows(query, as_df=False, index_col=None, params=(), as_dict=False):
+    """Executes a query and fetches all the rows, optionally as a DataFrame or as dictionaries
     
     Keyword arguments:
     query -- string, what to execute
     as_df -- boolean, returns a DataFrame if True, otherwise a List of Tuples (default: False)
     index_col -- string, the column to make the index of the dataframe (default: None)
-    Return: List of tuples or DataFrame
+    params -- values of the ? placeholders of the query (default: ())
+    as_dict -- boolean, returns a List of dictionaries keyed by column if True. Meant for API responses,
+               which do not need a DataFrame (default: False)
+    Return: List of tuples, List of dictionaries or DataFrame
     """
 
-    if not c:
-        init_connection()
-    
-    result = c.execute(query).fetchall()
+    c = get_connection().cursor()
+
+    result = c.execute(query, params).fetchall()
+    if as_dict:
+        columns = [desc[0] for desc in c.description]
+        return [dict(zip(columns, row)) for row in result]
     if as_df:
+        pd = lazy_import('pandas')
         df = pd.DataFrame(result, columns=[desc[0] for desc in c.description])
         if index_col:
             df.set_index(index_col, inplace=True)
         return df
     return result
     
-def execute_and_fetch_one(query, as_df=False):
-    """Executes a query and fetches the first row, optionally as a DataFrame
+def execute_and_fetch_one(query, as_df=False, as_dict=False):
+    """Executes a query and fetches the first row, optionally as a DataFrame or as a dictionary
     
     Keyword arguments:
     query -- string, what to execute
     as_df -- boolean, returns a DataFrame if True, otherwise a List of Tuples (default: False)
-    Return: List of tuples or DataFrame
+    as_dict -- boolean, returns a dictionary keyed by column if True, or None if there is no row (default: False)
+    Return: List of tuples, dictionary or DataFrame
     """
 
-    if not c:
-        init_connection()
-    
+    c = get_connection().cursor()
+
     result = c.execute(query).fetchone()
+    if as_dict:
+        return dict(zip([desc[0] for desc in c.description], result)) if result else None
     if as_df:
+        pd = lazy_import('pandas')
         return pd.DataFrame([result], columns=[desc[0] for desc in c.description]) if result else pd.DataFrame()
     return result
 
+def add_transaction_listener(listener):
+    """Register a callable that is notified of the transactions added through insert_transactions
+    
+    Keyword arguments:
+    listener -- callable taking the list of inserted rows
+    """
+
+    _transaction_listeners.append(listener)
+
+def insert_transactions(rows):
+    """Insert new transactions and notify the registered listeners
+    
+    Keyword arguments:
+    rows -- list of (cid, pid, amount, purchase_date, payment_mode) tuples
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    rows = list(rows)
+    c.executemany('''
+    insert into transactions (cid, pid, amount, purchase_date, payment_mode)
+    values (?, ?, ?, ?, ?)''', rows)
+    conn.commit()
+
+    for listener in _transaction_listeners:
+        listener(rows)
+
+def save_recommendations(rows, cids):
+    """Replace the precomputed recommendations of some customers in a single transaction
+    
+    Keyword arguments:
+    rows -- list of (cid, rank, pid, score, generated_at) tuples
+    cids -- ids of the customers whose previous recommendations are replaced
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    cid_list = ', '.join(str(int(cid)) for cid in cids)
+    c.execute(f'delete from recommendations where cid in ({cid_list})')
+    c.executemany('''
+    insert into recommendations (cid, rank, pid, score, generated_at)
+    values (?, ?, ?, ?, ?)''', rows)
+    conn.commit()
+
+def get_precomputed_recommendations(cid:int, as_df=False, as_dict=False):
+    """Return the precomputed recommendations of a customer with the product and business information
+    
+    Keyword arguments:
+    cid -- id of the customer
+    as_df -- whether to convert it into a DataFrame
+    as_dict -- whether to return dictionaries keyed by column
+
+    Return: List of Tuples, List of dictionaries or DataFrame, best recommendation first
+    """
+
+    query = f'''
+    select p.*, b.category, b.business_name, r.score, r.generated_at
+    from recommendations r
+    join products p on r.pid = p.pid
+    join businesses b on p.bid = b.bid
+    where r.cid = {cid}
+    order by r.rank
+    '''
+    try:
+        return execute_and_fetch_rows(query, as_df=as_df, as_dict=as_dict)
+    except sqlite3.OperationalError:
+        # the precompute job has never run on this database
+        return lazy_import('pandas').DataFrame() if as_df and not as_dict else []
+
+def get_cached_insight(cache_key:str, ttl:float):
+    """Return a cached insight if it is younger than ttl, marking it as recently used
+    
+    Keyword arguments:
+    cache_key -- key of the insight
+    ttl -- maximum age of the insight in seconds
+    Return: the cached insight text, or None
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    now = time.time()
+    try:
+        row = c.execute('select result, created_at from insight_cache where cache_key = ?', (cache_key,)).fetchone()
+    except sqlite3.OperationalError:
+        # the cache table has not been created on this database
+        return None
+    if row is None or now - row[1] > ttl:
+        return None
+
+    c.execute('update insight_cache set last_used_at = ? where cache_key = ?', (now, cache_key))
+    conn.commit()
+    return row[0]
+
+def save_cached_insight(cache_key:str, bid:int, result:str, ttl:float, max_entries:int):
+    """Store an insight in the cache, then evict the expired entries and the least recently used ones beyond max_entries
+    
+    Keyword arguments:
+    cache_key -- key of the insight
+    bid -- id of the business
+    result -- insight text
+    ttl -- maximum age of the cached insights in seconds
+    max_entries -- maximum number of cached insights
+    """
+
+    conn = get_connection()
+    c = conn.cursor()
+
+    now = time.time()
+    try:
+        c.execute('''
+        insert or replace into insight_cache (cache_key, bid, result, created_at, last_used_at)
+        values (?, ?, ?, ?, ?)''', (cache_key, bid, result, now, now))
+        c.execute('delete from insight_cache where created_at < ?', (now - ttl,))
+        c.execute('''
+        delete from insight_cache where cache_key not in (
+            select cache_key from insight_cache order by last_used_at desc limit ?
+        )''', (max_entries,))
+        conn.commit()
+    except sqlite3.OperationalError:
+        # the insight is still returned, just not cached
+        conn.rollback()
+
+def count_cached_insights():
+    """Return the number of cached insights
+    """
+
+    c = get_connection().cursor()
+
+    try:
+        return c.execute('select count(*) from insight_cache').fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+
+def get_data_version(*table_names):
+    """Get the current data version of one or more tables
+    
+    Keyword arguments:
+    table_names -- names of the tables, as registered by init_data_versions
+    Return: string that changes whenever any of the tables is written to, or None if versions are not tracked
+    """
+
+    c = get_connection().cursor()
+
+    versions = []
+    for table_name in table_names:
+        try:
+            row = c.execute('select epoch, version from data_versions where table_name = ?', (table_name,)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row is None:
+            return None
+        versions.append(f'{table_name}:{row[0]}:{row[1]}')
+    return '|'.join(versions)
+
 def get_last_n_transactions_for_customer(cid:int, n:int=10, as_df = False):
     """Get the last {n} transactions for the customer
     
@@ -365,6 +1007,31 @@ def get_last_n_transactions_for_all_customers(n:int=10, as_df=False):
         return result_grouped
     return result
 
+def get_last_n_transactions_for_customers(cids, n:int=10, as_df=False):
+    """Get the last {n} transactions for each of the given customers as a batch query
+    
+    Keyword arguments:
+    cids -- ids of the customers
+    n -- number of transactions per customer (default: 10)
+    as_df -- whether to convert it into a DataFrame
+
+    Return: List of Tuples or DataFrame
+    """
+
+    cid_list = ', '.join(str(int(cid)) for cid in cids)
+    query = f'''
+    select tid, cid, pid, amount, purchase_date, payment_mode
+    from (
+        select 
+            tid, cid, pid, amount, purchase_date, payment_mode,
+            ROW_NUMBER() over (partition by cid order by purchase_date DESC) AS rn
+        from transactions
+        where cid in ({cid_list})
+    )
+    where rn <= {n}
+    '''
+    return execute_and_fetch_rows(query, as_df=as_df)
+
 def get_last_n_social_media_posts(n:int, as_df=False):
     """Get last {n} social media posts from the database
     
@@ -421,44 +1088,198 @@ def get_product_by_pid(pid:int, as_df=False):
     '''
     return execute_and_fetch_one(query, as_df=as_df)
 
-def search_products_by_name(query: str, as_df=False):
-    search_query = f"""
+def _product_search_expression(words, column=None):
+    # quoted terms, so that the user's text is never parsed as FTS5 syntax. Only the last word is being typed,
+    # and matching the others as whole words is much cheaper than as prefixes
+    expression = ' '.join(f'"{word}"' for word in words[:-1]) + f' "{words[-1]}"*'
+    return f'{{{column}}} : ({expression})' if column else expression
+
+def _popular_search_matches(expression, limit):
+    """pids of the products matching a product_search expression, most popular first
+    """
+
+    (n_matches,) = execute_and_fetch_rows('''
+    SELECT count(*) FROM (SELECT 1 FROM product_search WHERE product_search MATCH ? LIMIT ?)
+    ''', params=(expression, SEARCH_CANDIDATE_LIMIT + 1))[0]
+    if n_matches <= SEARCH_CANDIDATE_LIMIT:
+        # few matches: sort them all
+        query = '''
+        SELECT p.pid
+        FROM product_search s
+        JOIN products p ON p.pid = s.rowid
+        JOIN businesses b ON p.bid = b.bid
+        WHERE product_search MATCH ?
+        ORDER BY p.popularity DESC, p.pid
+        LIMIT ?
+        '''
+    else:
+        # many matches: walk the products in popularity order, which meets enough of them early.
+        # The unary + keeps the planner from looking up every match by pid and sorting them instead
+        query = '''
+        SELECT p.pid
+        FROM products p
+        JOIN businesses b ON p.bid = b.bid
+        WHERE +p.pid IN (SELECT rowid FROM product_search WHERE product_search MATCH ?)
+        ORDER BY p.popularity DESC, p.pid
+        LIMIT ?
+        '''
+    return [row[0] for row in execute_and_fetch_rows(query, params=(expression, limit))]
+
+def search_products_by_name(query: str, as_df=False, limit: int = SEARCH_RESULT_LIMIT, as_dict=False):
+    """Search the products whose name, business name or category contain the words of the query, the last one
+    possibly incomplete, using the product_search index. Products whose name has all the words come first, then
+    the most popular; search_typeahead ranks the same way.
+
+    Keyword arguments:
+    query -- text typed by the user
+    as_df -- whether to convert it into a DataFrame
+    limit -- maximum number of products returned (default: SEARCH_RESULT_LIMIT)
+    as_dict -- whether to return dictionaries keyed by column
+
+    Return: List of Tuples, List of dictionaries or DataFrame
+    """
+
+    # split on the separators of the product_search tokenizer
+    words = re.findall(r'[^\W_]+', query)
+    pids = []
+    if words:
+        pids = _popular_search_matches(_product_search_expression(words, 'product_name'), limit)
+        if len(pids) < limit:
+            # the products whose name has every word match the whole expression as well
+            name_matches = set(pids)
+            other_matches = _popular_search_matches(_product_search_expression(words), limit + len(pids))
+            pids += [pid for pid in other_matches if pid not in name_matches][:limit - len(pids)]
+
+    # an empty result still has the columns
+    search_query = """
     SELECT p.*, b.category, b.business_name
-    FROM products p
+    FROM json_each(?) r
+    JOIN products p ON p.pid = r.value
     JOIN businesses b ON p.bid = b.bid
-    WHERE p.product_name LIKE '%{query}%'
+    ORDER BY r.key
     """
-    return execute_and_fetch_rows(search_query, as_df)
+    return execute_and_fetch_rows(search_query, as_df, params=(json.dumps(pids),), as_dict=as_dict)
 
-def get_customer_by_cid(cid:int, as_df=False):
+def get_customer_by_cid(cid:int, as_df=False, as_dict=False):
     """Return the customer based on cid
     
     Keyword arguments:
     cid -- id of the customer
     as_df -- whether to convert it into a DataFrame
+    as_dict -- whether to return a dictionary keyed by column
 
-    Return: List of Tuples or DataFrame
+    Return: Tuple, dictionary or DataFrame; None if there is no such customer (except for a DataFrame, which is empty)
     """
 
     query = f'''
     select * from customers where cid = {cid}
     '''
-    return execute_and_fetch_one(query, as_df=as_df)
+    return execute_and_fetch_one(query, as_df=as_df, as_dict=as_dict)
+
+def get_sample_cid():
+    """Return the id of one customer, e.g. to warm up the recommendation paths at startup
+    
+    Return: id of the customer with the smallest cid, or None if there are no customers
+    """
+
+    return execute_and_fetch_one('select min(cid) from customers')[0]
+
+def get_customers_by_cids(cids, as_df=False, as_dict=False):
+    """Return the customers with the given cids in a single query
+    
+    Keyword arguments:
+    cids -- ids of the customers
+    as_df -- whether to convert it into a DataFrame
+    as_dict -- whether to return dictionaries keyed by column
+
+    Return: List of Tuples, List of dictionaries or DataFrame
+    """
+
+    cid_list = ', '.join(str(int(cid)) for cid in cids)
+    query = f'''
+    select * from customers where cid in ({cid_list})
+    '''
+    return execute_and_fetch_rows(query, as_df=as_df, as_dict=as_dict)
 
-def get_business_by_bid(bid:int, as_df=False):
+def get_business_by_bid(bid:int, as_df=False, as_dict=False):
     """Return the business based on bid
     
     Keyword arguments:
     bid -- id of the business
     as_df -- whether to convert it into a DataFrame
+    as_dict -- whether to return a dictionary keyed by column
     
-    Return: List of Tuples or DataFrame
+    Return: Tuple, dictionary or DataFrame; None if there is no such business (except for a DataFrame, which is empty)
     """
 
     query = f'''
     select * from businesses where bid = {bid}
     '''
-    return execute_and_fetch_one(query, as_df=as_df)
+    return execute_and_fetch_one(query, as_df=as_df, as_dict=as_dict)
+
+def get_products_by_bid(bid:int, as_df=False):
+    """Return the products of a business
+    
+    Keyword arguments:
+    bid -- id of the business
+    as_df -- whether to convert it into a DataFrame
+    
+    Return: List of Tuples or DataFrame
+    """
+
+    query = f'''
+    select * from products where bid = {bid}
+    '''
+    return execute_and_fetch_rows(query, as_df=as_df)
+
+def get_avg_category_sentiment(category:str):
+    """Return the average sentiment score of the social media posts about a category
+    
+    Keyword arguments:
+    category -- business category
+    
+    Return: float, or None if there are no posts about the category
+    """
+
+    c = get_connection().cursor()
+
+    row = c.execute('select avg(sentiment_score) from social_media where category = ?', (category,)).fetchone()
+    return row[0]
+
+def get_top_customers_by_business_spend(bid:int, fraction:float=0.05, as_df=False):
+    """Return the customers who spent the most on a business's products, with their profile.
+    The spend is aggregated and ranked in SQL so only the selected customers are fetched.
+    
+    Keyword arguments:
+    bid -- id of the business
+    fraction -- share of the business's customers to return; one more customer is always included (default: 0.05)
+    as_df -- whether to convert it into a DataFrame
+    
+    Return: List of Tuples or DataFrame of (cid, amount, age, gender, annual_income, education), highest spend first
+    """
+
+    query = f'''
+    with spend as (
+        select t.cid, sum(t.amount) as amount
+        from transactions t
+        join products p on t.pid = p.pid
+        where p.bid = {bid}
+        group by t.cid
+    ),
+    ranked as (
+        select
+            cid, amount,
+            ROW_NUMBER() over (order by amount desc) as rn,
+            count(*) over () as total
+        from spend
+    )
+    select ranked.cid, ranked.amount, c.age, c.gender, c.annual_income, c.education
+    from ranked
+    left join customers c on ranked.cid = c.cid
+    where ranked.rn <= cast({float(fraction)} * ranked.total as integer) + 1
+    order by ranked.rn
+    '''
+    return execute_and_fetch_rows(query, as_df=as_df)
 
 def get_last_n_loan_applications_by_cid(cid:int, n:int=None, as_df=False):
     """Return the loan applications for a customer
@@ -479,79 +1300,87 @@ def get_last_n_loan_applications_by_cid(cid:int, n:int=None, as_df=False):
         """
     return execute_and_fetch_rows(query, as_df=as_df)
 
-def validate_user(user_id:str, password:str, user_type:UserType) -> pd.DataFrame:
+def get_loan_application_summaries(cids, n:int=10, as_df=False):
+    """Return the mean debt to income ratio and credit score over the last {n} loan applications
+    of each of the given customers as a batch query. Customers without applications are left out.
+    
+    Keyword arguments:
+    cids -- ids of the customers
+    n -- number of loan applications per customer (default: 10)
+    as_df -- whether to convert it into a DataFrame
+
+    Return: List of Tuples or DataFrame
+    """
+
+    cid_list = ', '.join(str(int(cid)) for cid in cids)
+    query = f'''
+    select cid, avg(debt_to_income_ratio) as debt_to_income_ratio, avg(credit_score) as credit_score
+    from (
+        select 
+            cid, debt_to_income_ratio, credit_score,
+            ROW_NUMBER() over (partition by cid order by application_date DESC) AS rn
+        from loan_applications
+        where cid in ({cid_list})
+    )
+    where rn <= {n}
+    group by cid
+    '''
+    return execute_and_fetch_rows(query, as_df=as_df)
+
+def validate_user(user_id:str, password:str, user_type:UserType) -> dict:
     """Validate user credentials and type
     
     Keyword arguments:
     user_id -- id of the customer or business
     password -- password
 
-    Return: boolean indicating status of authentication  
+    Return: dictionary of the customer or business if authenticated, otherwise None
     """
 
     if password != 'password':
         return None
     if user_type == UserType.CUSTOMER:
-        result = get_customer_by_cid(user_id, as_df=True)
+        return get_customer_by_cid(user_id, as_dict=True)
     elif user_type == UserType.BUSINESS:
-        result = get_business_by_bid(user_id, as_df=True)
-    else:
-        return None
-    return result.iloc[0].to_dict() if not result.empty else None
+        return get_business_by_bid(user_id, as_dict=True)
+    return None
 
 # init_db() 
 
 
 def get_category_and_payment_summary(cid: int, after_date: datetime.date = None):
-    """Get aggregated spend by category and payment mode for a given customer.
+    """Get aggregated spend by category and payment mode for a given customer, from the spend summary
+    maintained by init_customer_spend_summary.
 
     Keyword arguments:
     cid -- id of the customer
+    after_date -- only count the purchases made on or after this day (default: None)
 
     Return: JSON-like dictionary
     """
 
-    where_clause = f"WHERE t.cid = {cid}"
     if after_date:
-        after_date_str = after_date.strftime('%Y-%m-%d %H:%M:%S')
-        where_clause += f" AND t.purchase_date >= '{after_date_str}'"
-
-    # Query to aggregate spend by category
-    category_query = f'''
-    SELECT b.category, SUM(t.amount) as spend
-    FROM transactions t
-    JOIN products p ON t.pid = p.pid
-    JOIN businesses b ON p.bid = b.bid
-    {where_clause}
-    GROUP BY b.category
-    '''
-
-    print(category_query)
-
-    # Query to aggregate spend by payment mode
-    payment_query = f'''
-    SELECT t.payment_mode as mode, SUM(t.amount) as spend
-    FROM transactions t
-    {where_clause}
-    GROUP BY t.payment_mode
-    '''
-
-    # Execute both queries and fetch results
-    category_data = execute_and_fetch_rows(category_query)
-    payment_data = execute_and_fetch_rows(payment_query)
-
-    # Format category data
-    category_summary = [{"category": row[0], "spend": row[1]} for row in category_data]
-    
-    # Format payment mode data
-    payment_summary = [{"mode": row[0], "spend": row[1]} for row in payment_data]
+        # the daily buckets answer for whole days
+        query = f'''
+        SELECT dimension, key, SUM(spend) as spend
+        FROM customer_daily_spend
+        WHERE cid = {cid} AND day >= '{after_date.strftime('%Y-%m-%d')}'
+        GROUP BY dimension, key
+        '''
+    else:
+        query = f'''
+        SELECT dimension, key, spend
+        FROM customer_spend
+        WHERE cid = {cid}
+        ORDER BY dimension, key
+        '''
 
-    # Combine the results
     result = {
-        "category": category_summary,
-        "payment_mode": payment_summary
+        "category": [],
+        "payment_mode": []
     }
-    print(result)
+    for (dimension, key, spend) in execute_and_fetch_rows(query):
+        result[dimension].append({"category" if dimension == "category" else "mode": key, "spend": spend})
 
     return result
 
@@ -566,13 +1395,13 @@ def get_product_revenue_info(bid: int, as_df=False):
     Return: List of Tuples or DataFrame
     """
 
-    # Query to aggregate revenue by product
+    # revenue by product, from the rollup maintained by init_kpi_rollups
     product_query = f'''
-    SELECT p.product_name, SUM(t.amount) as spend
-    FROM transactions t
-    JOIN products p ON t.pid = p.pid
-    WHERE p.bid = {bid}
-    GROUP BY t.pid
+    SELECT p.product_name, r.revenue as spend
+    FROM business_product_revenue r
+    JOIN products p ON r.pid = p.pid
+    WHERE r.bid = {bid}
+    ORDER BY r.pid
     '''
 
     # Execute query and fetch results
@@ -590,13 +1419,12 @@ def get_payment_mode_revenue_info(bid: int, as_df=False):
     Return: List of Tuples or DataFrame
     """
 
-    # Query to aggregate revenue by payment_mode
+    # revenue by payment mode, from the rollup maintained by init_kpi_rollups
     payment_mode_query = f'''
-    SELECT t.payment_mode, SUM(t.amount) as spend
-    FROM transactions t
-    JOIN products p ON t.pid = p.pid
-    WHERE p.bid = {bid}
-    GROUP BY t.payment_mode
+    SELECT payment_mode, revenue as spend
+    FROM business_payment_mode_revenue
+    WHERE bid = {bid}
+    ORDER BY payment_mode
     '''
 
     # Execute query and fetch results
@@ -605,7 +1433,113 @@ def get_payment_mode_revenue_info(bid: int, as_df=False):
     return result
 
 
+# helpers checked by check_query_plans, with sample arguments
+QUERY_PLAN_CHECKS = [
+    ('get_last_n_transactions_for_customer', (1,)),
+    ('get_last_n_transactions_for_customers', ([1, 2, 3],)),
+    ('get_last_n_transactions_for_all_customers', ()),
+    ('get_last_n_social_media_posts', (10,)),
+    ('get_avg_recent_sentiment', (100,)),
+    ('get_product_by_pid', (1,)),
+    ('get_customer_by_cid', (1,)),
+    ('get_customers_by_cids', ([1, 2, 3],)),
+    ('get_business_by_bid', (1,)),
+    ('get_last_n_loan_applications_by_cid', (1, 10)),
+    ('get_loan_application_summaries', ([1, 2, 3],)),
+    ('get_category_and_payment_summary', (1, datetime.date(2024, 1, 1))),
+    ('get_products_by_bid', (1,)),
+    ('get_avg_category_sentiment', ('Electronics',)),
+    ('get_top_customers_by_business_spend', (1,)),
+    ('get_product_revenue_info', (1,)),
+    ('get_payment_mode_revenue_info', (1,)),
+    ('get_precomputed_recommendations', (1,)),
+]
+
+def _full_scans(plan_details):
+    # e.g. 'SCAN transactions', but not 'SCAN t USING INDEX ...' or scans of subquery and CTE results
+    intermediate_results = {detail.split(' ', 1)[1] for detail in plan_details if detail.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+    return [detail for detail in plan_details
+            if detail.startswith('SCAN ') and ' USING ' not in detail and not detail.startswith('SCAN (')
+            and detail[len('SCAN '):] not in intermediate_results]
+
+def check_query_plans(checks=None):
+    """Verify with EXPLAIN QUERY PLAN that the query helpers use an index instead of scanning whole tables.
+    Each helper is called with sample arguments and the statements it runs are captured and explained.
+    
+    Keyword arguments:
+    checks -- list of (helper name, arguments) tuples (default: QUERY_PLAN_CHECKS)
+    Return: list of (helper name, statement, plan detail) tuples, one per full table scan; empty when all is well
+    """
+
+    conn = get_connection()
+
+    violations = []
+    for (helper_name, args) in checks or QUERY_PLAN_CHECKS:
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            # some helpers print their results
+            with contextlib.redirect_stdout(io.StringIO()):
+                globals()[helper_name](*args)
+        finally:
+            conn.set_trace_callback(None)
+
+        for statement in statements:
+            plan_details = [row[3] for row in conn.execute(f'explain query plan {statement}').fetchall()]
+            for detail in _full_scans(plan_details):
+                violations.append((helper_name, statement, detail))
+    return violations
+
+def check_kpi_rollups(tolerance=1e-9):
+    """Compare the business KPI rollups and the customer spend summary with the aggregation of the raw transactions
+    
+    Keyword arguments:
+    tolerance -- relative difference of the sums allowed for the rounding of the incremental updates (default: 1e-9)
+    Return: list of (table, key values, expected sum, rollup sum) tuples, one per mismatch; empty when consistent
+    """
+
+    c = get_connection().cursor()
+
+    mismatches = []
+    for (table_name, (key_columns, value_column, aggregation)) in _rollup_definitions().items():
+        expected = {row[:-2]: row[-2:] for row in c.execute(aggregation)}
+        actual = {row[:-2]: row[-2:] for row in c.execute(f'select {", ".join(key_columns)}, {value_column}, n_transactions from {table_name}')}
+        for key in sorted(expected.keys() | actual.keys(), key=repr):
+            expected_value, expected_count = expected.get(key, (None, None))
+            actual_value, actual_count = actual.get(key, (None, None))
+            if expected_count != actual_count or (expected_value is None) != (actual_value is None) or (
+                    expected_value is not None and abs(actual_value - expected_value) > tolerance * max(1, abs(expected_value))):
+                mismatches.append((table_name, key, expected_value, actual_value))
+    return mismatches
+
 if __name__ == '__main__':
-    init_db()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Initialize the database, or migrate and check the existing one.")
+    parser.add_argument("--migrate", action="store_true", help="Create the missing indexes and refresh the planner statistics")
+    parser.add_argument("--check-query-plans", action="store_true", help="Check that the query helpers use indexes")
+    parser.add_argument("--rebuild-kpi-rollups", action="store_true", help="Recompute the business KPI rollups and customer spend summary from the transactions")
+    parser.add_argument("--check-kpi-rollups", action="store_true", help="Compare the business KPI rollups and customer spend summary with the transactions")
+    args = parser.parse_args()
+
+    if args.migrate or args.check_query_plans or args.rebuild_kpi_rollups or args.check_kpi_rollups:
+        if args.migrate:
+            init_indexes(analyze=True)
+            init_kpi_rollups()
+            init_customer_spend_summary()
+        if args.rebuild_kpi_rollups:
+            rebuild_kpi_rollups()
+        if args.check_kpi_rollups:
+            mismatches = check_kpi_rollups()
+            for (table_name, key, expected, actual) in mismatches:
+                print(f'{table_name} {key}: expected {expected}, found {actual}')
+            print(f'{len(mismatches)} KPI rollup mismatches found')
+        if args.check_query_plans:
+            violations = check_query_plans()
+            for (helper_name, statement, detail) in violations:
+                print(f'{helper_name}: {detail}\n{statement}')
+            print(f'{len(violations)} full table scans found')
+    else:
+        init_db()
     close_connection()
 
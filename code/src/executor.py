@@ -0,0 +1,195 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+# threads running the blocking SQLite / pandas / model / LLM calls of the API
+THREAD_POOL_SIZE = int(os.environ.get('API_THREAD_POOL_SIZE', min(32, (os.cpu_count() or 1) + 4)))
+# processes for CPU-heavy scoring, 0 keeps it on the thread pool
+PROCESS_POOL_SIZE = int(os.environ.get('API_PROCESS_POOL_SIZE', 0))
+
+_thread_pool = None
+_process_pool = None
+_pool_sizes = {'thread': 0, 'process': 0}
+_pools_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+
+def _empty_stats():
+    return {
+        'submitted': 0,
+        'completed': 0,
+        'failed': 0,
+        'cancelled': 0,
+        'queued': 0,
+        'active': 0,
+        'max_queued': 0,
+        'wait_seconds_total': 0.0,
+    }
+
+_stats = {'thread': _empty_stats(), 'process': _empty_stats()}
+
+def init_executors(thread_pool_size:int=None, process_pool_size:int=None):
+    """Starts the worker pools, replacing running ones. Called at startup; the pools are otherwise created on first use.
+
+    Keyword arguments:
+    thread_pool_size -- maximum number of worker threads (default: THREAD_POOL_SIZE)
+    process_pool_size -- number of worker processes for CPU-heavy work, 0 to disable (default: PROCESS_POOL_SIZE)
+    """
+
+    global _thread_pool, _process_pool
+
+    thread_pool_size = thread_pool_size or THREAD_POOL_SIZE
+    process_pool_size = PROCESS_POOL_SIZE if process_pool_size is None else process_pool_size
+    shutdown_executors()
+    with _pools_lock:
+        _thread_pool = ThreadPoolExecutor(max_workers=thread_pool_size, thread_name_prefix='api-worker')
+        _pool_sizes['thread'] = thread_pool_size
+        if process_pool_size > 0:
+            # spawn, as forked children would inherit the parent's SQLite connections
+            _process_pool = ProcessPoolExecutor(max_workers=process_pool_size, mp_context=multiprocessing.get_context('spawn'))
+            _pool_sizes['process'] = process_pool_size
+    logging.info('Executors started with %d threads and %d processes', thread_pool_size, process_pool_size)
+
+def shutdown_executors():
+    """Stops the worker pools after the submitted work has finished
+    """
+
+    global _thread_pool, _process_pool
+
+    with _pools_lock:
+        pools = [_thread_pool, _process_pool]
+        _thread_pool = None
+        _process_pool = None
+        _pool_sizes.update(thread=0, process=0)
+    for pool in pools:
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+def _get_thread_pool():
+    global _thread_pool
+
+    if _thread_pool is None:
+        with _pools_lock:
+            if _thread_pool is None:
+                _thread_pool = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix='api-worker')
+                _pool_sizes['thread'] = THREAD_POOL_SIZE
+    return _thread_pool
+
+def _submitted(stats):
+    with _stats_lock:
+        stats['submitted'] += 1
+        stats['queued'] += 1
+        stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+
+def _finished(stats, failed):
+    with _stats_lock:
+        stats['active'] -= 1
+        stats['completed' if not failed else 'failed'] += 1
+
+def _run_tracked(stats, submitted_at, func):
+    with _stats_lock:
+        stats['queued'] -= 1
+        stats['active'] += 1
+        stats['wait_seconds_total'] += time.perf_counter() - submitted_at
+    failed = True
+    try:
+        result = func()
+        failed = False
+        return result
+    finally:
+        _finished(stats, failed)
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call (SQLite, pandas, model inference, LLM client) on the thread pool,
+    so that the event loop keeps serving other requests meanwhile.
+
+    Keyword arguments:
+    func -- the callable
+    args, kwargs -- its arguments
+    Return: the result of the call
+    """
+
+    stats = _stats['thread']
+    _submitted(stats)
+    call = functools.partial(_run_tracked, stats, time.perf_counter(), functools.partial(func, *args, **kwargs))
+    try:
+        future = _get_thread_pool().submit(call)
+    except RuntimeError:
+        # the pool is shutting down and did not accept the call
+        with _stats_lock:
+            stats['queued'] -= 1
+        raise
+    future.add_done_callback(functools.partial(_cancelled_while_queued, stats))
+    return await asyncio.wrap_future(future)
+
+def _cancelled_while_queued(stats, future):
+    # a call cancelled before a worker picked it up, e.g. when its client disconnected, never runs _run_tracked
+    if future.cancelled():
+        with _stats_lock:
+            stats['queued'] -= 1
+            stats['cancelled'] += 1
+
+async def run_cpu_bound(func, *args, **kwargs):
+    """Runs CPU-heavy work (similarity and model scoring) on the process pool when one is configured,
+    otherwise on the thread pool. func and its arguments must be picklable to use the process pool.
+
+    Keyword arguments:
+    func -- a module level callable
+    args, kwargs -- its arguments
+    Return: the result of the call
+    """
+
+    process_pool = _process_pool
+    if process_pool is None:
+        return await run_blocking(func, *args, **kwargs)
+
+    stats = _stats['process']
+    with _stats_lock:
+        stats['submitted'] += 1
+        _update_process_queue(stats)
+    try:
+        future = process_pool.submit(functools.partial(func, *args, **kwargs))
+    except RuntimeError:
+        # the pool is shutting down or broken and did not accept the call
+        with _stats_lock:
+            stats['submitted'] -= 1
+            _update_process_queue(stats)
+        raise
+    future.add_done_callback(functools.partial(_process_call_done, stats))
+    return await asyncio.wrap_future(future)
+
+def _update_process_queue(stats):
+    # the start of the work is not observable in another process, so the calls in flight beyond the number
+    # of workers are counted as queued. Called with _stats_lock held
+    in_flight = stats['submitted'] - stats['completed'] - stats['failed'] - stats['cancelled']
+    stats['active'] = min(in_flight, _pool_sizes['process'])
+    stats['queued'] = max(0, in_flight - _pool_sizes['process'])
+    stats['max_queued'] = max(stats['max_queued'], stats['queued'])
+
+def _process_call_done(stats, future):
+    # counted when the work ends, not when its awaiting task does, which may have been cancelled meanwhile
+    with _stats_lock:
+        if future.cancelled():
+            stats['cancelled'] += 1
+        elif future.exception() is not None:
+            stats['failed'] += 1
+        else:
+            stats['completed'] += 1
+        _update_process_queue(stats)
+
+def executor_stats():
+    """Queue depth and throughput counters of the worker pools. The process pool does not report when a call
+    starts, so its queued and active counts are derived from the calls in flight and the number of workers,
+    and its wait_seconds_total stays 0.
+
+    Return: dictionary with the pool sizes and the counters of the thread and process pools
+    """
+
+    with _stats_lock:
+        stats = {pool: dict(pool_stats, workers=_pool_sizes[pool]) for (pool, pool_stats) in _stats.items()}
+    return stats
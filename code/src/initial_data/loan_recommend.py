@@ -8,6 +8,12 @@ from sklearn.pipeline import Pipeline
 import tensorflow as tf
 from tensorflow.keras import layers, regularizers, models, optimizers
 import joblib
+import os
+import sys
+
+# the exporter lives with the server code, one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from loan_inference import export_loan_model
 
 pd.set_option('display.max_columns', None)
 
@@ -153,3 +159,9 @@ for layer in model.layers:
     print(f"Layer: {layer.name}")
     print(f"Weights: {weights[0]}")
     print(f"Biases: {weights[1]}")
+
+# ----------------------------
+# 11. Export the Model
+# ----------------------------
+# the API scores loans with NumPy from this export, and serves the slower Keras model while it is stale
+export_loan_model('loan_approval_model.keras', 'preprocessor_loan.joblib', 'loan_approval_model.npz')
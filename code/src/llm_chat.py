@@ -1,13 +1,305 @@
-from google import genai
-from google.genai import errors
+from startup import lazy_import
+import asyncio
+import logging
 import os
+import random
+import sys
+import threading
+
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gemini-2.0-flash')
+# 'gemini' calls the Google API, 'fake' answers locally without network
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'gemini')
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', 60))  # seconds per attempt
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 4))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BACKOFF = float(os.environ.get('LLM_RETRY_BACKOFF', 0.5))  # seconds, doubled after every retry
+
+class LLMError(Exception):
+    """Raised by stream_model when the model fails to answer
+    """
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+# HTTP status codes worth retrying besides the 5xx server errors
+TRANSIENT_ERROR_CODES = {408, 429}
+
+# answer of the fake backend, in the format requested by the insight prompt
+FAKE_INSIGHT = "\n".join([
+    "Action item 1: Restock the most popular products ahead of demand.",
+    "Action item 2: Target promotions at the top spending customer segment.",
+    "Action item 3: Respond to social media feedback in your category.",
+    "",
+    "Question 1: Which products drive repeat purchases?",
+    "Question 2: How does pricing compare to competitors?",
+    "Question 3: Which regions show growing demand?",
+])
+
+class GeminiBackend:
+    """Generates with the Gemini API through a single async client, so that its HTTP connections are reused
+    """
+
+    def __init__(self, model=LLM_MODEL, api_key=None):
+        self.model = model
+        self.api_key = api_key
+        self._client = None
+
+    def _get_client(self):
+        # created on first use, so that importing this module requires neither the Gemini SDK nor GOOGLE_API_KEY
+        if self._client is None:
+            genai = lazy_import('google.genai')
+            self._client = genai.Client(api_key=self.api_key or os.environ["GOOGLE_API_KEY"])
+        return self._client
+
+    async def generate(self, prompt):
+        response = await self._get_client().aio.models.generate_content(
+            model=self.model, contents=prompt.splitlines()
+        )
+        return response.text
+
+    async def generate_stream(self, prompt):
+        stream = await self._get_client().aio.models.generate_content_stream(
+            model=self.model, contents=prompt.splitlines()
+        )
+        async for chunk in stream:
+            if chunk.text:
+                yield chunk.text
+
+class FakeBackend:
+    """Answers every prompt locally, for tests and for running the API without network access
+
+    Keyword arguments:
+    response -- the text returned, or a callable computing it from the prompt (default: FAKE_INSIGHT)
+    delay -- seconds to wait before answering (default: 0)
+    """
+
+    def __init__(self, response=None, delay=0.0):
+        self.response = FAKE_INSIGHT if response is None else response
+        self.delay = delay
+        self.calls = 0
+
+    async def generate(self, prompt):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if callable(self.response):
+            return self.response(prompt)
+        return self.response
+
+    async def generate_stream(self, prompt):
+        # answers line by line, like the chunks of a streamed generation
+        text = await self.generate(prompt)
+        for line in text.splitlines(keepends=True):
+            yield line
+            await asyncio.sleep(0)
+
+LLM_BACKENDS = {
+    'gemini': GeminiBackend,
+    'fake': FakeBackend,
+}
+
+_backend = None
+_loop = None
+_loop_thread = None
+_semaphore = None
+_inflight = {}
+_gateway_lock = threading.Lock()
+_start_lock = threading.Lock()
+
+def set_llm_backend(backend):
+    """Replaces the backend used by prompt_model, e.g. with a FakeBackend in tests
+
+    Keyword arguments:
+    backend -- object with an async generate(prompt) method returning the text and an async generator
+               generate_stream(prompt) yielding it in chunks, or None to use LLM_BACKEND again
+    """
+
+    global _backend
+    _backend = backend
+
+def get_llm_backend():
+    global _backend
+
+    if _backend is None:
+        with _gateway_lock:
+            if _backend is None:
+                _backend = LLM_BACKENDS[LLM_BACKEND]()
+    return _backend
+
+def init_llm_gateway(max_concurrency:int=None):
+    """Starts the event loop thread that runs all LLM calls. Called at startup; the gateway is otherwise started on first use.
+    The calls share one loop so that the async client, the concurrency limit and the in-flight prompts are shared
+    between the API's worker threads.
+
+    Keyword arguments:
+    max_concurrency -- maximum number of concurrent LLM calls (default: LLM_MAX_CONCURRENCY)
+    """
+
+    global _loop, _loop_thread, _semaphore
+
+    shutdown_llm_gateway()
+    with _gateway_lock:
+        _loop = asyncio.new_event_loop()
+        _semaphore = asyncio.Semaphore(max_concurrency or LLM_MAX_CONCURRENCY)
+        _loop_thread = threading.Thread(target=_loop.run_forever, name='llm-gateway', daemon=True)
+        _loop_thread.start()
+    logging.info('LLM gateway started with the %s backend', LLM_BACKEND if _backend is None else type(_backend).__name__)
+
+def shutdown_llm_gateway():
+    """Stops the LLM gateway, cancelling the calls still in flight
+    """
+
+    global _loop, _loop_thread, _semaphore
+
+    with _gateway_lock:
+        loop, thread = _loop, _loop_thread
+        _loop = _loop_thread = _semaphore = None
+    if loop is None:
+        return
+
+    async def cancel_pending():
+        for task in list(_inflight.values()):
+            task.cancel()
+
+    asyncio.run_coroutine_threadsafe(cancel_pending(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    _inflight.clear()
+
+def _get_loop():
+    if _loop is None:
+        with _start_lock:
+            if _loop is None:
+                init_llm_gateway()
+    return _loop
+
+def _api_error_types():
+    # errors of the Gemini SDK, which cannot be raised before it is imported
+    errors = sys.modules.get('google.genai.errors')
+    return (errors.APIError,) if errors is not None else ()
+
+def _is_transient(error):
+    errors = sys.modules['google.genai.errors']
+    return isinstance(error, errors.ServerError) or getattr(error, 'code', None) in TRANSIENT_ERROR_CODES
+
+async def _generate(prompt):
+    backend = get_llm_backend()
+    async with _semaphore:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                text = await asyncio.wait_for(backend.generate(prompt), LLM_TIMEOUT)
+                return True, text
+            except asyncio.TimeoutError:
+                error_message = f'The model did not answer within {LLM_TIMEOUT:g} seconds'
+            except _api_error_types() as e:
+                if not _is_transient(e):
+                    return False, e.message
+                error_message = e.message
+            if attempt < LLM_MAX_RETRIES:
+                # exponential backoff with jitter, so that retries of concurrent calls do not line up
+                delay = LLM_RETRY_BACKOFF * 2 ** attempt * (1 + random.random())
+                logging.warning('LLM call failed (%s), retrying in %.1fs', error_message, delay)
+                await asyncio.sleep(delay)
+    return False, error_message
+
+async def _coalesced_generate(prompt):
+    # identical prompts in flight share one call
+    task = _inflight.get(prompt)
+    if task is None:
+        task = asyncio.ensure_future(_generate(prompt))
+        _inflight[prompt] = task
+        task.add_done_callback(lambda _: _inflight.pop(prompt, None))
+    # a cancelled caller does not cancel the call the other callers are waiting for
+    return await asyncio.shield(task)
+
+async def prompt_model_async(prompt):
+    """Sends a prompt to the LLM without blocking the caller's event loop
+
+    Keyword arguments:
+    prompt -- the prompt text
+    Return: tuple of (generation status, generated text or error message)
+    """
+
+    future = asyncio.run_coroutine_threadsafe(_coalesced_generate(prompt), _get_loop())
+    return await asyncio.wrap_future(future)
 
-client = genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
 def prompt_model(prompt):
+    """Sends a prompt to the LLM, blocking until it answers. Used from the worker threads and the command line.
+
+    Keyword arguments:
+    prompt -- the prompt text
+    Return: tuple of (generation status, generated text or error message)
+    """
+
+    return asyncio.run_coroutine_threadsafe(_coalesced_generate(prompt), _get_loop()).result()
+
+async def _stream(prompt, emit):
+    backend = get_llm_backend()
+    async with _semaphore:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            started = False
+            chunks = backend.generate_stream(prompt)
+            try:
+                # the timeout applies to the wait for every chunk
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), LLM_TIMEOUT)
+                    except StopAsyncIteration:
+                        return
+                    started = True
+                    emit(chunk)
+            except asyncio.TimeoutError:
+                error_message = f'The model did not answer within {LLM_TIMEOUT:g} seconds'
+            except _api_error_types() as e:
+                if not _is_transient(e):
+                    raise LLMError(e.message)
+                error_message = e.message
+            finally:
+                await chunks.aclose()
+            # the caller already received part of the answer, so it cannot be retried
+            if started:
+                raise LLMError(error_message)
+            if attempt < LLM_MAX_RETRIES:
+                delay = LLM_RETRY_BACKOFF * 2 ** attempt * (1 + random.random())
+                logging.warning('LLM call failed (%s), retrying in %.1fs', error_message, delay)
+                await asyncio.sleep(delay)
+    raise LLMError(error_message)
+
+async def stream_model(prompt):
+    """Streams the answer of the LLM to a prompt as it is generated. Streams share the concurrency limit,
+    timeout and retries of prompt_model, but identical prompts are not coalesced.
+
+    Keyword arguments:
+    prompt -- the prompt text
+    Return: async iterator of the text chunks; raises LLMError if the model fails
+    """
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def emit(item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    async def produce():
+        try:
+            await _stream(prompt, emit)
+            emit(done)
+        except BaseException as e:
+            emit(e)
+            raise
+
+    future = asyncio.run_coroutine_threadsafe(produce(), _get_loop())
     try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash", contents=prompt.splitlines()
-        )
-        return True, response.text
-    except errors.APIError as e:
-        return False, e.message
\ No newline at end of file
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # stops the generation when the caller goes away, e.g. a disconnected client
+        future.cancel()
@@ -0,0 +1,165 @@
+import numpy as np
+import argparse
+import hashlib
+
+LOAN_MODEL_NPZ_PATH = 'initial_data/loan_approval_model.npz'
+
+_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+}
+
+class NumpyLoanPreprocessor:
+    """Reproduces the fitted ColumnTransformer of the loan model (standard scaling of the numeric
+    columns followed by one hot encoding of the categorical columns) with plain NumPy.
+    """
+
+    def __init__(self, numeric_columns, mean, scale, categorical_columns, categories):
+        self.numeric_columns = list(numeric_columns)
+        self.mean = mean
+        self.scale = scale
+        self.categorical_columns = list(categorical_columns)
+        self.categories = [np.asarray(values, dtype=object) for values in categories]
+
+        # position of every output feature, so callers can fill in individual columns
+        self.numeric_positions = {column: i for (i, column) in enumerate(self.numeric_columns)}
+        self.category_offsets = {}
+        self.feature_columns = list(self.numeric_columns)
+        offset = len(self.numeric_columns)
+        for (column, values) in zip(self.categorical_columns, self.categories):
+            self.category_offsets[column] = offset
+            self.feature_columns.extend([column] * len(values))
+            offset += len(values)
+        self.n_features = offset
+
+    def transform(self, df):
+        """Transforms a DataFrame with the training columns into the model's dense feature matrix
+        """
+
+        X = np.zeros((len(df), self.n_features), dtype=np.float32)
+        X[:, :len(self.numeric_columns)] = (df[self.numeric_columns].to_numpy(dtype=np.float64) - self.mean) / self.scale
+        for (column, values) in zip(self.categorical_columns, self.categories):
+            # unknown categories are left as all zeros, like handle_unknown='ignore'
+            offset = self.category_offsets[column]
+            X[:, offset:offset + len(values)] = df[column].to_numpy(dtype=object)[:, None] == values[None, :]
+        return X
+
+class NumpyLoanModel:
+    """Dense feed-forward network evaluated as a chain of matrix multiplications
+    """
+
+    def __init__(self, weights, biases, activations):
+        self.weights = weights
+        self.biases = biases
+        self.activations = activations
+
+    def predict(self, X, **kwargs):
+        """Approval probabilities, shaped (n_samples, 1) like keras Model.predict
+        """
+
+        x = np.asarray(X, dtype=np.float32)
+        for (weight, bias, activation) in zip(self.weights, self.biases, self.activations):
+            x = _ACTIVATIONS[activation](x @ weight + bias)
+        return x
+
+def load_numpy_loan_model(path=LOAN_MODEL_NPZ_PATH):
+    """Loads the exported loan model for NumPy inference
+
+    Keyword arguments:
+    path -- path of the .npz written by export_loan_model (default: LOAN_MODEL_NPZ_PATH)
+    Return: tuple of (NumpyLoanModel, NumpyLoanPreprocessor)
+    """
+
+    with np.load(path, allow_pickle=False) as data:
+        n_layers = int(data['n_layers'])
+        model = NumpyLoanModel(
+            [data[f'weight_{i}'] for i in range(n_layers)],
+            [data[f'bias_{i}'] for i in range(n_layers)],
+            [str(activation) for activation in data['activations']],
+        )
+        categorical_columns = [str(column) for column in data['categorical_columns']]
+        preprocessor = NumpyLoanPreprocessor(
+            [str(column) for column in data['numeric_columns']],
+            data['mean'],
+            data['scale'],
+            categorical_columns,
+            [[str(value) for value in data[f'categories_{i}']] for i in range(len(categorical_columns))],
+        )
+    return model, preprocessor
+
+def file_digest(path):
+    """Short SHA-256 digest of a file, used as the version of a model artifact
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+def export_digests(path=LOAN_MODEL_NPZ_PATH):
+    """Digests of the Keras model and preprocessor an .npz was exported from
+
+    Keyword arguments:
+    path -- path of the .npz (default: LOAN_MODEL_NPZ_PATH)
+    Return: list of the digests, or None if the .npz predates their recording
+    """
+
+    with np.load(path, allow_pickle=False) as data:
+        if 'source_digests' not in data.files:
+            return None
+        return [str(digest) for digest in data['source_digests']]
+
+def export_loan_model(model_path='initial_data/loan_approval_model.keras', preprocessor_path='initial_data/preprocessor_loan.joblib', out_path=LOAN_MODEL_NPZ_PATH):
+    """Dumps the trained Keras model weights and the fitted preprocessor parameters into a compact .npz,
+    so that the server can score loans without importing TensorFlow. Run after every retraining.
+
+    Keyword arguments:
+    model_path -- path of the trained Keras model
+    preprocessor_path -- path of the fitted ColumnTransformer
+    out_path -- path of the .npz to write (default: LOAN_MODEL_NPZ_PATH)
+    """
+
+    from tensorflow.keras.models import load_model
+    import joblib
+
+    model = load_model(model_path)
+    preprocessor = joblib.load(preprocessor_path)
+
+    arrays = {}
+    activations = []
+    for layer in model.layers:
+        weights = layer.get_weights()
+        if not weights:
+            continue
+        arrays[f'weight_{len(activations)}'] = weights[0].astype(np.float32)
+        arrays[f'bias_{len(activations)}'] = weights[1].astype(np.float32)
+        activations.append(layer.get_config()['activation'])
+    arrays['n_layers'] = np.array(len(activations))
+    arrays['activations'] = np.array(activations)
+
+    transformers = {name: (transformer, columns) for (name, transformer, columns) in preprocessor.transformers_}
+    scaler = transformers['num'][0].named_steps['scaler']
+    onehot = transformers['cat'][0].named_steps['onehot']
+    arrays['numeric_columns'] = np.array(transformers['num'][1])
+    arrays['mean'] = scaler.mean_
+    arrays['scale'] = scaler.scale_
+    arrays['categorical_columns'] = np.array(transformers['cat'][1])
+    for (i, values) in enumerate(onehot.categories_):
+        arrays[f'categories_{i}'] = np.array([str(value) for value in values])
+
+    # lets the server tell that the export is out of date after a retraining
+    arrays['source_digests'] = np.array([file_digest(model_path), file_digest(preprocessor_path)])
+
+    np.savez_compressed(out_path, **arrays)
+    print(f'Loan model exported to {out_path}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the trained loan model and preprocessor for NumPy inference.")
+    parser.add_argument("--model", default='initial_data/loan_approval_model.keras', help="Path of the trained Keras model")
+    parser.add_argument("--preprocessor", default='initial_data/preprocessor_loan.joblib', help="Path of the fitted preprocessor")
+    parser.add_argument("--out", default=LOAN_MODEL_NPZ_PATH, help="Path of the .npz to write")
+    args = parser.parse_args()
+
+    export_loan_model(args.model, args.preprocessor, args.out)
@@ -1,20 +1,166 @@
-import tensorflow as tf
-from tensorflow.keras.models import load_model
-from database import get_customer_by_cid, get_last_n_loan_applications_by_cid, get_df_from_table
-import joblib
-import pandas as pd
+from startup import lazy_import
+from database import get_customer_by_cid, get_customers_by_cids, get_sample_cid, get_last_n_loan_applications_by_cid, get_loan_application_summaries, get_df_from_table, get_data_version
+from model_registry import get_loan_model
 import numpy as np
+import logging
+import threading
 
-pd.set_option('display.max_columns', None)
+LOAN_FEATURE_COLUMNS = [
+    'loan_amount', 'interest_rate', 'loan_term_months', 'credit_score', 'annual_income_x',
+    'debt_to_income_ratio', 'age', 'gender', 'annual_income_y', 'education', 'loan_type',
+    'purchase_category', 'min_interest_rate', 'max_interest_rate', 'min_term_months',
+    'max_term_months', 'min_loan_amount', 'max_loan_amount', 'processing_fee',
+    'app_month_sin', 'app_month_cos'
+]
+# model inputs that depend on the customer (or the application date) rather than on the loan product
+CUSTOMER_FEATURE_COLUMNS = [
+    'credit_score', 'annual_income_x', 'debt_to_income_ratio', 'age', 'gender', 'annual_income_y',
+    'education', 'app_month_sin', 'app_month_cos'
+]
+KEEP_COLS_LOAN = ['loan_type', 'purchase_category', 'min_interest_rate', 'max_interest_rate', 'min_term_months', 'max_term_months', 'min_loan_amount', 'max_loan_amount', 'processing_fee']
+
+_loan_product_cache = None
+_loan_product_lock = threading.Lock()
 
 def readable_loan_name(loan_type):
     return " ".join([word.capitalize() for word in loan_type.split('_')]) + " Loan"
 
+def _dense(X):
+    return X.toarray() if hasattr(X, 'toarray') else np.asarray(X)
+
+def _feature_columns(preprocessor):
+    """Input column each output feature of the preprocessor is computed from
+    """
+
+    if hasattr(preprocessor, 'feature_columns'):
+        return preprocessor.feature_columns
+
+    # fitted sklearn ColumnTransformer
+    feature_columns = []
+    for (name, transformer, columns) in preprocessor.transformers_:
+        if name == 'remainder':
+            continue
+        onehot = getattr(transformer, 'named_steps', {}).get('onehot')
+        if onehot is None:
+            feature_columns.extend(columns)
+        else:
+            for (column, values) in zip(columns, onehot.categories_):
+                feature_columns.extend([column] * len(values))
+    return feature_columns
+
+def build_loan_product_features(preprocessor):
+    """Transforms the loan product columns of every loan product once.
+    The customer columns are filled with placeholders and overwritten per request by customer_loan_features.
+
+    Keyword arguments:
+    preprocessor -- fitted preprocessor of the loan model
+    Return: dictionary with the loan products, the model input frame and the transformed features
+    """
+
+    loan_products = get_df_from_table('loan_products', index_col='loan_product_id')
+
+    frame = loan_products.copy()
+    frame['loan_amount'] = (frame['min_loan_amount'] + frame['max_loan_amount']) / 2
+    frame['interest_rate'] = (frame['min_interest_rate'] + frame['max_interest_rate']) / 2
+    frame['loan_term_months'] = (frame['min_term_months'] + frame['max_term_months']) / 2
+    frame = frame.reindex(columns=LOAN_FEATURE_COLUMNS)
+    frame[CUSTOMER_FEATURE_COLUMNS] = 0.0
+    frame[['gender', 'education']] = ''
+
+    customer_columns = set(CUSTOMER_FEATURE_COLUMNS)
+    return {
+        'loan_products': loan_products,
+        'frame': frame,
+        'features': _dense(preprocessor.transform(frame)),
+        'customer_features': np.array([column in customer_columns for column in _feature_columns(preprocessor)]),
+    }
+
+def get_loan_product_features(loan_model):
+    """Gets the cached loan product features, rebuilding them when loan_products changes or another model is loaded.
+
+    Keyword arguments:
+    loan_model -- registry entry of the served loan model
+    Return: dictionary with the loan products, the model input frame and the transformed features
+    """
+
+    global _loan_product_cache
+
+    key = (get_data_version('loan_products'), loan_model['version'])
+    cache = _loan_product_cache
+    if cache is not None and key[0] is not None and cache['key'] == key:
+        return cache
+
+    with _loan_product_lock:
+        cache = _loan_product_cache
+        if cache is None or key[0] is None or cache['key'] != key:
+            cache = build_loan_product_features(loan_model['preprocessor'])
+            cache['key'] = key
+            _loan_product_cache = cache
+            logging.info('Loan product features built for %d loan products', len(cache['loan_products']))
+    return cache
+
+def customer_loan_features(product_features, preprocessor, customers):
+    """Model inputs of every loan product for a block of customers: the cached product features
+    with the customer columns transformed and filled in.
+
+    Keyword arguments:
+    product_features -- cache returned by get_loan_product_features
+    preprocessor -- fitted preprocessor of the loan model
+    customers -- DataFrame with a column for every entry of CUSTOMER_FEATURE_COLUMNS, one row per customer
+    Return: feature tensor of shape (customers, loan products, features)
+    """
+
+    pd = lazy_import('pandas')
+    frame = product_features['frame']
+    customer_columns = set(CUSTOMER_FEATURE_COLUMNS)
+    rows = pd.DataFrame({
+        column: customers[column].values if column in customer_columns else np.repeat(frame[column].values[:1], len(customers))
+        for column in frame.columns
+    })
+    customer_rows = _dense(preprocessor.transform(rows))
+
+    mask = product_features['customer_features']
+    static = product_features['features']
+    X = np.repeat(static[None, :, :], len(customers), axis=0)
+    X[:, :, mask] = customer_rows[:, None, mask]
+    return X
+
+def _month_encoding():
+    pd = lazy_import('pandas')
+    month = pd.to_datetime('today').month
+    return np.sin(2 * np.pi * month / 12), np.cos(2 * np.pi * month / 12)
+
+def _top_loans(product_features, probabilities, n_recommendations):
+    """Best loans of each customer from a (customers, loan products) matrix of approval probabilities,
+    as one DataFrame with n_recommendations rows per customer in the order of the matrix.
+    """
+
+    pd = lazy_import('pandas')
+    loan_products = product_features['loan_products']
+    probabilities = np.asarray(probabilities).reshape(-1, len(loan_products))
+    n_recommendations = min(n_recommendations, len(loan_products))
+    # stable so that ties keep the loan product order
+    top = np.argsort(-probabilities, axis=1, kind='stable')[:, :n_recommendations]
+
+    positions = top.reshape(-1)
+    recommended_loans = pd.DataFrame({
+        'loan_product_id': loan_products.index.values[positions],
+        'approval_probability': np.take_along_axis(probabilities, top, axis=1).reshape(-1),
+    })
+    for column in KEEP_COLS_LOAN:
+        recommended_loans[column] = loan_products[column].values[positions]
+    readable_names = {loan_type: readable_loan_name(loan_type) for loan_type in loan_products['loan_type'].unique()}
+    recommended_loans['loan_type_readable'] = recommended_loans['loan_type'].map(readable_names)
+
+    return recommended_loans
+
 def recommend_loan(cid:int, n_recommendations:int=6):
     """Generates loan recommendations for a customer based on their loan application history.
     """
-    model = load_model('initial_data/loan_approval_model.keras')
-    preprocessor = joblib.load('initial_data/preprocessor_loan.joblib')
+    pd = lazy_import('pandas')
+    loan_model = get_loan_model()
+    model = loan_model['model']
+    preprocessor = loan_model['preprocessor']
 
     customer = get_customer_by_cid(cid, as_df=True).iloc[0]
     if customer.empty:
@@ -29,59 +175,93 @@ def recommend_loan(cid:int, n_recommendations:int=6):
         debt_to_income = customer_loans['debt_to_income_ratio'].mean()
         credit_score = customer_loans['credit_score'].mean()
 
-    original_loan_products = get_df_from_table('loan_products', index_col='loan_product_id')
-    loan_products = get_df_from_table('loan_products')
-
-    ids = loan_products['loan_product_id']
-    loan_products.drop(columns=['loan_product_id'], inplace=True)
-
-    loan_products['annual_income_x'] = annual_income
-    loan_products['annual_income_y'] = annual_income
-    loan_products['debt_to_income_ratio'] = debt_to_income
-    loan_products['credit_score'] = credit_score
-    loan_products['loan_amount'] = (loan_products['min_loan_amount'] + loan_products['max_loan_amount']) / 2
-    loan_products['interest_rate'] = (loan_products['min_interest_rate'] + loan_products['max_interest_rate']) / 2
-    loan_products['loan_term_months'] = (loan_products['min_term_months'] + loan_products['max_term_months']) / 2
-
-    date = pd.to_datetime('today')
-    month = date.month
-    app_month_sin = np.sin(2 * np.pi * month / 12)
-    app_month_cos = np.cos(2 * np.pi * month / 12)
-    loan_products['app_month_sin'] = app_month_sin
-    loan_products['app_month_cos'] = app_month_cos
-
-    customer_attributes = ['age', 'gender', 'education']
-    loan_products[customer_attributes] = customer[customer_attributes]
-
-    column_order = [
-        'loan_amount', 'interest_rate', 'loan_term_months', 'credit_score', 'annual_income_x',
-        'debt_to_income_ratio', 'age', 'gender', 'annual_income_y', 'education', 'loan_type',
-        'purchase_category', 'min_interest_rate', 'max_interest_rate', 'min_term_months',
-        'max_term_months', 'min_loan_amount', 'max_loan_amount', 'processing_fee',
-        'app_month_sin', 'app_month_cos'
-    ]
-
-    loan_products = loan_products.reindex(columns=column_order)
-
-    print(loan_products.iloc[0])
-    
-    # print(loan_products.columns)
-    X = preprocessor.transform(loan_products)
-    # print(X)
+    app_month_sin, app_month_cos = _month_encoding()
+    customer_values = pd.DataFrame([{
+        'annual_income_x': annual_income,
+        'annual_income_y': annual_income,
+        'debt_to_income_ratio': debt_to_income,
+        'credit_score': credit_score,
+        'age': customer['age'],
+        'gender': customer['gender'],
+        'education': customer['education'],
+        'app_month_sin': app_month_sin,
+        'app_month_cos': app_month_cos,
+    }])
+
+    product_features = get_loan_product_features(loan_model)
+    X = customer_loan_features(product_features, preprocessor, customer_values)[0]
     y_pred = model.predict(X)
-    loan_products['approval_probability'] = y_pred
-    loan_products['loan_product_id'] = ids
-    loan_products = loan_products.sort_values('approval_probability', ascending=False)
 
-    recommended_loans = loan_products[['loan_product_id', 'approval_probability']].head(n_recommendations)
+    return _top_loans(product_features, y_pred, n_recommendations)
+
+def warm_up_loan_model():
+    """Loads the loan model and the loan product features and scores one customer, so that the first request
+    does not pay for them (nor for tracing the TensorFlow graph with the Keras backend). Run by the startup warmup.
+    """
+
+    loan_model = get_loan_model()
+    cid = get_sample_cid()
+    if cid is None:
+        get_loan_product_features(loan_model)
+        return
+    recommend_loan(cid)
+
+def recommend_loans_batch(cids, n_recommendations:int=6, batch_size:int=4096):
+    """Generates loan recommendations for many customers. Profiles and loan application histories are
+    fetched with one query each, and every batch of customers is scored in a single model call.
+    Unknown customers are left out of the result.
+
+    Keyword arguments:
+    cids -- ids of the customers
+    n_recommendations -- number of recommended loans per customer (default: 6)
+    batch_size -- number of customers scored at once (default: 4096)
+    Return: DataFrame of the recommended loans with a cid column, n_recommendations rows per customer
+    """
+
+    pd = lazy_import('pandas')
+    loan_model = get_loan_model()
+    model = loan_model['model']
+    preprocessor = loan_model['preprocessor']
+
+    cids = list(dict.fromkeys(int(cid) for cid in cids))
+    customers = get_customers_by_cids(cids, as_df=True)
+    if customers.empty:
+        return pd.DataFrame(columns=['cid', 'loan_product_id', 'approval_probability'] + KEEP_COLS_LOAN + ['loan_type_readable'])
+    found = set(customers['cid'])
+    customers = customers.set_index('cid').reindex([cid for cid in cids if cid in found])
 
-    keep_cols_loan = ['loan_type', 'purchase_category', 'min_interest_rate', 'max_interest_rate', 'min_term_months', 'max_term_months', 'min_loan_amount', 'max_loan_amount', 'processing_fee']
-    recommended_loans[keep_cols_loan] = original_loan_products[keep_cols_loan].loc[recommended_loans['loan_product_id']].values
-    
-    recommended_loans['loan_type_readable'] = recommended_loans['loan_type'].apply(readable_loan_name)
+    # customers without loan applications get the same defaults as recommend_loan
+    summaries = get_loan_application_summaries(customers.index, n=10, as_df=True)
+    if not summaries.empty:
+        summaries = summaries.set_index('cid').reindex(customers.index)
+    else:
+        summaries = pd.DataFrame(index=customers.index, columns=['debt_to_income_ratio', 'credit_score'], dtype=float)
 
-    return recommended_loans.head(n_recommendations)
+    app_month_sin, app_month_cos = _month_encoding()
+    customer_values = pd.DataFrame({
+        'annual_income_x': customers['annual_income'].values,
+        'annual_income_y': customers['annual_income'].values,
+        'debt_to_income_ratio': summaries['debt_to_income_ratio'].fillna(0.5).values,
+        'credit_score': summaries['credit_score'].fillna(650).values,
+        'age': customers['age'].values,
+        'gender': customers['gender'].values,
+        'education': customers['education'].values,
+        'app_month_sin': app_month_sin,
+        'app_month_cos': app_month_cos,
+    })
 
+    product_features = get_loan_product_features(loan_model)
+    results = []
+    for start in range(0, len(customers), batch_size):
+        batch = customer_values.iloc[start:start + batch_size]
+        X = customer_loan_features(product_features, preprocessor, batch)
+        y_pred = model.predict(X.reshape(-1, X.shape[-1]))
+        recommended_loans = _top_loans(product_features, y_pred, n_recommendations)
+        n_loans = len(recommended_loans) // len(batch)
+        recommended_loans.insert(0, 'cid', np.repeat(customers.index.values[start:start + batch_size], n_loans))
+        results.append(recommended_loans)
+    return pd.concat(results, ignore_index=True)
 
 if(__name__ == '__main__'):
+    lazy_import('pandas').set_option('display.max_columns', None)
     print(recommend_loan(1))
\ No newline at end of file
@@ -1,7 +1,14 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from database import init_connection, close_connection
+from database import init_connection, close_connection, init_data_versions, init_indexes, init_insight_cache, init_kpi_rollups, init_customer_spend_summary, init_product_search
+from recommendations import get_product_similarity_store, warm_up_recommendations
+from loan_recommendation import warm_up_loan_model
+from typeahead import TYPEAHEAD_ENABLED, get_typeahead_index
+from executor import init_executors, shutdown_executors
+from llm_chat import init_llm_gateway, shutdown_llm_gateway
+from startup import preload_imports, startup_stage, startup_report, start_warmup
 from api import router
+import logging
 
 app = FastAPI()
 
@@ -15,10 +22,42 @@ app.add_middleware(
 
 app.include_router(router)
 
+def init_typeahead_index():
+    if TYPEAHEAD_ENABLED:
+        get_typeahead_index()
+
+# run in order at startup, each timed in the startup report
+STARTUP_STAGES = [
+    ('executors', init_executors),
+    ('llm_gateway', init_llm_gateway),
+    ('connection', init_connection),
+    ('indexes', init_indexes),
+    ('data_versions', init_data_versions),
+    ('insight_cache', init_insight_cache),
+    ('kpi_rollups', init_kpi_rollups),
+    ('customer_spend_summary', init_customer_spend_summary),
+    ('product_search', init_product_search),
+]
+
+# run after the startup stages, in background or before serving depending on WARMUP_MODE; /readyz reports their state
+WARMUP_STAGES = [
+    ('imports', preload_imports),
+    ('typeahead', init_typeahead_index),
+    ('product_similarity', get_product_similarity_store),
+    ('recommendations', warm_up_recommendations),
+    ('loan_model', warm_up_loan_model),
+]
+
 @app.on_event("startup")
 async def startup_event():
-    init_connection()
+    for (name, stage) in STARTUP_STAGES:
+        with startup_stage(name):
+            stage()
+    start_warmup(WARMUP_STAGES)
+    logging.info('Startup report: %s', startup_report())
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    shutdown_llm_gateway()
+    shutdown_executors()
     close_connection()
\ No newline at end of file
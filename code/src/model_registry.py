@@ -0,0 +1,157 @@
+from loan_inference import load_numpy_loan_model, export_digests, file_digest, LOAN_MODEL_NPZ_PATH
+from startup import lazy_import
+import datetime
+import logging
+import os
+import threading
+
+LOAN_MODEL_PATH = 'initial_data/loan_approval_model.keras'
+LOAN_PREPROCESSOR_PATH = 'initial_data/preprocessor_loan.joblib'
+
+# artifact files of each inference backend
+LOAN_MODEL_ARTIFACTS = {
+    'numpy': (LOAN_MODEL_NPZ_PATH,),
+    'keras': (LOAN_MODEL_PATH, LOAN_PREPROCESSOR_PATH),
+}
+
+_loan_model = None
+_loan_model_lock = threading.Lock()
+
+def _artifact_signature(paths):
+    """Modification time and size of each artifact file, used to detect that an artifact was replaced
+    """
+
+    signature = []
+    for path in paths:
+        stat = os.stat(path)
+        signature.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+def is_numpy_export_stale(npz_path=None, source_paths=None):
+    """Whether the exported NumPy model no longer matches the Keras model and preprocessor, i.e. they were
+    retrained without running export_loan_model. Compares the digests recorded by the export, or the modification
+    times for an export that predates them. Without the Keras artifacts the export is never stale.
+
+    Keyword arguments:
+    npz_path -- path of the exported model (default: LOAN_MODEL_NPZ_PATH)
+    source_paths -- Keras model and preprocessor (default: LOAN_MODEL_ARTIFACTS['keras'])
+    """
+
+    npz_path = npz_path or LOAN_MODEL_NPZ_PATH
+    source_paths = tuple(source_paths or LOAN_MODEL_ARTIFACTS['keras'])
+    if not all(os.path.exists(path) for path in source_paths):
+        return False
+    digests = export_digests(npz_path)
+    if digests is not None:
+        return digests != [file_digest(path) for path in source_paths]
+    return os.stat(npz_path).st_mtime_ns < max(os.stat(path).st_mtime_ns for path in source_paths)
+
+def default_backend():
+    """Inference backend used when none is given: the LOAN_MODEL_BACKEND environment variable if set,
+    otherwise NumPy when the exported model exists and is up to date (so TensorFlow is never imported) and Keras if not.
+    """
+
+    backend = os.environ.get('LOAN_MODEL_BACKEND')
+    if backend:
+        return backend
+    if not os.path.exists(LOAN_MODEL_NPZ_PATH):
+        return 'keras'
+    if is_numpy_export_stale():
+        logging.warning('%s was not exported from the current Keras model, serving the Keras model until '
+                        '`python loan_inference.py` is run', LOAN_MODEL_NPZ_PATH)
+        return 'keras'
+    return 'numpy'
+
+def _load_keras_model(path):
+    # TensorFlow is only imported when the Keras backend is actually used
+    from tensorflow.keras.models import load_model
+    return load_model(path)
+
+def load_loan_model(backend=None, paths=None):
+    """Loads the loan approval model and its preprocessor from disk and makes them the served model.
+    Called once at startup, and again by get_loan_model whenever the artifact files change.
+
+    Keyword arguments:
+    backend -- 'numpy' or 'keras' (default: default_backend())
+    paths -- artifact files of the backend (default: LOAN_MODEL_ARTIFACTS[backend])
+    Return: dictionary with the model, the preprocessor and their version
+    """
+
+    global _loan_model
+
+    default = backend is None and paths is None
+    backend = backend or default_backend()
+    paths = tuple(paths or LOAN_MODEL_ARTIFACTS[backend])
+    # the export is also reloaded when the Keras artifacts change, so that a retraining is never silently ignored
+    watched = paths
+    if default and backend == 'numpy':
+        watched = paths + tuple(path for path in LOAN_MODEL_ARTIFACTS['keras'] if os.path.exists(path))
+    signature = _artifact_signature(watched)
+    if backend == 'numpy':
+        model, preprocessor = load_numpy_loan_model(paths[0])
+    elif backend == 'keras':
+        model, preprocessor = _load_keras_model(paths[0]), lazy_import('joblib').load(paths[1])
+    else:
+        raise ValueError(f"Unknown loan model backend: {backend}")
+
+    registry_entry = {
+        'model': model,
+        'preprocessor': preprocessor,
+        'backend': backend,
+        'version': '-'.join(file_digest(path) for path in paths),
+        'loaded_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'paths': paths,
+        'watched': watched,
+        'default': default,
+        'signature': signature,
+    }
+
+    _loan_model = registry_entry
+    logging.info('Loan model %s loaded with the %s backend', registry_entry['version'], backend)
+    return registry_entry
+
+def get_loan_model(check_reload=True):
+    """Gets the in-memory loan model and preprocessor, loading them on first use.
+
+    Keyword arguments:
+    check_reload -- reload the artifacts if their files changed since they were loaded (default: True)
+    Return: dictionary with the model, the preprocessor and their version
+    """
+
+    registry_entry = _loan_model
+    if registry_entry is not None and not (check_reload and _artifact_signature(registry_entry['watched']) != registry_entry['signature']):
+        return registry_entry
+
+    with _loan_model_lock:
+        registry_entry = _loan_model
+        if registry_entry is None:
+            registry_entry = load_loan_model()
+        elif _artifact_signature(registry_entry['watched']) != registry_entry['signature']:
+            # keep serving the loaded model if the new artifacts cannot be read (e.g. while they are being copied)
+            try:
+                if registry_entry['default']:
+                    # choose the backend again, e.g. Keras once the export is stale
+                    registry_entry = load_loan_model()
+                else:
+                    registry_entry = load_loan_model(registry_entry['backend'], registry_entry['paths'])
+            except Exception:
+                logging.exception('Reloading the loan model failed, serving version %s', registry_entry['version'])
+                # do not retry until the files change again
+                registry_entry['signature'] = _artifact_signature(registry_entry['watched'])
+    return registry_entry
+
+def loan_model_info():
+    """Describes the loaded loan model
+
+    Return: dictionary with the backend, version, load time and artifact paths, or None if no model is loaded
+    """
+
+    registry_entry = _loan_model
+    if registry_entry is None:
+        return None
+    return {
+        'backend': registry_entry['backend'],
+        'version': registry_entry['version'],
+        'loaded_at': registry_entry['loaded_at'],
+        'paths': list(registry_entry['paths']),
+    }
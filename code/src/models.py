@@ -1,16 +1,56 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+from typing_extensions import TypedDict
 from enum import Enum
-from typing import List
+from typing import Dict, List, Literal, Optional
 
+# the columns other than the ids are nullable in the database, and sent as null
 class Product(BaseModel):
     pid: int
     bid: int
-    product_name: str
-    business_name: str
-    popularity: float
-    price: float
-    geo_demand: str
-    category: str
+    product_name: Optional[str]
+    business_name: Optional[str]
+    popularity: Optional[float]
+    price: Optional[float]
+    geo_demand: Optional[str]
+    category: Optional[str]
+
+# product dictionary built by the services, with the fields of Product. The list endpoints serialize these
+# with the schema directly instead of validating them into Product models first
+ProductRecord = TypedDict('ProductRecord', Product.__annotations__)
+
+class BatchRecommendationRequest(BaseModel):
+    cids: List[int] = Field(..., min_length=1, max_length=10000)
+    n_recommendations: int = Field(5, ge=1, le=100)
+
+class CustomerRecommendations(BaseModel):
+    cid: int
+    products: List[Product]
+
+class CustomerRecommendationsRecord(TypedDict):
+    cid: int
+    products: List[ProductRecord]
+
+class BatchLoanRecommendationRequest(BaseModel):
+    cids: List[int] = Field(..., min_length=1, max_length=100000)
+    n_recommendations: int = Field(6, ge=1, le=20)
+
+class LoanRecommendation(BaseModel):
+    loan_product_id: int
+    approval_probability: float
+    loan_type: str
+    purchase_category: str
+    min_interest_rate: float
+    max_interest_rate: float
+    min_term_months: int
+    max_term_months: int
+    min_loan_amount: float
+    max_loan_amount: float
+    processing_fee: float
+    loan_type_readable: str
+
+class CustomerLoanRecommendations(BaseModel):
+    cid: int
+    loans: List[LoanRecommendation]
 
 class LoginData(BaseModel):
     username: str
@@ -40,6 +80,19 @@ class BusinessInsight(BaseModel):
     action_items: List[str]
     questions: List[str]
 
+class BusinessInsightItem(BaseModel):
+    kind: Literal['action_item', 'question']
+    index: int
+    text: str
+
+class InsightCacheStats(BaseModel):
+    hits: int
+    misses: int
+    refreshes: int
+    entries: int
+    ttl_seconds: float
+    max_entries: int
+
 class ProductRevenue(BaseModel):
     product_name: str
     amount: float
@@ -48,6 +101,40 @@ class PaymentModeRevenue(BaseModel):
     mode: str
     amount: float
 
+class LoanModelInfo(BaseModel):
+    backend: str
+    version: str
+    loaded_at: str
+    paths: List[str]
+
+class PoolStats(BaseModel):
+    workers: int
+    submitted: int
+    completed: int
+    failed: int
+    cancelled: int
+    queued: int
+    active: int
+    max_queued: int
+    wait_seconds_total: float
+
+class ExecutorStats(BaseModel):
+    thread: PoolStats
+    process: PoolStats
+
+class StartupReport(BaseModel):
+    stages: Dict[str, float]
+    imports: Dict[str, float]
+
+class WarmupStatus(BaseModel):
+    state: Literal['pending', 'warming', 'warm', 'failed']
+    seconds: Optional[float]
+    error: Optional[str]
+
+class Readiness(BaseModel):
+    ready: bool
+    subsystems: Dict[str, WarmupStatus]
+
 class BusinessChart(BaseModel):
     products: List[ProductRevenue]
     payment_mode: List[PaymentModeRevenue]
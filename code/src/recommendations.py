@@ -1,9 +1,22 @@
 from database import *
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import StandardScaler
+from startup import lazy_import
 import numpy as np
-import pandas as pd
+import argparse
+import datetime
 import logging
+import os
+import threading
+
+PRODUCT_SIMILARITY_PATH = 'product_similarity.npz'
+PRODUCT_SIMILARITY_FORMAT = 1
+
+# upper bound on the number of similarities held in memory at once when searching similar customers
+NEIGHBOUR_BLOCK_ELEMENTS = 2 ** 24
+
+_product_similarity_store = None
+_product_similarity_lock = threading.Lock()
+_customer_embedding_store = None
+_customer_embedding_lock = threading.Lock()
 
 def product_similarity():
     """Computes the cosine similarity between products based on their features. 
@@ -13,6 +26,10 @@ def product_similarity():
     Return: cosine similarity matrix between products
     """
     
+    pd = lazy_import('pandas')
+    preprocessing = lazy_import('sklearn.preprocessing')
+    pairwise = lazy_import('sklearn.metrics.pairwise')
+
     products = get_df_from_table('products')
     businesses = get_df_from_table('businesses')
 
@@ -23,52 +40,358 @@ def product_similarity():
 
     # Standardize numerical columns
     numerical_cols = ['popularity', 'price', 'revenue', 'num_employees']
-    products[numerical_cols] = StandardScaler().fit_transform(products[numerical_cols])
+    products[numerical_cols] = preprocessing.StandardScaler().fit_transform(products[numerical_cols])
 
-    cosine_sim = cosine_similarity(products.drop(['bid', 'pid', 'product_name', 'business_name', 'geo_demand'], axis=1))
+    cosine_sim = pairwise.cosine_similarity(products.drop(['bid', 'pid', 'product_name', 'business_name', 'geo_demand'], axis=1))
 
     # convert to DataFrame
     product_similarity_df = pd.DataFrame(cosine_sim, index=products.pid, columns=products.pid)
     return product_similarity_df
 
-def customer_similarity(n_transactions:int=None):
-    """Computes the cosine similarity between customers based on their purchase history and profile.
-    Can be run on demand with n_transactions, or on a schedule to update the similarity matrix.
+def product_similarity_version():
+    """Version of the product similarity inputs; a store built from an older version is stale.
+    
+    Return: string combining the store format and the data versions of products and businesses
+    """
+
+    data_version = get_data_version('products', 'businesses')
+    if data_version is None:
+        return None
+    return f'{PRODUCT_SIMILARITY_FORMAT}/{data_version}'
+
+def _make_product_similarity_store(pids, matrix, version, built_at):
+    return {
+        'pids': pids,
+        'matrix': matrix,
+        'positions': {int(pid): i for (i, pid) in enumerate(pids)},
+        'version': version,
+        'built_at': built_at,
+    }
+
+def rebuild_product_similarity_store(path=PRODUCT_SIMILARITY_PATH):
+    """Recomputes the product similarity matrix, persists it to disk and makes it the in-memory store.
+    Run on startup when the store is stale, or explicitly after the products or businesses tables change.
     
     Keyword arguments:
-    n_transactions -- Number of TOTAL transactions to consider (default: entire history)
-    Return: cosine similarity matrix between customers based on last n_transactions transactions in the database
+    path -- file to persist the store to (default: PRODUCT_SIMILARITY_PATH)
+    Return: the new store
+    """
+
+    global _product_similarity_store
+
+    # read the version first so that writes during the build leave the store stale instead of silently fresh
+    version = product_similarity_version()
+    similarity_df = product_similarity()
+    store = _make_product_similarity_store(
+        similarity_df.index.to_numpy(dtype=np.int64),
+        similarity_df.to_numpy(dtype=np.float32),
+        version,
+        datetime.datetime.now().isoformat(timespec='seconds'),
+    )
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, pids=store['pids'], matrix=store['matrix'], version=np.array(version or ''), built_at=np.array(store['built_at']))
+    os.replace(tmp_path, path)
+
+    _product_similarity_store = store
+    logging.info('Product similarity store built for %d products (version %s)', len(store['pids']), version)
+    return store
+
+def load_product_similarity_store(path=PRODUCT_SIMILARITY_PATH):
+    """Loads a persisted product similarity store from disk.
+    
+    Keyword arguments:
+    path -- file the store was persisted to (default: PRODUCT_SIMILARITY_PATH)
+    Return: the store, or None if the file does not exist
+    """
+
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return _make_product_similarity_store(data['pids'], data['matrix'], str(data['version']) or None, str(data['built_at']))
+
+def is_product_similarity_stale(store):
+    """Checks whether a store was built from an older version of the products or businesses tables.
+    Stores built without version tracking are always considered stale.
+    """
+
+    return store['version'] is None or store['version'] != product_similarity_version()
+
+def get_product_similarity_store(check_version=True):
+    """Gets the product similarity store, loading it from disk or building it on first use.
+    
+    Keyword arguments:
+    check_version -- rebuild the store if the products or businesses tables changed since it was built (default: True)
+    Return: dictionary with the pids, the float32 similarity matrix, pid positions, version and build time
     """
+
+    global _product_similarity_store
+
+    store = _product_similarity_store
+    if store is not None and not (check_version and is_product_similarity_stale(store)):
+        return store
+
+    with _product_similarity_lock:
+        store = _product_similarity_store
+        if store is None:
+            store = load_product_similarity_store()
+            _product_similarity_store = store
+        if store is None or (check_version and is_product_similarity_stale(store)):
+            store = rebuild_product_similarity_store()
+    return store
+
+def product_similarity_row(pid:int, store=None):
+    """Gets the similarities of one product to all products from the store.
     
+    Keyword arguments:
+    pid -- id of the product
+    store -- product similarity store (default: the in-memory store)
+    Return: Series of similarities indexed by pid
+    """
+
+    pd = lazy_import('pandas')
+    if store is None:
+        store = get_product_similarity_store()
+    return pd.Series(store['matrix'][store['positions'][int(pid)]], index=store['pids'])
+
+def _customer_embedding_row(store, pos):
+    """Scales and normalizes the raw features of one customer into their embedding row
+    """
+
+    spend_mean = np.divide(store['spend_sum'][pos], store['spend_count'][pos],
+                           out=np.zeros(len(store['categories'])), where=store['spend_count'][pos] > 0)
+    scaled = (np.concatenate([spend_mean, store['profile'][pos]]) - store['mean']) / store['scale']
+    row = np.concatenate([scaled, store['dummies'][pos]])
+    norm = np.linalg.norm(row)
+    return (row / norm if norm > 0 else row).astype(np.float32)
+
+def _window_key(row):
+    # latest purchase first like the build's query, which puts a missing date last
+    return (row[0] if isinstance(row[0], str) else '', row[1])
+
+def build_customer_embedding_store(n_transactions:int=None):
+    """Builds the customer embeddings used for customer similarity: the average spend in each category
+    and the profile (age, income) standardized, plus one hot encoded gender and education.
+    Rows are normalized, so the cosine similarity to every customer is a single matrix-vector product
+    and memory grows linearly with the number of customers.
+    
+    Keyword arguments:
+    n_transactions -- Number of TOTAL transactions to consider (default: entire history)
+    Return: dictionary with the cids, embeddings and the raw features needed for incremental updates
+    """
+
+    pd = lazy_import('pandas')
+    # read the version first so that writes during the build leave the store stale instead of silently fresh
+    transactions_version = get_data_version('transactions')
     # get the data and one hot encode the categorical columns
     customers = get_df_from_table('customers', index_col='cid')
     customers = pd.get_dummies(customers, columns=['gender', 'education'])
 
     transactions = get_df_from_table('transactions', limit=n_transactions, order_by='purchase_date', order='desc')
+    preprocessing = lazy_import('sklearn.preprocessing')
+    pairwise = lazy_import('sklearn.metrics.pairwise')
+
     products = get_df_from_table('products')
     businesses = get_df_from_table('businesses')
-    
-    # merge transactions with products and businesses
+
+    # map every product to the category of its business
     products = products.merge(businesses[['bid', 'category']], on='bid', how='left')
-    products.drop('bid', axis=1, inplace=True)
-    keep_cols_product = ['pid', 'popularity', 'price', 'category']
-    transactions = transactions.merge(products[keep_cols_product], on='pid', how='left')
+    product_categories = products.set_index('pid')['category']
+    categories = sorted(product_categories.dropna().unique())
+    category_positions = {category: i for (i, category) in enumerate(categories)}
 
-    # pivot table to get the amount spent by each customer in each category
-    sim_matrix = transactions.pivot_table(index='cid', columns=['category'], values='amount', fill_value=0)
+    # total spend and number of purchases of each customer in each category, kept so single transactions can be added later
+    transactions = transactions.assign(category=transactions['pid'].map(product_categories))
+    spend = transactions.groupby(['cid', 'category'])['amount'].agg(['sum', 'count'])
+    spend_sum = spend['sum'].unstack(fill_value=0).reindex(index=customers.index, columns=categories, fill_value=0)
+    spend_count = spend['count'].unstack(fill_value=0).reindex(index=customers.index, columns=categories, fill_value=0)
 
-    categorical_features_customers = ['name', 'location', 'occupation']
-    sim_matrix = sim_matrix.reindex(index=customers.index, fill_value=0)
-    sim_matrix = pd.merge(sim_matrix, customers.drop(columns=categorical_features_customers), on='cid', how='left')
+    profile_cols = ['age', 'annual_income']
+    dummy_cols = [col for col in customers.columns if col.startswith('gender_') or col.startswith('education_')]
 
-    # Standardize numerical columns
-    numerical_cols = ['Clothing', 'Dining', 'Education', 'Electronics', 'Entertainment',
-       'Groceries', 'Health', 'Travel', 'age', 'annual_income']
-    sim_matrix[numerical_cols] = StandardScaler().fit_transform(sim_matrix[numerical_cols])
+    store = {
+        'n_transactions': n_transactions,
+        'version': get_data_version('customers', 'products', 'businesses'),
+        # the transactions after last_tid are applied incrementally, see update_customer_embeddings
+        'transactions_version': transactions_version,
+        'last_tid': int(transactions['tid'].max()) if len(transactions) else 0,
+        # (purchase_date, tid, cid, pid, amount) of the rows of a limited window, latest first, which the
+        # incremental updates slide forward so that the store keeps the latest n_transactions rows
+        'window': None if n_transactions is None else sorted(
+            transactions[['purchase_date', 'tid', 'cid', 'pid', 'amount']].itertuples(index=False, name=None),
+            key=_window_key, reverse=True),
+        'cids': customers.index.to_numpy(dtype=np.int64),
+        'positions': {int(cid): i for (i, cid) in enumerate(customers.index)},
+        'categories': categories,
+        'category_positions': category_positions,
+        'pid_categories': {int(pid): category_positions[category] for (pid, category) in product_categories.dropna().items()},
+        'spend_sum': spend_sum.to_numpy(dtype=np.float64),
+        'spend_count': spend_count.to_numpy(dtype=np.float64),
+        'profile': customers[profile_cols].to_numpy(dtype=np.float64),
+        'dummies': customers[dummy_cols].to_numpy(dtype=np.float64),
+    }
+
+    # Standardize the numerical columns (average category spend, age and income)
+    spend_mean = np.divide(store['spend_sum'], store['spend_count'], out=np.zeros_like(store['spend_sum']), where=store['spend_count'] > 0)
+    numerical = np.hstack([spend_mean, store['profile']])
+    store['mean'] = numerical.mean(axis=0)
+    scale = numerical.std(axis=0)
+    store['scale'] = np.where(scale > 0, scale, 1.0)
+
+    embeddings = np.hstack([(numerical - store['mean']) / store['scale'], store['dummies']])
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    store['embeddings'] = np.divide(embeddings, norms, out=np.zeros_like(embeddings), where=norms > 0).astype(np.float32)
+    return store
+
+def get_customer_embedding_store(n_transactions:int=None):
+    """Gets the in-memory customer embedding store, building it on first use, when a different transaction
+    window is requested, or when the customers, products or businesses tables changed.
+    New transactions are applied incrementally instead, including those committed by other processes.
+
+    Keyword arguments:
+    n_transactions -- Number of TOTAL transactions to consider (default: entire history)
+    Return: the store
+    """
+
+    global _customer_embedding_store
+
+    version = get_data_version('customers', 'products', 'businesses')
+    transactions_version = get_data_version('transactions')
+    store = _customer_embedding_store
+    if store is not None and store['n_transactions'] == n_transactions and store['version'] == version \
+            and transactions_version is not None and store['transactions_version'] == transactions_version:
+        return store
+
+    with _customer_embedding_lock:
+        store = _customer_embedding_store
+        if store is None or store['n_transactions'] != n_transactions or store['version'] != version:
+            store = build_customer_embedding_store(n_transactions)
+            _customer_embedding_store = store
+            logging.info('Customer embedding store built for %d customers', len(store['cids']))
+        else:
+            _apply_new_transactions(store)
+    return store
+
+def _apply_new_transactions(store):
+    """Adds the transactions committed after the store's last_tid to its spend and recomputes the affected rows.
+    With a limited window, the rows pushed out of the latest n_transactions by purchase date are removed again,
+    back-dated transactions included. The standardization parameters stay those of the last build until the
+    store is rebuilt.
+    """
+
+    # read the version first, like the build, so that a concurrent insert is picked up by the next call
+    transactions_version = get_data_version('transactions')
+    transactions = execute_and_fetch_rows('''
+    select tid, cid, pid, amount, purchase_date
+    from transactions
+    where tid > ?
+    order by tid
+    ''', params=(store['last_tid'],))
+    if transactions:
+        store['last_tid'] = transactions[-1][0]
+
+    added = [(cid, pid, amount) for (_, cid, pid, amount, _) in transactions]
+    removed = []
+    if store['window'] is not None and transactions:
+        window = store['window'] + [(purchase_date, tid, cid, pid, amount) for (tid, cid, pid, amount, purchase_date) in transactions]
+        window.sort(key=_window_key, reverse=True)
+        store['window'] = window[:store['n_transactions']]
+        removed = [(cid, pid, amount) for (_, _, cid, pid, amount) in window[store['n_transactions']:]]
+
+    updated = set()
+    for (sign, rows) in ((1, added), (-1, removed)):
+        for (cid, pid, amount) in rows:
+            pos = store['positions'].get(int(cid))
+            category_pos = store['pid_categories'].get(int(pid))
+            if pos is None or category_pos is None:
+                if sign > 0:
+                    logging.warning('Transaction for unknown customer %s or product %s is ignored until the next rebuild', cid, pid)
+                continue
+            store['spend_sum'][pos, category_pos] += sign * amount
+            store['spend_count'][pos, category_pos] += sign
+            updated.add(pos)
+    for pos in updated:
+        store['embeddings'][pos] = _customer_embedding_row(store, pos)
+    store['transactions_version'] = transactions_version
+
+def update_customer_embeddings(transactions=None):
+    """Applies new transactions to the customer embedding store, recomputing only the affected customers' rows.
+    The transactions are read from the database after the store's last one, so that a process which did not
+    insert them, e.g. a process pool worker where this listener is never called, catches up the same way through
+    get_customer_embedding_store, and no transaction is counted twice.
+
+    Keyword arguments:
+    transactions -- rows passed by insert_transactions, unused
+    """
+
+    store = _customer_embedding_store
+    if store is None:
+        return
+
+    with _customer_embedding_lock:
+        _apply_new_transactions(store)
 
-    # Compute cosine similarity between customers
-    user_similarity = cosine_similarity(sim_matrix)
-    user_similarity_df = pd.DataFrame(user_similarity, index=sim_matrix.index, columns=sim_matrix.index)
+def similar_customers(cids, k:int, store):
+    """Finds the k most similar customers to each of the given customers, excluding the customer itself.
+    Similarities are computed in blocks of rows, so memory stays linear in the number of customers.
+    
+    Keyword arguments:
+    cids -- ids of the customers
+    k -- number of similar customers
+    store -- customer embedding store
+    Return: tuple of (cids, similarities) arrays of shape (len(cids), k), most similar first
+    """
+
+    embeddings = store['embeddings']
+    positions = np.array([store['positions'][int(cid)] for cid in cids], dtype=np.int64)
+    k = max(0, min(k, len(embeddings) - 1))
+    top_cids = np.empty((len(positions), k), dtype=np.int64)
+    top_similarities = np.empty((len(positions), k), dtype=np.float32)
+    if k == 0:
+        return top_cids, top_similarities
+
+    block_size = max(1, NEIGHBOUR_BLOCK_ELEMENTS // len(embeddings))
+    for start in range(0, len(positions), block_size):
+        block = positions[start:start + block_size]
+        similarities = embeddings[block] @ embeddings.T
+        similarities[np.arange(len(block)), block] = -np.inf
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        top_values = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_values, axis=1, kind='stable')
+        top_cids[start:start + len(block)] = store['cids'][np.take_along_axis(top, order, axis=1)]
+        top_similarities[start:start + len(block)] = np.take_along_axis(top_values, order, axis=1)
+    return top_cids, top_similarities
+
+def top_k_similar_customers(cid:int, k:int, store=None):
+    """Finds the k most similar customers to a customer by computing a single row of similarities.
+    
+    Keyword arguments:
+    cid -- id of the customer
+    k -- number of similar customers
+    store -- customer embedding store (default: the in-memory store over the entire history)
+    Return: tuple of (cids, similarities) arrays, most similar first
+    """
+
+    if store is None:
+        store = get_customer_embedding_store()
+    top_cids, top_similarities = similar_customers([cid], k, store)
+    return top_cids[0], top_similarities[0]
+
+def customer_similarity(n_transactions:int=None):
+    """Computes the cosine similarity between customers based on their purchase history and profile.
+    Builds the dense N x N matrix, so it is meant for offline analysis; recommendations use
+    top_k_similar_customers on the customer embedding store instead.
+    
+    Keyword arguments:
+    n_transactions -- Number of TOTAL transactions to consider (default: entire history)
+    Return: cosine similarity matrix between customers based on last n_transactions transactions in the database
+    """
+
+    pd = lazy_import('pandas')
+    store = build_customer_embedding_store(n_transactions)
+    user_similarity = store['embeddings'] @ store['embeddings'].T
+    user_similarity_df = pd.DataFrame(user_similarity, index=pd.Index(store['cids'], name='cid'), columns=pd.Index(store['cids'], name='cid'))
     return user_similarity_df
 
 def sentiment_scores(n:int=None):
@@ -82,6 +405,103 @@ def sentiment_scores(n:int=None):
     avg_recent_sentiment = get_avg_recent_sentiment(n, as_df=True)
     return avg_recent_sentiment
 
+def _top_similar_products(store, k:int):
+    """Sparse matrix keeping, for every product, the similarities to its k most similar other products.
+    Cached on the store, so it is computed once per build and value of k.
+    """
+
+    cache = store.setdefault('top_similar_products', {})
+    if k not in cache:
+        matrix = store['matrix']
+        n_products = len(matrix)
+        k = max(0, min(k, n_products - 1))
+        candidates = matrix.copy()
+        np.fill_diagonal(candidates, -np.inf)
+        top = np.argpartition(-candidates, k - 1, axis=1)[:, :k] if k > 0 else np.empty((n_products, 0), dtype=np.int64)
+        values = np.take_along_axis(matrix, top, axis=1)
+        sparse = lazy_import('scipy.sparse')
+        cache[k] = sparse.csr_matrix((values.ravel(), (np.repeat(np.arange(n_products), k), top.ravel())), shape=(n_products, n_products))
+    return cache[k]
+
+def _purchase_indicator(transactions, cids, pid_positions, n_products):
+    """Matrix with a 1 for every product (column) each customer (row, in the order of the sorted cids) bought
+    """
+
+    indicator = np.zeros((len(cids), n_products), dtype=np.float32)
+    cols = transactions['pid'].map(pid_positions)
+    known = cols.notna().to_numpy()
+    rows = np.searchsorted(cids, transactions['cid'].to_numpy()[known])
+    indicator[rows, cols[known].to_numpy(dtype=np.int64)] = 1.0
+    return indicator
+
+def score_products(cids, n_transactions:int=10, n_transactions_customer:int=10000, n_customers:int=5, n_similar_products:int=5, n_posts:int=1000, product_weight:float=0.5, customer_weight:float=0.5, sentiment_weight:float=0.3, repeat_prob:float=0.3):
+    """Scores every product for a batch of customers based on their purchase history, similar customers, and category sentiment scores.
+    The scores for all customers are computed at once with array operations over the products of the similarity store.
+    
+    Keyword arguments:
+    cids -- ids of the customers
+    (see get_product_recommendations for the other arguments)
+
+    Return: tuple of (products DataFrame indexed by pid, scores array of shape (len(cids), len(products)))
+    """
+
+    products_df = get_df_from_table('products')
+    businesses_df = get_df_from_table('businesses')
+    products_df = products_df.merge(businesses_df[['bid', 'category', 'business_name']], on='bid', how='left')
+    products_df.set_index('pid', inplace=True)
+
+    # score columns follow the order of the product similarity store
+    similarity_store = get_product_similarity_store()
+    products_df = products_df.reindex(similarity_store['pids'])
+    n_products = len(products_df)
+
+    cids = np.asarray(cids, dtype=np.int64)
+    customer_store = get_customer_embedding_store(n_transactions=n_transactions_customer)
+    similar_cids, customer_scores = similar_customers(cids, n_customers, customer_store)
+
+    # recent purchases of the customers and of their similar customers, in a single query
+    involved_cids = np.unique(np.concatenate([cids, similar_cids.ravel()]))
+    recent_transactions = get_last_n_transactions_for_customers(involved_cids, n=n_transactions, as_df=True)
+    purchased = _purchase_indicator(recent_transactions, involved_cids, similarity_store['positions'], n_products)
+    bought = purchased[np.searchsorted(involved_cids, cids)]
+
+    # increase score for similar products
+    scores = product_weight * np.asarray(bought @ _top_similar_products(similarity_store, n_similar_products))
+
+    # increase score for products bought by similar customers in the same amount of transactions
+    n_similar = similar_cids.shape[1]
+    sparse = lazy_import('scipy.sparse')
+    customer_weights = sparse.csr_matrix(
+        (customer_scores.ravel(), (np.repeat(np.arange(len(cids)), n_similar), np.searchsorted(involved_cids, similar_cids.ravel()))),
+        shape=(len(cids), len(involved_cids)))
+    scores += customer_weight * np.asarray(customer_weights @ purchased)
+
+    # increase score for products belonging to categories with high sentiment scores
+    category_sentiment = sentiment_scores(n=n_posts)['avg_sentiment']
+    scores += sentiment_weight * products_df['category'].map(category_sentiment).fillna(0).to_numpy(dtype=np.float64)
+
+    # randomly decrease score for repeat products with probability 1 - repeat_prob
+    repeats = (bought > 0) & (np.random.rand(*bought.shape) > repeat_prob)
+    scores[repeats] *= 0.2 # penalise repeat purchases
+
+    return products_df, scores
+
+def top_recommendations(products_df, scores, n_recommendations:int=5):
+    """Selects the highest scoring products for one customer.
+    
+    Keyword arguments:
+    products_df -- products DataFrame indexed by pid, as returned by score_products
+    scores -- scores of the customer for each product
+    n_recommendations -- number of recommendations (default: 5)
+    Return: DataFrame of the recommended products with their score
+    """
+
+    top = np.argsort(-scores, kind='stable')[:n_recommendations]
+    recommendations = products_df.iloc[top].copy()
+    recommendations['score'] = scores[top]
+    recommendations['pid'] = recommendations.index
+    return recommendations.reset_index(drop=True)
+
 def get_product_recommendations(cid:int, n_transactions:int=10, n_transactions_customer:int=10000, n_customers:int=5, n_similar_products:int=5, n_posts:int=1000, n_recommendations:int=5, product_weight:float=0.5, customer_weight:float=0.5, sentiment_weight:float=0.3, repeat_prob:float=0.3):
     """Generates product recommendations for a customer based on their purchase history, similar customers, and category sentiment scores.
     
@@ -98,58 +518,100 @@ def get_product_recommendations(cid:int, n_transactions:int=10, n_transactions_c
     sentiment_weight -- weight for category sentiment scores (default: 0.3)
     repeat_prob -- probability of keeping repeat purchases (default: 0.3)
 
-    Return: return_description
+    Return: DataFrame of the recommended products with their score
     """
     
-    products_df = get_df_from_table('products')
-    businesses_df = get_df_from_table('businesses')
-    products_df = products_df.merge(businesses_df[['bid', 'category']], on='bid', how='left')
-    products_df.set_index('pid', inplace=True)
+    products_df, scores = score_products(
+        [cid], n_transactions=n_transactions, n_transactions_customer=n_transactions_customer, n_customers=n_customers,
+        n_similar_products=n_similar_products, n_posts=n_posts, product_weight=product_weight,
+        customer_weight=customer_weight, sentiment_weight=sentiment_weight, repeat_prob=repeat_prob)
+    return top_recommendations(products_df, scores[0], n_recommendations)
+
+def warm_up_recommendations():
+    """Builds the product similarity store, the customer embedding store and the caches of the scoring by
+    recommending products to one customer, so that the first request does not pay for them. Run by the startup warmup.
+    """
+
+    cid = get_sample_cid()
+    if cid is None:
+        # no customer to recommend for yet
+        get_product_similarity_store()
+        return
+    get_product_recommendations(cid)
+
+def get_batch_recommendations(cids, n_recommendations:int=5, batch_size:int=1024, **scoring_args):
+    """Generates product recommendations for many customers, scoring them in batches.
     
-    recent_transactions = get_last_n_transactions_for_customer(cid, n=n_transactions, as_df=True)
-    unique_pids = recent_transactions["pid"].unique()
+    Keyword arguments:
+    cids -- ids of the customers
+    n_recommendations -- number of recommendations per customer (default: 5)
+    batch_size -- number of customers scored at once (default: 1024)
+    scoring_args -- other arguments of get_product_recommendations
+    Return: dictionary of DataFrames of the recommended products for each cid
+    """
 
-    products_df['score'] = 0.0
+    cids = list(dict.fromkeys(int(cid) for cid in cids))
+    results = {}
+    for start in range(0, len(cids), batch_size):
+        batch = cids[start:start + batch_size]
+        products_df, scores = score_products(batch, **scoring_args)
+        for (cid, customer_scores) in zip(batch, scores):
+            results[cid] = top_recommendations(products_df, customer_scores, n_recommendations)
+    return results
 
-    # increase score for similar products
-    product_similarity_df = product_similarity()
-    for pid in unique_pids:
-        similar_products = product_similarity_df[pid].sort_values(ascending=False)[1:1+n_similar_products].index
-        for similar_pid in similar_products:
-            score = product_similarity_df[pid][similar_pid]
-            products_df.loc[similar_pid, 'score'] += score * product_weight
+def precompute_recommendations(cids=None, n_recommendations:int=5, batch_size:int=1024, **scoring_args):
+    """Offline job computing the top recommendations of every customer into the recommendations table,
+    so that /recommend can serve them without scoring.
     
-    last_n = get_last_n_transactions_for_all_customers(n=n_transactions, as_df=True)
+    Keyword arguments:
+    cids -- ids of the customers (default: all customers)
+    n_recommendations -- number of recommendations per customer (default: 5)
+    batch_size -- number of customers scored and written at once (default: 1024)
+    scoring_args -- other arguments of get_product_recommendations
+    Return: number of customers processed
+    """
 
-    # increase score for products bought by similar customers in the same amount of transactions
-    user_similarity_df = customer_similarity(n_transactions=n_transactions_customer)
-    similar_customers = user_similarity_df[cid].sort_values(ascending=False)[1:1+n_customers].index
-    for similar_cid in similar_customers:
-        similar_transactions = last_n[similar_cid]
-        for pid in similar_transactions['pid'].unique():
-            score = product_similarity_df[pid][similar_pid]
-            products_df.loc[pid, 'score'] += score * customer_weight
+    if cids is None:
+        cids = [row[0] for row in execute_and_fetch_rows('select cid from customers order by cid')]
+    cids = np.asarray(cids, dtype=np.int64)
+    generated_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    init_recommendations()
 
-    # increase score for products belonging to categories with high sentiment scores
-    sentiment_scores_df = sentiment_scores(n=n_posts)
-    for category, row in sentiment_scores_df.iterrows():
-        products_df.loc[products_df['category'] == category, 'score'] += row['avg_sentiment'] * sentiment_weight
+    start_time = datetime.datetime.now()
+    for start in range(0, len(cids), batch_size):
+        batch = cids[start:start + batch_size]
+        products_df, scores = score_products(batch, **scoring_args)
+        top = np.argsort(-scores, axis=1, kind='stable')[:, :n_recommendations]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        top_pids = products_df.index.to_numpy()[top]
+        rows = [
+            (int(cid), rank + 1, int(pid), float(score), generated_at)
+            for (cid, pids, customer_scores) in zip(batch, top_pids, top_scores)
+            for (rank, (pid, score)) in enumerate(zip(pids, customer_scores))
+        ]
+        save_recommendations(rows, batch)
+        logging.info('Precomputed recommendations for %d/%d customers', min(start + batch_size, len(cids)), len(cids))
 
-    # randomly decrease score for repeat products with probability 1 - repeat_prob
-    for pid in unique_pids:
-        if np.random.rand() > repeat_prob:
-            products_df.loc[pid, 'score'] *= 0.2 # penalise repeat purchases
+    elapsed = (datetime.datetime.now() - start_time).total_seconds()
+    print(f'Precomputed recommendations for {len(cids)} customers in {elapsed:.1f}s')
+    return len(cids)
 
-    # get top n recommendations
-    recommendations = products_df.sort_values(by='score', ascending=False)[:n_recommendations]
-    recommendations['pid'] = recommendations.index
-    recommendations = recommendations.merge(businesses_df[['bid', 'business_name']], on='bid', how='left')
-    return recommendations
+add_transaction_listener(update_customer_embeddings)
 
 if __name__ == '__main__':
-    cid = int(input("Enter the customer id: "))
-    recommendations = get_product_recommendations(cid)
-    print(recommendations)
+    parser = argparse.ArgumentParser(description="Generate product recommendations for a customer, or precompute them for all customers.")
+    parser.add_argument("--cid", type=int, help="Customer ID (prompted for if not given)")
+    parser.add_argument("--precompute", action="store_true", help="Precompute recommendations for all customers into the recommendations table")
+    parser.add_argument("--n_recommendations", type=int, default=5, help="Number of recommendations per customer")
+    parser.add_argument("--batch_size", type=int, default=1024, help="Number of customers scored at once when precomputing")
+    args = parser.parse_args()
+
+    if args.precompute:
+        precompute_recommendations(n_recommendations=args.n_recommendations, batch_size=args.batch_size)
+    else:
+        cid = args.cid if args.cid is not None else int(input("Enter the customer id: "))
+        recommendations = get_product_recommendations(cid, n_recommendations=args.n_recommendations)
+        print(recommendations)
     close_connection()
 
 
@@ -1,11 +1,16 @@
-from database import search_products_by_name, validate_user, get_product_revenue_info, get_payment_mode_revenue_info
-from models import LoginData, UserType, BusinessInsight, ProductRevenue, PaymentModeRevenue, BusinessChart
+from database import SEARCH_RESULT_LIMIT, search_products_by_name, validate_user, get_product_revenue_info, get_payment_mode_revenue_info
+from models import LoginData, UserType, BusinessInsight, BusinessInsightItem, ProductRevenue, PaymentModeRevenue, BusinessChart, InsightCacheStats
 from fastapi import HTTPException
-from business_insightgen import generate_insights
+from business_insightgen import generate_insights_async, stream_insights, insight_cache_stats
+from llm_chat import LLMError
+from typeahead import TYPEAHEAD_ENABLED, search_typeahead
+import json
 
-def search_products_service(query: str):
-    results = search_products_by_name(query, as_df=True)
-    return results.to_dict('records')
+def search_products_service(query: str, limit: int = SEARCH_RESULT_LIMIT):
+    # the search box queries on every keystroke, so it is answered from memory when the typeahead index is enabled
+    if TYPEAHEAD_ENABLED:
+        return search_typeahead(query, limit)
+    return search_products_by_name(query, limit=limit, as_dict=True)
 
 def authenticate_user_service(login_data: LoginData):
     is_valid_username = len(login_data.username) > 1 and (login_data.username.startswith('c') or login_data.username.startswith('b')) and login_data.username[1:].isdigit() and not login_data.username[1:].startswith('0')
@@ -17,8 +22,8 @@ def authenticate_user_service(login_data: LoginData):
     else:
         return False, None
 
-def get_business_insight(bid: int):
-    generation_status, result = generate_insights(bid)
+async def get_business_insight(bid: int, force_refresh: bool = False):
+    generation_status, result = await generate_insights_async(bid, force_refresh=force_refresh)
     if not generation_status:
         raise HTTPException(status_code=503, detail=result)
     insights_list = result.split('\n')
@@ -27,6 +32,38 @@ def get_business_insight(bid: int):
     else:
         return BusinessInsight(action_items=insights_list[:3],questions=insights_list[4:7])
     
+def _sse_event(event: str, data: str):
+    return f"event: {event}\ndata: {data}\n\n"
+
+async def stream_business_insight(bid: int, force_refresh: bool = False):
+    """Server-sent events of a business insight: an 'item' event per action item and question as soon as the model
+    writes it, then 'done', or 'error' with the detail if the insight cannot be generated.
+    The lines are picked like in get_business_insight.
+    """
+
+    n_lines = 0
+    try:
+        async for line in stream_insights(bid, force_refresh=force_refresh):
+            if n_lines < 3:
+                item = BusinessInsightItem(kind='action_item', index=n_lines, text=line)
+            elif 4 <= n_lines < 7:
+                item = BusinessInsightItem(kind='question', index=n_lines - 4, text=line)
+            else:
+                item = None
+            n_lines += 1
+            if item is not None:
+                yield _sse_event('item', item.model_dump_json())
+    except LLMError as e:
+        yield _sse_event('error', json.dumps({'detail': e.message}))
+        return
+    if n_lines < 7:
+        yield _sse_event('error', json.dumps({'detail': "Service is not available. Please try again later."}))
+    else:
+        yield _sse_event('done', '{}')
+
+def get_insight_cache_stats():
+    return InsightCacheStats(**insight_cache_stats())
+
 def get_business_kpi(bid: int):
     product_revenue_data = get_product_revenue_info(bid)
     product_revenue_list = [ProductRevenue(product_name=row[0], amount=row[1]) for row in product_revenue_data]
@@ -0,0 +1,223 @@
+import argparse
+import contextlib
+import importlib
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+# heavy third-party modules of each subsystem. They are imported on first use, so that a worker serving
+# only search and login never pays for them, or at startup for the subsystems listed in PRELOAD_IMPORTS
+HEAVY_IMPORTS = {
+    'data': ('pandas',),
+    'recommendations': ('scipy.sparse', 'sklearn.metrics.pairwise', 'sklearn.preprocessing'),
+    'llm': ('google.genai',),
+}
+# comma separated names of HEAVY_IMPORTS to import by the 'imports' warmup stage, or 'all'. The default covers
+# the subsystems of the other warmup stages; the LLM client stays lazy since no stage uses it
+PRELOAD_IMPORTS = os.environ.get('PRELOAD_IMPORTS', 'data,recommendations')
+# 'background' warms the subsystems up on a thread after startup, 'startup' before the API accepts requests, 'off' never.
+# Warming up undoes the lazy imports: every worker loads the loan model, the heavy modules, the product similarity
+# matrix and the embedding store right away and keeps them in memory, and competes for the CPU with the requests it
+# already serves, even if it only ever serves search and login. Use 'off' on such workers, or to trade a slower first
+# recommendation for less memory
+WARMUP_MODE = os.environ.get('WARMUP_MODE', 'background')
+# comma separated names of the warmup stages to run, or 'all'
+WARMUP_STAGES = os.environ.get('WARMUP_STAGES', 'all')
+
+_startup_times = {'stages': {}, 'imports': {}}
+_startup_lock = threading.Lock()
+# state of every warmup stage: 'pending', 'warming', 'warm' or 'failed'
+_warmup_state = {}
+_warmup_started = False
+
+def lazy_import(name):
+    """Imports a heavy module on first use, recording how long the import took
+
+    Keyword arguments:
+    name -- full name of the module, e.g. 'sklearn.preprocessing'
+    Return: the module
+    """
+
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    seconds = time.perf_counter() - start
+    with _startup_lock:
+        _startup_times['imports'].setdefault(name, seconds)
+    logging.info('Imported %s in %.2fs', name, seconds)
+    return module
+
+def preload_imports(subsystems=None):
+    """Imports the heavy modules of subsystems ahead of their first use
+
+    Keyword arguments:
+    subsystems -- names of HEAVY_IMPORTS, or 'all' (default: PRELOAD_IMPORTS)
+    Return: list of the imported module names
+    """
+
+    if subsystems is None:
+        subsystems = [name.strip() for name in PRELOAD_IMPORTS.split(',') if name.strip()]
+    if subsystems == 'all' or 'all' in subsystems:
+        subsystems = list(HEAVY_IMPORTS)
+
+    modules = []
+    for subsystem in subsystems:
+        if subsystem not in HEAVY_IMPORTS:
+            raise ValueError(f"Unknown subsystem to preload: {subsystem}")
+        for name in HEAVY_IMPORTS[subsystem]:
+            lazy_import(name)
+            modules.append(name)
+    return modules
+
+@contextlib.contextmanager
+def startup_stage(name):
+    """Times a stage of the API startup for startup_report
+
+    Keyword arguments:
+    name -- name of the stage
+    """
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _startup_lock:
+            _startup_times['stages'][name] = seconds
+        logging.info('Startup stage %s took %.2fs', name, seconds)
+
+def startup_report():
+    """Durations of the startup stages and of the heavy imports done so far
+
+    Return: dictionary with the seconds of each stage and of each lazily imported module
+    """
+
+    with _startup_lock:
+        return {kind: dict(times) for (kind, times) in _startup_times.items()}
+
+def _selected_stages(stages, names):
+    if names is None:
+        names = [name.strip() for name in WARMUP_STAGES.split(',') if name.strip()]
+    if names == 'all' or 'all' in names:
+        return list(stages)
+    known = dict(stages)
+    for name in names:
+        if name not in known:
+            raise ValueError(f"Unknown warmup stage: {name}")
+    return [(name, func) for (name, func) in stages if name in names]
+
+def _set_warmup_state(name, state, seconds=None, error=None):
+    with _startup_lock:
+        _warmup_state[name] = {'state': state, 'seconds': seconds, 'error': error}
+
+def run_warmup(stages):
+    """Runs warmup stages one after the other. A failed stage is logged and reported by readiness,
+    the following stages still run.
+
+    Keyword arguments:
+    stages -- list of (name, function) of the stages
+    """
+
+    for (name, func) in stages:
+        _set_warmup_state(name, 'warming')
+        start = time.perf_counter()
+        try:
+            with startup_stage(f'warmup.{name}'):
+                func()
+        except Exception as e:
+            logging.exception('Warmup stage %s failed', name)
+            _set_warmup_state(name, 'failed', time.perf_counter() - start, str(e))
+        else:
+            _set_warmup_state(name, 'warm', time.perf_counter() - start)
+
+def start_warmup(stages, names=None, mode=None):
+    """Warms up the subsystems, e.g. loads the models and builds the similarity structures, so that the
+    first requests do not pay for them. Called at startup; readiness reports the progress.
+
+    Keyword arguments:
+    stages -- list of (name, function) of all the warmup stages
+    names -- names of the stages to run, or 'all' (default: WARMUP_STAGES)
+    mode -- 'background', 'startup' or 'off' (default: WARMUP_MODE)
+    Return: the thread running the warmup in background mode, else None
+    """
+
+    global _warmup_started
+
+    mode = mode or WARMUP_MODE
+    if mode not in ('background', 'startup', 'off'):
+        raise ValueError(f"Unknown warmup mode: {mode}")
+    stages = _selected_stages(stages, names) if mode != 'off' else []
+    with _startup_lock:
+        _warmup_state.clear()
+        for (name, _) in stages:
+            _warmup_state[name] = {'state': 'pending', 'seconds': None, 'error': None}
+        _warmup_started = True
+
+    if mode == 'background':
+        thread = threading.Thread(target=run_warmup, args=(stages,), name='warmup', daemon=True)
+        thread.start()
+        return thread
+    run_warmup(stages)
+    return None
+
+def readiness():
+    """Whether the API is ready to serve traffic, i.e. it started and every warmup stage is warm
+
+    Return: dictionary with the readiness and the state of every warmup stage
+    """
+
+    with _startup_lock:
+        subsystems = {name: dict(state) for (name, state) in _warmup_state.items()}
+        started = _warmup_started
+    ready = started and all(state['state'] == 'warm' for state in subsystems.values())
+    return {'ready': ready, 'subsystems': subsystems}
+
+def module_import_times(module='main', python=sys.executable):
+    """Measures the cold import of a module in a fresh interpreter with -X importtime
+
+    Keyword arguments:
+    module -- module to import (default: 'main')
+    python -- interpreter to run (default: the current one)
+    Return: list of (module name, cumulative seconds) of the module and of the modules it imports directly, slowest first
+    """
+
+    result = subprocess.run([python, '-X', 'importtime', '-c', f'import {module}'], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    # the imports are listed after the modules they import, which are indented one level deeper
+    times = {}
+    children = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)', line)
+        if match is None:
+            continue
+        (seconds, depth, name) = (int(match.group(1)) / 1e6, len(match.group(2)) // 2, match.group(3))
+        if depth == 1:
+            children[name] = seconds
+        elif depth == 0:
+            # imports of the interpreter startup (site and .pth files) are not part of the module
+            if name == module:
+                times = dict(children, **{name: seconds})
+            children = {}
+    return sorted(times.items(), key=lambda item: item[1], reverse=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report the cold import time of the API modules.")
+    parser.add_argument("--module", default='main', help="Module to import")
+    parser.add_argument("--top", type=int, default=20, help="Number of modules to report")
+    args = parser.parse_args()
+
+    import_times = dict(module_import_times(args.module))
+    total = import_times.pop(args.module)
+    for (name, seconds) in list(import_times.items())[:args.top]:
+        print(f'{name:40s} {seconds:7.3f}s')
+    print(f"{'total':40s} {total:7.3f}s")
@@ -1,9 +1,15 @@
 from fastapi.testclient import TestClient
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, AsyncMock, patch
 import pytest
-from fastapi import HTTPException
+from fastapi import FastAPI, HTTPException
+from fastapi.exceptions import RequestValidationError
 import pandas as pd
+import datetime
+import threading
+from typing import List
+from models import Product
 from api import router
+import startup
 
 client = TestClient(router)
 
@@ -46,6 +52,50 @@ def test_search_products():
         response = client.get("/search_products?query=smart")
         assert response.status_code == 200
         assert response.json() == expected_result
+        mock_search_products_service.assert_called_with("smart", limit=50)
+
+def test_search_products_serializes_records_with_product_schema():
+    record = {"pid": 9, "bid": 9, "product_name": "Smartphone", "business_name": "Gallagher PLC", "popularity": 7,
+              "price": 1344.77, "geo_demand": "Josephtown", "category": "Electronics"}
+    with patch('api.search_products_service', Mock(return_value=[{**record, "score": 0.5}])):
+        response = client.get("/search_products?query=smart")
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/json'
+    # only the fields of Product are sent, with their declared types
+    assert response.content == b'[{"pid":9,"bid":9,"product_name":"Smartphone","business_name":"Gallagher PLC","popularity":7.0,"price":1344.77,"geo_demand":"Josephtown","category":"Electronics"}]'
+
+def test_search_products_serializes_null_fields_like_the_response_model():
+    record = {"pid": 9, "bid": 9, "product_name": "Smartphone", "business_name": "Gallagher PLC", "popularity": None,
+              "price": 1344.77, "geo_demand": None, "category": "Electronics"}
+    app = FastAPI()
+
+    @app.get("/validated", response_model=List[Product])
+    async def validated():
+        return [record]
+
+    with patch('api.search_products_service', Mock(return_value=[record])):
+        response = client.get("/search_products?query=smart")
+    validated_response = TestClient(app).get("/validated")
+
+    assert validated_response.status_code == 200
+    assert response.content == validated_response.content
+    assert response.json()[0]['popularity'] is None
+
+def test_list_endpoints_document_their_response_models():
+    app = FastAPI()
+    app.include_router(router)
+    paths = app.openapi()['paths']
+    assert paths['/search_products']['get']['responses']['200']['content']['application/json']['schema']['items'] == {'$ref': '#/components/schemas/Product'}
+    assert paths['/recommend/batch']['post']['responses']['200']['content']['application/json']['schema']['items'] == {'$ref': '#/components/schemas/CustomerRecommendations'}
+
+def test_search_products_limit():
+    with patch('api.search_products_service', Mock(return_value=[])) as mock_search_products_service:
+        response = client.get("/search_products?query=smart&limit=5")
+        assert response.status_code == 200
+        mock_search_products_service.assert_called_with("smart", limit=5)
+
+        with pytest.raises(RequestValidationError):
+            client.get("/search_products?query=smart&limit=0")
 
 def test_recommend_product_success():
     expected_result = [
@@ -81,7 +131,7 @@ def test_recommend_product_success():
         }
     ]
     mock_get_customer_by_cid = Mock()
-    mock_get_customer_by_cid.return_value = pd.DataFrame([{'cid': 1}])
+    mock_get_customer_by_cid.return_value = (1,)
     mock_get_product_recommendations = Mock()
     mock_get_product_recommendations.return_value = pd.DataFrame(expected_result)
 
@@ -90,9 +140,74 @@ def test_recommend_product_success():
         assert response.status_code == 200
         assert response.json() == expected_result
 
+def test_recommend_product_precomputed():
+    product = {
+        "pid": 9,
+        "bid": 9,
+        "product_name": "Smartphone",
+        "business_name": "Gallagher PLC",
+        "popularity": 7,
+        "price": 1344.77,
+        "geo_demand": "Josephtown",
+        "category": "Electronics"
+    }
+    generated_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    mock_get_customer_by_cid = Mock(return_value=(1,))
+    mock_get_precomputed = Mock(return_value=[{**product, 'score': 1.5, 'generated_at': generated_at}])
+    mock_get_product_recommendations = Mock()
+
+    with patch('api.get_customer_by_cid', mock_get_customer_by_cid), patch('api.get_precomputed_recommendations', mock_get_precomputed), \
+         patch('api.get_product_recommendations', mock_get_product_recommendations):
+        response = client.get("/recommend?cid=1&precomputed=true&max_age=3600")
+        assert response.status_code == 200
+        assert response.json() == [product]
+        assert response.headers['X-Recommendations-Source'] == 'precomputed'
+        assert response.headers['X-Recommendations-Generated-At'] == generated_at
+        mock_get_product_recommendations.assert_not_called()
+
+def test_recommend_product_precomputed_stale():
+    mock_get_customer_by_cid = Mock(return_value=(1,))
+    mock_get_precomputed = Mock(return_value=[{'pid': 9, 'generated_at': '2020-01-01 00:00:00'}])
+    mock_get_product_recommendations = Mock(return_value=pd.DataFrame(columns=['pid']))
+
+    with patch('api.get_customer_by_cid', mock_get_customer_by_cid), patch('api.get_precomputed_recommendations', mock_get_precomputed), \
+         patch('api.get_product_recommendations', mock_get_product_recommendations):
+        response = client.get("/recommend?cid=1&precomputed=true&max_age=3600")
+        assert response.status_code == 200
+        assert response.headers['X-Recommendations-Source'] == 'online'
+        mock_get_product_recommendations.assert_called_once_with(1)
+
+def test_recommend_products_batch():
+    product = {
+        "pid": 9,
+        "bid": 9,
+        "product_name": "Smartphone",
+        "business_name": "Gallagher PLC",
+        "popularity": 7,
+        "price": 1344.77,
+        "geo_demand": "Josephtown",
+        "category": "Electronics"
+    }
+    mock_get_customers_by_cids = Mock(return_value=[{'cid': 1}, {'cid': 2}])
+    mock_get_batch_recommendations = Mock(return_value={1: pd.DataFrame([product]), 2: pd.DataFrame([product])})
+
+    with patch('api.get_customers_by_cids', mock_get_customers_by_cids), patch('api.get_batch_recommendations', mock_get_batch_recommendations):
+        response = client.post("/recommend/batch", json={'cids': [1, 2], 'n_recommendations': 1})
+        assert response.status_code == 200
+        assert response.json() == [{'cid': 1, 'products': [product]}, {'cid': 2, 'products': [product]}]
+        mock_get_batch_recommendations.assert_called_once_with([1, 2], n_recommendations=1)
+
+def test_recommend_products_batch_customer_not_found():
+    mock_get_customers_by_cids = Mock(return_value=[{'cid': 1}])
+
+    with patch('api.get_customers_by_cids', mock_get_customers_by_cids):
+        with pytest.raises(HTTPException) as e:
+            client.post("/recommend/batch", json={'cids': [1, 2]})
+        assert e.value.status_code == 404
+
 def test_recommend_product_customer_not_found():
     mock_get_customer_by_cid = Mock()
-    mock_get_customer_by_cid.return_value = pd.DataFrame()
+    mock_get_customer_by_cid.return_value = None
 
     with patch('api.get_customer_by_cid', mock_get_customer_by_cid):
         with pytest.raises(HTTPException) as e:
@@ -278,6 +393,37 @@ def test_generate_loan_recommendation():
         assert response.status_code == 200
         assert response.json() == expected_result
 
+def test_generate_loan_recommendations_batch():
+    loan = {
+        "loan_product_id": 18,
+        "approval_probability": 0.782360315322876,
+        "loan_type": "eco_friendly",
+        "purchase_category": "Health",
+        "min_interest_rate": 3,
+        "max_interest_rate": 7,
+        "min_term_months": 12,
+        "max_term_months": 60,
+        "min_loan_amount": 5000,
+        "max_loan_amount": 50000,
+        "processing_fee": 572.28,
+        "loan_type_readable": "Eco Friendly Loan"
+    }
+    mock_recommend_loans_batch = Mock(return_value=pd.DataFrame([{'cid': 1, **loan}, {'cid': 2, **loan}]))
+
+    with patch('api.recommend_loans_batch', mock_recommend_loans_batch):
+        response = client.post("/loan_recommend/batch", json={'cids': [1, 2], 'n_recommendations': 1})
+        assert response.status_code == 200
+        assert response.json() == [{'cid': 1, 'loans': [loan]}, {'cid': 2, 'loans': [loan]}]
+        mock_recommend_loans_batch.assert_called_once_with([1, 2], n_recommendations=1)
+
+def test_generate_loan_recommendations_batch_customer_not_found():
+    mock_recommend_loans_batch = Mock(return_value=pd.DataFrame({'cid': [1]}))
+
+    with patch('api.recommend_loans_batch', mock_recommend_loans_batch):
+        with pytest.raises(HTTPException) as e:
+            client.post("/loan_recommend/batch", json={'cids': [1, 2]})
+        assert e.value.status_code == 404
+
 def test_generate_business_insight_success():
     expected_result = {
         "action_items": [
@@ -288,18 +434,52 @@ def test_generate_business_insight_success():
         ]
     }
     mock_get_business_by_bid = Mock()
-    mock_get_business_by_bid.return_value = pd.DataFrame([{'bid': 1}])
-    mock_get_business_insight = Mock()
+    mock_get_business_by_bid.return_value = (1,)
+    mock_get_business_insight = AsyncMock()
     mock_get_business_insight.return_value = expected_result
 
     with patch('api.get_business_by_bid', mock_get_business_by_bid), patch('api.get_business_insight', mock_get_business_insight):
         response = client.get("/business_insight?bid=1")
         assert response.status_code == 200
         assert response.json() == expected_result
+        mock_get_business_insight.assert_called_with(1, force_refresh=False)
+
+        response = client.get("/business_insight?bid=1&force_refresh=true")
+        assert response.status_code == 200
+        mock_get_business_insight.assert_called_with(1, force_refresh=True)
+
+def test_stream_business_insight():
+    async def mock_stream_business_insight(bid, force_refresh=False):
+        yield 'event: item\ndata: {}\n\n'
+        yield 'event: done\ndata: {}\n\n'
+    mock_get_business_by_bid = Mock(return_value=(1,))
+
+    with patch('api.get_business_by_bid', mock_get_business_by_bid), patch('api.stream_business_insight', mock_stream_business_insight):
+        response = client.get("/business_insight/stream?bid=1")
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/event-stream')
+        assert response.text == 'event: item\ndata: {}\n\nevent: done\ndata: {}\n\n'
+
+def test_stream_business_insight_not_found():
+    mock_get_business_by_bid = Mock(return_value=None)
+
+    with patch('api.get_business_by_bid', mock_get_business_by_bid):
+        with pytest.raises(HTTPException) as e:
+            client.get("/business_insight/stream?bid=0")
+        assert e.value.status_code == 404
+
+def test_get_business_insight_cache_stats():
+    expected_result = {'hits': 3, 'misses': 1, 'refreshes': 0, 'entries': 1, 'ttl_seconds': 86400.0, 'max_entries': 1000}
+    mock_insight_cache_stats = Mock(return_value=expected_result)
+
+    with patch('service.insight_cache_stats', mock_insight_cache_stats):
+        response = client.get("/business_insight/cache_stats")
+        assert response.status_code == 200
+        assert response.json() == expected_result
 
 def test_generate_business_insight_not_found():
     mock_get_business_by_bid = Mock()
-    mock_get_business_by_bid.return_value = pd.DataFrame()
+    mock_get_business_by_bid.return_value = None
 
     with patch('api.get_business_by_bid', mock_get_business_by_bid):
         with pytest.raises(HTTPException) as e:
@@ -343,7 +523,7 @@ def test_generate_business_chart_success():
         ]
     }
     mock_get_business_by_bid = Mock()
-    mock_get_business_by_bid.return_value = pd.DataFrame([{'bid': 1}])
+    mock_get_business_by_bid.return_value = (1,)
     mock_get_business_kpi = Mock()
     mock_get_business_kpi.return_value = expected_result
 
@@ -354,10 +534,72 @@ def test_generate_business_chart_success():
 
 def test_generate_business_chart_not_found():
     mock_get_business_by_bid = Mock()
-    mock_get_business_by_bid.return_value = pd.DataFrame()
+    mock_get_business_by_bid.return_value = None
 
     with patch('api.get_business_by_bid', mock_get_business_by_bid):
         with pytest.raises(HTTPException) as e:
             response = client.get("/business_chart?bid=1")
             assert response.status_code == 404
-            assert response.json() == {'detail': 'Business not found'}
\ No newline at end of file
+            assert response.json() == {'detail': 'Business not found'}
+
+def test_get_executor_stats():
+    pool_stats = {'workers': 4, 'submitted': 10, 'completed': 8, 'failed': 0, 'cancelled': 0, 'queued': 1, 'active': 1, 'max_queued': 3, 'wait_seconds_total': 0.5}
+    mock_executor_stats = Mock(return_value={'thread': pool_stats, 'process': dict(pool_stats, workers=0)})
+
+    with patch('api.executor_stats', mock_executor_stats):
+        response = client.get("/executor_stats")
+        assert response.status_code == 200
+        assert response.json()['thread'] == pool_stats
+
+def test_healthz():
+    response = client.get("/healthz")
+    assert response.status_code == 200
+    assert response.json() == {'status': 'ok'}
+
+def test_readyz():
+    warm = {'state': 'warm', 'seconds': 1.5, 'error': None}
+    warming = {'state': 'warming', 'seconds': None, 'error': None}
+
+    with patch('api.readiness', Mock(return_value={'ready': True, 'subsystems': {'loan_model': warm}})):
+        response = client.get("/readyz")
+        assert response.status_code == 200
+        assert response.json() == {'ready': True, 'subsystems': {'loan_model': warm}}
+
+    with patch('api.readiness', Mock(return_value={'ready': False, 'subsystems': {'loan_model': warming}})):
+        response = client.get("/readyz")
+        assert response.status_code == 503
+        assert response.json()['subsystems'] == {'loan_model': warming}
+
+def test_readyz_waits_for_every_warmup_stage():
+    started, release = threading.Event(), threading.Event()
+
+    def slow_stage():
+        started.set()
+        release.wait(10)
+
+    def broken_stage():
+        raise RuntimeError('no model')
+
+    with patch.dict('startup._startup_times', {'stages': {}, 'imports': {}}), \
+         patch.dict('startup._warmup_state', clear=True), patch('startup._warmup_started', False):
+        thread = startup.start_warmup([('cache', lambda: None), ('model', slow_stage), ('index', lambda: None)], 'all', mode='background')
+        assert started.wait(10)
+        response = client.get("/readyz")
+        assert response.status_code == 503
+        assert {name: state['state'] for (name, state) in response.json()['subsystems'].items()} == \
+            {'cache': 'warm', 'model': 'warming', 'index': 'pending'}
+
+        release.set()
+        thread.join(10)
+        response = client.get("/readyz")
+        assert response.status_code == 200
+        assert response.json()['ready']
+
+        # a failed stage keeps the API unready and says why, even once the others are warm
+        startup.start_warmup([('cache', lambda: None), ('model', broken_stage), ('index', lambda: None)], 'all', mode='startup')
+        response = client.get("/readyz")
+        assert response.status_code == 503
+        subsystems = response.json()['subsystems']
+        assert subsystems['model']['state'] == 'failed'
+        assert subsystems['model']['error'] == 'no model'
+        assert subsystems['cache']['state'] == subsystems['index']['state'] == 'warm'
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+import benchmark
+from benchmark import benchmark_serialization, synthetic_product_records, benchmark_call, compare_benchmarks
+from models import Product
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_product_records_are_valid_products(self):
+        records = synthetic_product_records(5)
+        self.assertEqual([Product(**record).pid for record in records], [1, 2, 3, 4, 5])
+        self.assertEqual(synthetic_product_records(5), records)
+
+    def test_benchmark_serialization(self):
+        results = benchmark_serialization(n_rows=20, repeat=2)
+
+        self.assertEqual(set(results), {'response_model', 'json_records_response'})
+        for timings in results.values():
+            self.assertGreater(timings['response_ms'], 0)
+            self.assertAlmostEqual(timings['row_us'], timings['response_ms'] * 1e3 / 20)
+
+    def test_benchmark_call(self):
+        func = Mock()
+
+        result = benchmark_call(func, [(1,), (2,)], repeat=3)
+
+        # the first call, the rounds using the inputs in turn, then the traced call
+        self.assertEqual([call.args for call in func.call_args_list], [(1,), (1,), (2,), (1,), (1,)])
+        self.assertEqual(result['rounds'], 3)
+        self.assertLessEqual(result['min_ms'], result['p50_ms'])
+        self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+        self.assertLessEqual(result['p95_ms'], result['max_ms'])
+        self.assertGreaterEqual(result['peak_memory_mb'], 0)
+
+    def test_compare_benchmarks(self):
+        baseline = {'scales': {'10k': {'results': {'recommend_loan': {'p50_ms': 2.0}, 'removed': {'p50_ms': 1.0}}}}}
+        current = {'scales': {'10k': {'results': {'recommend_loan': {'p50_ms': 3.0}, 'added': {'p50_ms': 1.0}}},
+                              '100k': {'results': {'recommend_loan': {'p50_ms': 5.0}}}}}
+
+        self.assertEqual(compare_benchmarks(baseline, current), [('10k', 'recommend_loan', 2.0, 3.0, 1.5)])
+
+    def test_benchmark_suite(self):
+        # builds a small database with the initial_data generators and times every hot path on it
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        scales = {'tiny': {'customers': 50, 'transactions': 300, 'loan_applications': 50}}
+        with patch.dict('benchmark.BENCHMARK_SCALES', scales), patch('database.DATABASE_PATH', 'database.db'):
+            report = benchmark.benchmark_suite(['tiny'], repeat=2, directory=directory)
+
+        self.assertTrue(os.path.exists(os.path.join(directory, 'benchmark_tiny.db')))
+        results = report['scales']['tiny']['results']
+        self.assertEqual(set(results), set(benchmark.BENCHMARK_HOT_PATHS))
+        for result in results.values():
+            self.assertGreater(result['p50_ms'], 0)
+            self.assertGreater(result['max_rss_mb'], 0)
+        self.assertEqual(results['customer_similarity']['rounds'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,7 @@
+import os
+import sqlite3
+import tempfile
+import threading
 import unittest
 from unittest.mock import patch, MagicMock
 import database
@@ -8,135 +12,304 @@ import pandas as pd
 class TestDatabase(unittest.TestCase):
 
     def setUp(self):
-        # Create mock connection and cursor objects and override the globals in the module
+        # Create mock connection and cursor objects and hand them out as the thread's connection
         self.mock_conn = MagicMock()
         self.mock_cursor = MagicMock()
-        database.conn = self.mock_conn
-        database.c = self.mock_cursor
+        self.mock_conn.cursor.return_value = self.mock_cursor
+        patcher = patch('database.get_connection', return_value=self.mock_conn)
+        self.mock_get_connection = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _use_memory_database(self):
+        # Use a real in-memory database, e.g. so that triggers actually fire
+        conn = sqlite3.connect(':memory:')
+        self.mock_get_connection.return_value = conn
+        self.addCleanup(conn.close)
+        return conn
     
     @patch('database.sqlite3.connect')
     def test_init_connection(self, mock_connect):
         mock_conn = mock_connect.return_value
-        mock_cursor = mock_conn.cursor.return_value
-        
-        database.init_connection()
+
+        with patch.dict('database._connections', clear=True):
+            conn = database.init_connection()
+            self.assertIs(database._connections[threading.get_ident()], conn)
         
-        mock_connect.assert_called_with('database.db')
-        mock_conn.cursor.assert_called()
+        mock_connect.assert_called_with('database.db', check_same_thread=False)
+        mock_conn.execute.assert_any_call('pragma journal_mode=wal')
+        mock_conn.execute.assert_any_call('pragma synchronous=normal')
     
-    @patch('database.conn')
-    @patch('database.c')
-    def test_drop_existing_tables(self, mock_cursor, mock_conn):
+    def test_drop_existing_tables(self):
+        mock_cursor, mock_conn = self.mock_cursor, self.mock_conn
         mock_cursor.execute = MagicMock()
 
         database.drop_existing_tables()
 
-        # Ensure the execute function is called 7 times (once per table)
-        self.assertEqual(mock_cursor.execute.call_count, 7)
+        # Ensure the execute function is called 14 times (once per table, plus data_versions, recommendations, insight_cache and the rollups)
+        self.assertEqual(mock_cursor.execute.call_count, 15)
         mock_conn.commit.assert_called()
     
-    @patch('database.pd.read_csv')
-    @patch('database.conn')
-    @patch('database.c')
-    def test_init_customers(self, mock_cursor, mock_conn, mock_read_csv):
+    @patch('pandas.read_csv')
+    def test_init_customers(self, mock_read_csv):
+        mock_cursor, mock_conn = self.mock_cursor, self.mock_conn
         mock_cursor.execute = MagicMock()
         
         # Ensure mock_read_csv returns a valid DataFrame
-        mock_read_csv.return_value = pd.DataFrame([{
+        mock_read_csv.return_value = iter([pd.DataFrame([{
             'name': 'John Doe', 'age': 30, 'gender': 'Male', 'location': 'NY', 
             'annual_income': 50000, 'education': 'Bachelor', 'occupation': 'Engineer'
-        }])
+        }])])
         
         database.init_customers()
 
         # Ensure the INSERT statement is called
-        mock_cursor.execute.assert_called()
+        mock_cursor.executemany.assert_called()
         mock_conn.commit.assert_called()
     
-    @patch('database.conn')
-    @patch('database.c')
-    @patch('database.pd.read_csv')
-    def test_init_businesses(self, mock_read_csv, mock_cursor, mock_conn):
+    @patch('pandas.read_csv')
+    def test_init_businesses(self, mock_read_csv):
+        mock_cursor, mock_conn = self.mock_cursor, self.mock_conn
         mock_cursor.execute = MagicMock()
-        mock_read_csv.return_value = pd.DataFrame([
+        mock_read_csv.return_value = iter([pd.DataFrame([
             {'category': 'Retail', 'business_name': 'ABC Store', 'revenue': 100000, 'num_employees': 10}
-        ])
+        ])])
         
         database.init_businesses()
         
-        mock_cursor.execute.assert_called()
+        mock_cursor.executemany.assert_called()
         mock_conn.commit.assert_called()
     
-    @patch('database.conn')
-    @patch('database.c')
-    @patch('database.pd.read_csv')
-    def test_init_products(self, mock_read_csv, mock_cursor, mock_conn):
+    @patch('pandas.read_csv')
+    def test_init_products(self, mock_read_csv):
+        mock_cursor, mock_conn = self.mock_cursor, self.mock_conn
         mock_cursor.execute = MagicMock()
-        mock_read_csv.return_value = pd.DataFrame([
+        mock_read_csv.return_value = iter([pd.DataFrame([
             {'bid': 1, 'product_name': 'Laptop', 'popularity': 4.5, 'price': 1000, 'geo_demand': 'USA'}
-        ])
+        ])])
         
         database.init_products()
         
-        mock_cursor.execute.assert_called()
+        mock_cursor.executemany.assert_called()
         mock_conn.commit.assert_called()
     
-    @patch('database.conn')
-    @patch('database.c')
-    @patch('database.pd.read_csv')
-    def test_init_transactions(self, mock_read_csv, mock_cursor, mock_conn):
+    @patch('pandas.read_csv')
+    def test_init_transactions(self, mock_read_csv):
+        mock_cursor, mock_conn = self.mock_cursor, self.mock_conn
         mock_cursor.execute = MagicMock()
-        mock_read_csv.return_value = pd.DataFrame([
+        mock_read_csv.return_value = iter([pd.DataFrame([
             {'cid': 1, 'pid': 1, 'amount': 100, 'purchase_date': '2024-01-01', 'payment_mode': 'Credit Card'}
-        ])
+        ])])
         
         database.init_transactions()
         
-        mock_cursor.execute.assert_called()
+        mock_cursor.executemany.assert_called()
         mock_conn.commit.assert_called()
     
-    @patch('database.conn')
-    @patch('database.c')
-    @patch('database.pd.read_csv')
-    def test_init_social_media(self, mock_read_csv, mock_cursor, mock_conn):
+    @patch('pandas.read_csv')
+    def test_init_social_media(self, mock_read_csv):
+        mock_cursor, mock_conn = self.mock_cursor, self.mock_conn
         mock_cursor.execute = MagicMock()
-        mock_read_csv.return_value = pd.DataFrame([
+        mock_read_csv.return_value = iter([pd.DataFrame([
             {'platform': 'Twitter', 'content': 'Great Product!', 'timestamp': '2024-01-01', 'sentiment_score': 0.8, 'category': 'Tech'}
-        ])
+        ])])
         
         database.init_social_media()
         
-        mock_cursor.execute.assert_called()
+        mock_cursor.executemany.assert_called()
         mock_conn.commit.assert_called()
     
-    @patch('database.conn')
-    @patch('database.c')
-    @patch('database.pd.read_csv')
-    def test_init_loan_products(self, mock_read_csv, mock_cursor, mock_conn):
+    @patch('pandas.read_csv')
+    def test_init_loan_products(self, mock_read_csv):
+        mock_cursor, mock_conn = self.mock_cursor, self.mock_conn
         mock_cursor.execute = MagicMock()
-        mock_read_csv.return_value = pd.DataFrame([
+        mock_read_csv.return_value = iter([pd.DataFrame([
             {'loan_product_id': 1, 'loan_type': 'Personal Loan', 'purchase_category': 'Electronics', 'min_interest_rate': 5.0, 'max_interest_rate': 15.0, 'min_term_months': 12, 'max_term_months': 60, 'min_loan_amount': 1000, 'max_loan_amount': 50000, 'processing_fee': 2.0}
-        ])
+        ])])
         
         database.init_loan_products()
         
-        mock_cursor.execute.assert_called()
+        mock_cursor.executemany.assert_called()
         mock_conn.commit.assert_called()
     
-    @patch('database.conn')
-    @patch('database.c')
-    @patch('database.pd.read_csv')
-    def test_init_loan_applications(self, mock_read_csv, mock_cursor, mock_conn):
+    @patch('pandas.read_csv')
+    def test_init_loan_applications(self, mock_read_csv):
+        mock_cursor, mock_conn = self.mock_cursor, self.mock_conn
         mock_cursor.execute = MagicMock()
-        mock_read_csv.return_value = pd.DataFrame([
+        mock_read_csv.return_value = iter([pd.DataFrame([
             {'application_id': 1, 'cid': 1, 'loan_product_id': 1, 'loan_amount': 10000, 'interest_rate': 7.5, 'loan_term_months': 36, 'credit_score': 750, 'annual_income': 60000, 'debt_to_income_ratio': 20.0, 'application_date': '2024-01-01', 'status': 'Approved'}
-        ])
+        ])])
         
         database.init_loan_applications()
         
-        mock_cursor.execute.assert_called()
+        mock_cursor.executemany.assert_called()
         mock_conn.commit.assert_called()
 
+    @patch('pandas.read_csv')
+    def test_bulk_load_csv(self, mock_read_csv):
+        conn = self._use_memory_database()
+        conn.execute('create table products (pid integer primary key autoincrement, bid integer, product_name text, price real)')
+        mock_read_csv.return_value = iter([
+            pd.DataFrame({'bid': [1, 1], 'product_name': ['Laptop', 'Phone'], 'price': [1000.0, 500.0]}),
+            pd.DataFrame({'bid': [2], 'product_name': ['Desk'], 'price': [float('nan')]}),
+        ])
+
+        with patch('builtins.print') as mock_print:
+            n_rows = database.bulk_load_csv('products', 'products.csv', ['bid', 'product_name', 'price'], chunksize=2)
+
+        self.assertEqual(n_rows, 3)
+        mock_read_csv.assert_called_once_with('products.csv', usecols=['bid', 'product_name', 'price'], chunksize=2)
+        self.assertEqual(conn.execute('select * from products').fetchall(),
+                         [(1, 1, 'Laptop', 1000.0), (2, 1, 'Phone', 500.0), (3, 2, 'Desk', None)])
+        self.assertIn('products: 3 rows loaded', mock_print.call_args[0][0])
+        # durability is restored after the load
+        self.assertEqual(conn.execute('pragma synchronous').fetchone()[0], 1)
+
+    @patch('pandas.read_csv')
+    def test_bulk_load_csv_rolls_back_on_error(self, mock_read_csv):
+        conn = self._use_memory_database()
+        conn.execute('create table products (pid integer primary key autoincrement, product_name text not null)')
+        mock_read_csv.return_value = iter([
+            pd.DataFrame({'product_name': ['Laptop']}),
+            pd.DataFrame({'product_name': [None]}),
+        ])
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            database.bulk_load_csv('products', 'products.csv', ['product_name'], chunksize=1)
+        self.assertEqual(conn.execute('select count(*) from products').fetchone()[0], 0)
+
+    def _create_schema(self):
+        conn = self._use_memory_database()
+        with patch('database.bulk_load_csv'), patch('builtins.print'):
+            for init_table in (database.init_customers, database.init_businesses, database.init_products,
+                               database.init_transactions, database.init_social_media, database.init_loan_products,
+                               database.init_loan_applications, database.init_recommendations,
+                               database.init_insight_cache, database.init_kpi_rollups, database.init_customer_spend_summary,
+                               database.init_product_search):
+                init_table()
+        return conn
+
+    def test_init_indexes(self):
+        conn = self._use_memory_database()
+        conn.execute('create table products (pid integer primary key, bid integer, popularity real)')
+
+        with patch('builtins.print'):
+            created = database.init_indexes()
+            # the migration is idempotent
+            self.assertEqual(database.init_indexes(), [])
+
+        # only the tables that exist get their indexes
+        self.assertEqual(created, ['idx_products_bid', 'idx_products_popularity'])
+        self.assertEqual(conn.execute("select count(*) from sqlite_master where type = 'index' and name = 'idx_products_bid'").fetchone()[0], 1)
+
+    def test_check_query_plans(self):
+        self._create_schema()
+        checks = [('get_last_n_transactions_for_customer', (1,)), ('get_products_by_bid', (1,)), ('get_product_revenue_info', (1,))]
+
+        violations = database.check_query_plans(checks)
+        # the KPI rollups are looked up by their primary key
+        self.assertEqual({violation[0] for violation in violations}, {'get_last_n_transactions_for_customer', 'get_products_by_bid'})
+
+        with patch('builtins.print'):
+            database.init_indexes(analyze=True)
+        self.assertEqual(database.check_query_plans(), [])
+
+    def test_get_top_customers_by_business_spend(self):
+        conn = self._create_schema()
+        conn.execute("insert into businesses (bid, category) values (1, 'Tech'), (2, 'Food')")
+        conn.execute("insert into products (pid, bid) values (10, 1), (11, 1), (20, 2)")
+        conn.executemany("insert into customers (cid, age, gender, annual_income, education) values (?, 30, 'f', 50000, 'b')",
+                         [(cid,) for cid in range(1, 26)])
+        # customer i spends i on the business, and a lot on another business
+        conn.executemany("insert into transactions (cid, pid, amount) values (?, ?, ?)",
+                         [(cid, 10 + cid % 2, cid) for cid in range(1, 26)] + [(1, 20, 1000.0)])
+
+        result = database.get_top_customers_by_business_spend(1, fraction=0.05, as_df=True)
+
+        # int(0.05 * 25) + 1 customers, highest spend first
+        self.assertEqual(list(result['cid']), [25, 24])
+        self.assertEqual(list(result['amount']), [25.0, 24.0])
+        self.assertEqual(list(result.columns), ['cid', 'amount', 'age', 'gender', 'annual_income', 'education'])
+
+    def test_get_sample_cid(self):
+        conn = self._create_schema()
+        self.assertIsNone(database.get_sample_cid())
+
+        conn.executemany("insert into customers (cid, age, gender, annual_income, education) values (?, 30, 'f', 50000, 'b')",
+                         [(7,), (3,), (12,)])
+        self.assertEqual(database.get_sample_cid(), 3)
+
+    def test_get_avg_category_sentiment(self):
+        conn = self._create_schema()
+        conn.executemany("insert into social_media (category, sentiment_score) values (?, ?)",
+                         [('Tech', 0.5), ('Tech', -0.1), ('Food', 0.9)])
+
+        self.assertAlmostEqual(database.get_avg_category_sentiment('Tech'), 0.2)
+        self.assertIsNone(database.get_avg_category_sentiment('Travel'))
+
+    def test_data_versions(self):
+        conn = self._use_memory_database()
+        conn.execute('create table products (pid integer primary key, product_name text)')
+
+        with patch('builtins.print'):
+            database.init_data_versions()
+            # calling it again (e.g. on every startup) must not reset the version
+            database.init_data_versions()
+
+        initial_version = database.get_data_version('products')
+        self.assertIsNotNone(initial_version)
+        # tables that do not exist are not tracked
+        self.assertIsNone(database.get_data_version('transactions'))
+
+        conn.execute("insert into products (product_name) values ('Laptop')")
+        self.assertNotEqual(database.get_data_version('products'), initial_version)
+
+    def test_insert_transactions_notifies_listeners(self):
+        listener = MagicMock()
+        rows = [(1, 2, 100.0, '2024-01-01 00:00:00', 'Credit')]
+
+        with patch('database._transaction_listeners', [listener]):
+            database.insert_transactions(rows)
+
+        self.mock_cursor.executemany.assert_called_once()
+        self.assertEqual(self.mock_cursor.executemany.call_args[0][1], rows)
+        self.mock_conn.commit.assert_called()
+        listener.assert_called_once_with(rows)
+
+    def test_save_and_get_precomputed_recommendations(self):
+        conn = self._use_memory_database()
+        conn.execute('create table businesses (bid integer primary key, category text, business_name text)')
+        conn.execute('create table products (pid integer primary key, bid integer, product_name text)')
+        conn.execute("insert into businesses values (1, 'Tech', 'X Corp')")
+        conn.executemany('insert into products values (?, 1, ?)', [(10, 'Laptop'), (11, 'Phone')])
+        with patch('builtins.print'):
+            database.init_recommendations()
+
+        database.save_recommendations([(1, 1, 11, 0.9, '2024-01-01 00:00:00'), (1, 2, 10, 0.5, '2024-01-01 00:00:00')], [1])
+        # saving again replaces the customer's previous recommendations
+        database.save_recommendations([(1, 1, 10, 0.7, '2024-01-02 00:00:00')], [1])
+
+        result = database.get_precomputed_recommendations(1, as_df=True)
+        self.assertEqual(list(result['pid']), [10])
+        self.assertEqual(result['business_name'].iloc[0], 'X Corp')
+        self.assertEqual(result['generated_at'].iloc[0], '2024-01-02 00:00:00')
+        self.assertEqual(database.get_precomputed_recommendations(1, as_dict=True), [
+            {'pid': 10, 'bid': 1, 'product_name': 'Laptop', 'category': 'Tech', 'business_name': 'X Corp', 'score': 0.7, 'generated_at': '2024-01-02 00:00:00'},
+        ])
+
+    def test_get_precomputed_recommendations_without_table(self):
+        conn = self._use_memory_database()
+        self.assertTrue(database.get_precomputed_recommendations(1, as_df=True).empty)
+        self.assertEqual(database.get_precomputed_recommendations(1, as_dict=True), [])
+
+    @patch('database.execute_and_fetch_rows')
+    def test_get_customers_by_cids(self, mock_exec_rows):
+        database.get_customers_by_cids([1, 2], as_df=True)
+        self.assertIn("where cid in (1, 2)", mock_exec_rows.call_args[0][0])
+
+    def test_get_data_version_untracked_database(self):
+        conn = self._use_memory_database()
+        self.assertIsNone(database.get_data_version('products'))
+
     @patch('database.execute_and_fetch_rows')
     def test_get_last_n_transactions_for_customer(self, mock_execute):
         mock_execute.return_value = [(1, 100, 50.0, '2024-01-01', 'Credit Card')]
@@ -163,23 +336,70 @@ class TestDatabase(unittest.TestCase):
     
     @patch('database.execute_and_fetch_one')
     def test_validate_user(self, mock_execute):
-        mock_execute.return_value = pd.DataFrame([{'cid': 1, 'name': 'John Doe'}])
+        mock_execute.return_value = {'cid': 1, 'name': 'John Doe'}
         result = database.validate_user(1, 'password', UserType.CUSTOMER)
         
         self.assertEqual(result['name'], 'John Doe')
+        self.assertTrue(mock_execute.call_args.kwargs['as_dict'])
+
+    def test_validate_user_unknown_customer(self):
+        conn = self._create_schema()
+        conn.execute("insert into customers (cid, name, age) values (1, 'John Doe', 30)")
+
+        self.assertIsNone(database.validate_user(2, 'password', UserType.CUSTOMER))
+        self.assertIsNone(database.validate_user(1, 'wrong', UserType.CUSTOMER))
+        user = database.validate_user(1, 'password', UserType.CUSTOMER)
+        self.assertEqual((user['cid'], user['name'], user['age']), (1, 'John Doe', 30))
+        # plain Python values rather than NumPy scalars
+        self.assertIs(type(user['age']), int)
     
-    @patch('database.execute_and_fetch_rows')
-    def test_get_category_and_payment_summary(self, mock_execute):
-        mock_execute.side_effect = [
-            [('Tech', 500.0)],  # Category Spend
-            [('Credit Card', 300.0)]  # Payment Mode Spend
-        ]
-        result = database.get_category_and_payment_summary(1, datetime.date(2024, 1, 1))
-        
-        self.assertEqual(result['category'][0]['category'], 'Tech')
-        self.assertEqual(result['category'][0]['spend'], 500.0)
-        self.assertEqual(result['payment_mode'][0]['mode'], 'Credit Card')
-        self.assertEqual(result['payment_mode'][0]['spend'], 300.0)
+    def _create_spend_schema(self):
+        conn = self._create_schema()
+        conn.executemany('insert into businesses (bid, category) values (?, ?)', [(1, 'Tech'), (2, 'Food')])
+        conn.executemany('insert into products (pid, bid) values (?, ?)', [(10, 1), (20, 2)])
+        conn.executemany('insert into transactions (cid, pid, amount, purchase_date, payment_mode) values (?, ?, ?, ?, ?)', [
+            (1, 10, 500.0, '2024-01-15 10:00:00', 'Credit Card'),
+            (1, 20, 30.0, '2024-02-01 09:30:00', 'Cash'),
+            (1, 10, 200.0, '2024-02-03 18:00:00', 'Cash'),
+            (2, 20, 99.0, '2024-02-03 18:00:00', 'Cash'),
+        ])
+        return conn
+
+    def test_get_category_and_payment_summary(self):
+        self._create_spend_schema()
+
+        with patch('builtins.print') as mock_print:
+            result = database.get_category_and_payment_summary(1)
+            after_date_result = database.get_category_and_payment_summary(1, datetime.date(2024, 2, 1))
+
+        self.assertEqual(result, {
+            "category": [{"category": "Food", "spend": 30.0}, {"category": "Tech", "spend": 700.0}],
+            "payment_mode": [{"mode": "Cash", "spend": 230.0}, {"mode": "Credit Card", "spend": 500.0}]
+        })
+        # purchases on the after_date itself are counted
+        self.assertEqual(after_date_result, {
+            "category": [{"category": "Food", "spend": 30.0}, {"category": "Tech", "spend": 200.0}],
+            "payment_mode": [{"mode": "Cash", "spend": 230.0}]
+        })
+        mock_print.assert_not_called()
+        self.assertEqual(database.get_category_and_payment_summary(3), {"category": [], "payment_mode": []})
+
+    def test_customer_spend_summary_follows_transactions(self):
+        conn = self._create_spend_schema()
+
+        database.insert_transactions([(1, 20, 10.0, '2024-03-01 00:00:00', 'Cash')])
+        conn.execute("update transactions set payment_mode = 'Debit' where amount = 500.0")
+        conn.execute('delete from transactions where amount = 200.0')
+        self.assertEqual(database.get_category_and_payment_summary(1, datetime.date(2024, 2, 1)), {
+            "category": [{"category": "Food", "spend": 40.0}],
+            "payment_mode": [{"mode": "Cash", "spend": 40.0}]
+        })
+
+        # a business changing category moves its customers' spend
+        conn.execute("update businesses set category = 'Dining' where bid = 2")
+        self.assertEqual(database.get_category_and_payment_summary(1)["category"],
+                         [{"category": "Dining", "spend": 40.0}, {"category": "Tech", "spend": 500.0}])
+        self.assertEqual(database.check_kpi_rollups(), [])
 
     @patch('database.drop_existing_tables')
     @patch('database.init_customers')
@@ -209,10 +429,13 @@ class TestDatabase(unittest.TestCase):
         mock_print.assert_called_with("initialization complete")
 
     def test_close_connection(self):
-        with patch('builtins.print') as mock_print:
-            database.close_connection()
+        other_conn = MagicMock()
+        with patch.dict('database._connections', {1: self.mock_conn, 2: other_conn}, clear=True):
+            with patch('builtins.print') as mock_print:
+                database.close_connection()
+            self.assertEqual(database._connections, {})
         self.mock_conn.close.assert_called_once()
-        # We no longer assert that database.c is None because the function's assignment doesn't update the global variable.
+        other_conn.close.assert_called_once()
         mock_print.assert_called_with('Connection closed')
 
     def test_get_first_n(self):
@@ -226,7 +449,7 @@ class TestDatabase(unittest.TestCase):
         self.mock_cursor.execute.assert_called_with(expected_query)
         self.assertEqual(result, expected_result)
 
-    @patch('database.pd.read_sql_query')
+    @patch('pandas.read_sql_query')
     def test_get_df_from_table(self, mock_read_sql_query):
         table_name = "test_table"
         limit = 10
@@ -238,7 +461,7 @@ class TestDatabase(unittest.TestCase):
         mock_read_sql_query.return_value = expected_df
 
         result = database.get_df_from_table(table_name, limit=limit, order_by=order_by, order=order, index_col=index_col)
-        mock_read_sql_query.assert_called_with(query, database.conn, index_col=index_col)
+        mock_read_sql_query.assert_called_with(query, self.mock_conn, index_col=index_col)
         pd.testing.assert_frame_equal(result, expected_df)
 
     def test_execute_and_fetch_rows_as_list(self):
@@ -250,9 +473,25 @@ class TestDatabase(unittest.TestCase):
         self.mock_cursor.execute.return_value.fetchall.return_value = expected_result
 
         result = database.execute_and_fetch_rows(query, as_df=False)
-        self.mock_cursor.execute.assert_called_with(query)
+        self.mock_cursor.execute.assert_called_with(query, ())
         self.assertEqual(result, expected_result)
 
+    def test_execute_and_fetch_rows_as_dict(self):
+        self.mock_cursor.description = [("col1",), ("col2",)]
+        self.mock_cursor.execute.return_value.fetchall.return_value = [(1, 2), (3, 4)]
+
+        result = database.execute_and_fetch_rows("SELECT * FROM test WHERE col1 > ?", as_dict=True, params=(0,))
+        self.mock_cursor.execute.assert_called_with("SELECT * FROM test WHERE col1 > ?", (0,))
+        self.assertEqual(result, [{"col1": 1, "col2": 2}, {"col1": 3, "col2": 4}])
+
+    def test_execute_and_fetch_one_as_dict(self):
+        self.mock_cursor.description = [("col1",), ("col2",)]
+        self.mock_cursor.execute.return_value.fetchone.return_value = (1, 2)
+        self.assertEqual(database.execute_and_fetch_one("SELECT * FROM test", as_dict=True), {"col1": 1, "col2": 2})
+
+        self.mock_cursor.execute.return_value.fetchone.return_value = None
+        self.assertIsNone(database.execute_and_fetch_one("SELECT * FROM test", as_dict=True))
+
     def test_execute_and_fetch_rows_as_df(self):
         query = "SELECT * FROM test"
         expected_result = [(1, 2)]
@@ -325,6 +564,29 @@ class TestDatabase(unittest.TestCase):
         self.assertIn(1, result)
         pd.testing.assert_frame_equal(result[1], df)
 
+    @patch('database.execute_and_fetch_rows')
+    def test_get_last_n_transactions_for_customers(self, mock_exec_rows):
+        expected = [(1, 3, 1, 100, '2024-01-01', 'Credit Card')]
+        mock_exec_rows.return_value = expected
+
+        result = database.get_last_n_transactions_for_customers([3, 5], n=2)
+        self.assertEqual(result, expected)
+        query = mock_exec_rows.call_args[0][0]
+        self.assertIn("where cid in (3, 5)", query)
+        self.assertIn("where rn <= 2", query)
+
+    @patch('database.execute_and_fetch_rows')
+    def test_get_loan_application_summaries(self, mock_exec_rows):
+        expected = [(3, 0.45, 720.0)]
+        mock_exec_rows.return_value = expected
+
+        result = database.get_loan_application_summaries([3, 5], n=10)
+        self.assertEqual(result, expected)
+        query = mock_exec_rows.call_args[0][0]
+        self.assertIn("where cid in (3, 5)", query)
+        self.assertIn("where rn <= 10", query)
+        self.assertIn("group by cid", query)
+
     @patch('database.execute_and_fetch_rows')
     def test_get_avg_recent_sentiment_list(self, mock_exec_rows):
         # When as_df is False, simply return the list provided by the lower-level function.
@@ -346,19 +608,67 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(result.index.name, 'category')
         self.assertEqual(list(result.columns), ['avg_sentiment'])
 
-    @patch('database.execute_and_fetch_rows')
-    def test_search_products_by_name(self, mock_exec_rows):
-        # Return a dummy list for the query
-        expected = [(1, 'Laptop', 4.5, 1000, 'USA', 'Tech', 'Some Business')]
-        mock_exec_rows.return_value = expected
-
-        query_param = 'Laptop'
-        result = database.search_products_by_name(query_param, as_df=False)
-        self.assertEqual(result, expected)
-        # Verify that the query passed to execute_and_fetch_rows includes our query_param.
-        # We'll extract the search query from the call arguments:
-        actual_query = mock_exec_rows.call_args[0][0]
-        self.assertIn(f"LIKE '%{query_param}%'", actual_query)
+    def _create_search_schema(self):
+        conn = self._create_schema()
+        conn.execute("insert into businesses (bid, business_name, category) values (1, 'Gallagher PLC', 'Electronics'), (2, 'Smart Foods', 'Food')")
+        conn.executemany("insert into products (pid, bid, product_name, popularity) values (?, ?, ?, ?)",
+                         [(1, 1, 'Smartphone', 7.0), (2, 1, 'Smartwatch', 9.6), (3, 2, 'Organic Tea', 9.9),
+                          (4, 1, 'Gaming Console', 5.0), (5, 1, 'Smart TV', 1.0)])
+        return conn
+
+    def test_search_products_by_name(self):
+        self._create_search_schema()
+
+        result = database.search_products_by_name('smart', as_df=True)
+
+        # products named after the query come first, then the most popular; the tea matches its business name
+        self.assertEqual(list(result['pid']), [2, 1, 5, 3])
+        self.assertEqual(list(result.columns)[-2:], ['category', 'business_name'])
+        self.assertEqual(database.search_products_by_name('smart', limit=2), database.search_products_by_name('smart')[:2])
+
+    def test_search_products_by_name_words(self):
+        self._create_search_schema()
+
+        # every word must match, the last one as a prefix
+        self.assertEqual([row[0] for row in database.search_products_by_name('gaming cons')], [4])
+        self.assertEqual([row[0] for row in database.search_products_by_name('electro')], [2, 1, 4, 5])
+        self.assertEqual(database.search_products_by_name('gam console'), [])
+
+    def test_search_products_by_name_special_characters(self):
+        self._create_search_schema()
+
+        # the query is never interpreted as SQL or FTS5 syntax
+        self.assertEqual([row[0] for row in database.search_products_by_name('"tea\'); -- (*')], [3])
+        self.assertEqual(database.search_products_by_name(''), [])
+        self.assertTrue(database.search_products_by_name('%', as_df=True).empty)
+
+    def test_search_products_by_name_ranks_every_match(self):
+        conn = self._create_search_schema()
+        # more matches than are sorted at once, the most popular one inserted last
+        conn.executemany("insert into products (pid, bid, product_name, popularity) values (?, 1, ?, ?)",
+                         [(pid, f'Smart Lamp {pid}', 1.0 + pid / 1000) for pid in range(100, 130)] + [(1000, 'Smart Speaker', 9.9)])
+        with patch('builtins.print'):
+            database.init_indexes()
+
+        with patch('database.SEARCH_CANDIDATE_LIMIT', 10):
+            pids = [row[0] for row in database.search_products_by_name('sm', limit=3)]
+            # the name matches are ranked before the products matching only by their business name
+            all_pids = [row[0] for row in database.search_products_by_name('smart', limit=100)]
+        self.assertEqual(pids, [1000, 2, 1])
+        self.assertEqual(all_pids[:4], [1000, 2, 1, 129])
+        self.assertEqual(all_pids[-2:], [5, 3])
+
+    def test_product_search_follows_changes(self):
+        conn = self._create_search_schema()
+
+        conn.execute("insert into products (pid, bid, product_name, popularity) values (6, 2, 'Smart Oven', 3.0)")
+        conn.execute("update products set product_name = 'Green Tea' where pid = 3")
+        conn.execute("delete from products where pid = 1")
+        conn.execute("update businesses set business_name = 'Fresh Foods' where bid = 2")
+
+        self.assertEqual([row[0] for row in database.search_products_by_name('smart')], [2, 6, 5])
+        self.assertEqual([row[0] for row in database.search_products_by_name('fresh')], [3, 6])
+        self.assertEqual(database.search_products_by_name('organic'), [])
 
     @patch('database.execute_and_fetch_one')
     def test_get_customer_by_cid(self, mock_exec_one):
@@ -368,7 +678,7 @@ class TestDatabase(unittest.TestCase):
         result = database.get_customer_by_cid(1, as_df=False)
         self.assertEqual(result, expected)
         expected_query = "\n    select * from customers where cid = 1\n    "
-        mock_exec_one.assert_called_with(expected_query, as_df=False)
+        mock_exec_one.assert_called_with(expected_query, as_df=False, as_dict=False)
 
     @patch('database.execute_and_fetch_one')
     def test_get_business_by_bid(self, mock_exec_one):
@@ -378,7 +688,7 @@ class TestDatabase(unittest.TestCase):
         result = database.get_business_by_bid(1, as_df=False)
         self.assertEqual(result, expected)
         expected_query = "\n    select * from businesses where bid = 1\n    "
-        mock_exec_one.assert_called_with(expected_query, as_df=False)
+        mock_exec_one.assert_called_with(expected_query, as_df=False, as_dict=False)
 
     @patch('database.execute_and_fetch_rows')
     def test_get_last_n_loan_applications_by_cid_with_limit(self, mock_exec_rows):
@@ -413,88 +723,56 @@ class TestDatabase(unittest.TestCase):
         self.assertNotIn("limit", args[0])
         self.assertEqual(result, dummy_result)
 
-    @patch('database.execute_and_fetch_rows')
-    def test_get_product_revenue_info(self, mock_exec_rows):
-        # Prepare a dummy result for product revenue info
-        dummy_result = [('Laptop', 5000)]
-        mock_exec_rows.return_value = dummy_result
-        
-        bid = 1
-        result = database.get_product_revenue_info(bid, as_df=False)
-        
-        args, kwargs = mock_exec_rows.call_args
-        # Ensure the query contains the expected FROM and GROUP BY clauses.
-        self.assertIn("FROM transactions t", args[0])
-        self.assertIn("JOIN products p", args[0])
-        self.assertIn(f"WHERE p.bid = {bid}", args[0])
-        self.assertIn("GROUP BY t.pid", args[0])
-        self.assertEqual(result, dummy_result)
-
-    @patch('database.execute_and_fetch_rows')
-    def test_get_payment_mode_revenue_info(self, mock_exec_rows):
-        # Prepare a dummy result for payment mode revenue info
-        dummy_result = [('Credit Card', 7000)]
-        mock_exec_rows.return_value = dummy_result
-        
-        bid = 2
-        result = database.get_payment_mode_revenue_info(bid, as_df=False)
-        
-        args, kwargs = mock_exec_rows.call_args
-        self.assertIn("FROM transactions t", args[0])
-        self.assertIn("JOIN products p", args[0])
-        self.assertIn(f"WHERE p.bid = {bid}", args[0])
-        self.assertIn("GROUP BY t.payment_mode", args[0])
-        self.assertEqual(result, dummy_result)
-
-    # --- Test for get_df_from_table branch when c is None (lines 269-272) ---
-    @patch('database.init_connection')
-    @patch('database.pd.read_sql_query')
-    def test_get_df_from_table_no_cursor(self, mock_read_sql_query, mock_init_conn):
-        # Simulate that the global cursor is None so that init_connection is triggered.
-        database.c = None
-        expected_df = pd.DataFrame({'id': [1, 2]})
-        mock_read_sql_query.return_value = expected_df
-
-        result = database.get_df_from_table("test_table", limit=10, order_by="id", order="ASC", index_col="id")
-        # Check that init_connection was called to reinitialize c
-        mock_init_conn.assert_called_once()
-        query = f'select * from test_table order by id ASC limit 10'
-        mock_read_sql_query.assert_called_with(query, database.conn, index_col="id")
-        pd.testing.assert_frame_equal(result, expected_df)
-
-    @patch('database.init_connection')
-    def test_execute_and_fetch_rows_no_cursor(self, mock_init_conn):
-        # Set the global cursor to None to trigger init_connection
-        database.c = None
-        # Create a new mock cursor to be set by init_connection
-        new_cursor = MagicMock()
-        new_cursor.description = [("col1",), ("col2",)]
-        new_cursor.execute.return_value.fetchall.return_value = [(1, 2)]
-        # When init_connection is called, set database.c to our new_cursor
-        mock_init_conn.side_effect = lambda: setattr(database, 'c', new_cursor)
-        
-        result = database.execute_and_fetch_rows("SELECT * FROM test", as_df=True, index_col="col1")
-        mock_init_conn.assert_called_once()
-        self.assertIsInstance(result, pd.DataFrame)
-        # Since "col1" is used as the index, only "col2" remains in df.columns.
-        self.assertEqual(list(result.columns), ["col2"])
-        self.assertEqual(result.index.name, "col1")
+    def _create_kpi_schema(self):
+        conn = self._create_schema()
+        conn.executemany('insert into products (pid, bid, product_name) values (?, ?, ?)', [(1, 1, 'Laptop'), (2, 1, 'Phone'), (3, 2, 'Pizza')])
+        conn.executemany('insert into transactions (cid, pid, amount, payment_mode) values (?, ?, ?, ?)',
+                         [(1, 1, 1000.0, 'Credit'), (2, 2, 500.0, 'Debit'), (1, 2, 250.0, 'Credit'), (3, 3, 20.0, 'Credit')])
+        return conn
+
+    def test_get_product_revenue_info(self):
+        self._create_kpi_schema()
+
+        self.assertEqual(database.get_product_revenue_info(1), [('Laptop', 1000.0), ('Phone', 750.0)])
+        df = database.get_product_revenue_info(2, as_df=True)
+        self.assertEqual(df.to_dict('records'), [{'product_name': 'Pizza', 'spend': 20.0}])
+
+    def test_get_payment_mode_revenue_info(self):
+        self._create_kpi_schema()
+
+        self.assertEqual(database.get_payment_mode_revenue_info(1), [('Credit', 1250.0), ('Debit', 500.0)])
+        self.assertEqual(database.get_payment_mode_revenue_info(3), [])
+
+    def test_kpi_rollups_follow_transactions_and_products(self):
+        conn = self._create_kpi_schema()
+
+        database.insert_transactions([(4, 1, 100.0, '2024-01-01 00:00:00', 'Cash')])
+        conn.execute("update transactions set amount = 300.0, payment_mode = 'Cash' where tid = 3")
+        conn.execute('delete from transactions where tid = 2')
+        self.assertEqual(database.get_product_revenue_info(1), [('Laptop', 1100.0), ('Phone', 300.0)])
+        self.assertEqual(database.get_payment_mode_revenue_info(1), [('Cash', 400.0), ('Credit', 1000.0)])
+
+        # a product moving to another business takes its revenue along
+        conn.execute('update products set bid = 2 where pid = 2')
+        self.assertEqual(database.get_product_revenue_info(2), [('Phone', 300.0), ('Pizza', 20.0)])
+        self.assertEqual(database.get_payment_mode_revenue_info(1), [('Cash', 100.0), ('Credit', 1000.0)])
+        self.assertEqual(database.check_kpi_rollups(), [])
+
+    def test_check_and_rebuild_kpi_rollups(self):
+        conn = self._create_kpi_schema()
+        self.assertEqual(database.check_kpi_rollups(), [])
+
+        conn.execute('update business_product_revenue set revenue = revenue + 0.01 where pid = 1')
+        conn.execute("insert into business_payment_mode_revenue values (2, 'Cash', 5.0, 1)")
+        mismatches = database.check_kpi_rollups()
+        self.assertEqual(sorted(mismatches), [
+            ('business_payment_mode_revenue', (2, 'Cash'), None, 5.0),
+            ('business_product_revenue', (1, 1), 1000.0, 1000.01),
+        ])
 
-    @patch('database.init_connection')
-    def test_execute_and_fetch_one_no_cursor(self, mock_init_conn):
-        # Set the global cursor to None to trigger init_connection
-        database.c = None
-        # Create a new mock cursor to be set by init_connection
-        new_cursor = MagicMock()
-        new_cursor.description = [("col1",), ("col2",)]
-        new_cursor.execute.return_value.fetchone.return_value = (1, 2)
-        # When init_connection is called, set database.c to our new_cursor
-        mock_init_conn.side_effect = lambda: setattr(database, 'c', new_cursor)
-        
-        result = database.execute_and_fetch_one("SELECT * FROM test", as_df=True)
-        mock_init_conn.assert_called_once()
-        self.assertIsInstance(result, pd.DataFrame)
-        self.assertEqual(list(result.columns), ["col1", "col2"])
+        with patch('builtins.print'):
+            database.rebuild_kpi_rollups()
+        self.assertEqual(database.check_kpi_rollups(), [])
 
     # --- Test validate_user branch: wrong password, wrong user type, and empty result (lines 493-499) ---
     @patch('database.get_customer_by_cid')
@@ -517,37 +795,36 @@ class TestDatabase(unittest.TestCase):
 
     @patch('database.get_customer_by_cid')
     def test_validate_user_empty_result(self, mock_get_customer):
-        # Simulate get_customer_by_cid returning an empty DataFrame.
-        mock_get_customer.return_value = pd.DataFrame()
+        # Simulate get_customer_by_cid finding no customer.
+        mock_get_customer.return_value = None
         result = database.validate_user(1, "password", UserType.CUSTOMER)
         self.assertIsNone(result)
+        mock_get_customer.assert_called_once_with(1, as_dict=True)
 
     @patch('database.get_customer_by_cid')
     def test_validate_user_valid(self, mock_get_customer):
-        # Simulate a valid DataFrame result
-        mock_get_customer.return_value = pd.DataFrame([{'cid': 1, 'name': 'John Doe'}])
+        # Simulate a valid dictionary result
+        mock_get_customer.return_value = {'cid': 1, 'name': 'John Doe'}
         result = database.validate_user(1, "password", UserType.CUSTOMER)
         self.assertEqual(result, {'cid': 1, 'name': 'John Doe'})
 
     # --- Test for get_category_and_payment_summary branch when after_date is not provided (lines 609-610) ---
     @patch('database.execute_and_fetch_rows')
     def test_get_category_and_payment_summary_no_after_date(self, mock_exec_rows):
-        # Simulate the two queries returning dummy data.
-        dummy_category = [("Tech", 500.0)]
-        dummy_payment = [("Credit Card", 300.0)]
-        # Use side_effect so the first call returns category data and second returns payment mode data.
-        mock_exec_rows.side_effect = [dummy_category, dummy_payment]
+        # Simulate the spend summary rows of both dimensions.
+        mock_exec_rows.return_value = [("category", "Tech", 500.0), ("payment_mode", "Credit Card", 300.0)]
 
         result = database.get_category_and_payment_summary(1)
-        # Check that the where clause doesn't include the after_date part.
-        self.assertIn("WHERE t.cid = 1", mock_exec_rows.call_args_list[0][0][0])
-        self.assertNotIn("purchase_date >=", mock_exec_rows.call_args_list[0][0][0])
+        # Check that the totals are read without the daily buckets of the after_date part.
+        self.assertIn("FROM customer_spend", mock_exec_rows.call_args[0][0])
+        self.assertIn("WHERE cid = 1", mock_exec_rows.call_args[0][0])
+        self.assertNotIn("day >=", mock_exec_rows.call_args[0][0])
         self.assertEqual(result, {
             "category": [{"category": "Tech", "spend": 500.0}],
             "payment_mode": [{"mode": "Credit Card", "spend": 300.0}]
         })
 
-    # --- Tests for get_last_n_loan_applications_by_cid, get_product_revenue_info, get_payment_mode_revenue_info ---
+    # --- Tests for get_last_n_loan_applications_by_cid ---
     @patch('database.execute_and_fetch_rows')
     def test_get_last_n_loan_applications_by_cid_with_limit(self, mock_exec_rows):
         dummy_result = [(1, 'Loan App', 10000, '2024-01-01')]
@@ -573,60 +850,14 @@ class TestDatabase(unittest.TestCase):
         self.assertNotIn("limit", args[0])
         self.assertEqual(result, dummy_result)
 
-    @patch('database.execute_and_fetch_rows')
-    def test_get_product_revenue_info(self, mock_exec_rows):
-        dummy_result = [('Laptop', 5000)]
-        mock_exec_rows.return_value = dummy_result
-        
-        bid = 1
-        result = database.get_product_revenue_info(bid, as_df=False)
-        args, _ = mock_exec_rows.call_args
-        self.assertIn("FROM transactions t", args[0])
-        self.assertIn("JOIN products p", args[0])
-        self.assertIn(f"WHERE p.bid = {bid}", args[0])
-        self.assertIn("GROUP BY t.pid", args[0])
-        self.assertEqual(result, dummy_result)
-
-    @patch('database.execute_and_fetch_rows')
-    def test_get_payment_mode_revenue_info(self, mock_exec_rows):
-        dummy_result = [('Credit Card', 7000)]
-        mock_exec_rows.return_value = dummy_result
-        
-        bid = 2
-        result = database.get_payment_mode_revenue_info(bid, as_df=False)
-        args, _ = mock_exec_rows.call_args
-        self.assertIn("FROM transactions t", args[0])
-        self.assertIn("JOIN products p", args[0])
-        self.assertIn(f"WHERE p.bid = {bid}", args[0])
-        self.assertIn("GROUP BY t.payment_mode", args[0])
-        self.assertEqual(result, dummy_result)
-
     # Validate the business branch in validate_user (line ~497)
     @patch('database.get_business_by_bid')
     def test_validate_user_business_valid(self, mock_get_business):
-        # Simulate a valid DataFrame result for a business user.
-        mock_get_business.return_value = pd.DataFrame([{'bid': 2, 'business_name': 'ABC Corp'}])
+        # Simulate a valid result for a business user.
+        mock_get_business.return_value = {'bid': 2, 'business_name': 'ABC Corp'}
         result = database.validate_user(2, "password", UserType.BUSINESS)
         self.assertEqual(result, {'bid': 2, 'business_name': 'ABC Corp'})
-    
-    # Validate get_category_and_payment_summary when after_date is provided (lines 609-610)
-    @patch('database.execute_and_fetch_rows')
-    def test_get_category_and_payment_summary_with_after_date(self, mock_exec_rows):
-        # Set up a dummy after_date and dummy return values.
-        after_date = datetime.date(2024, 2, 1)
-        dummy_category = [("Tech", 500.0)]
-        dummy_payment = [("Cash", 300.0)]
-        # The first call (category query) and second call (payment query)
-        mock_exec_rows.side_effect = [dummy_category, dummy_payment]
-        
-        result = database.get_category_and_payment_summary(1, after_date=after_date)
-        formatted_date = after_date.strftime('%Y-%m-%d %H:%M:%S')
-        # Verify that the first query includes the formatted after_date.
-        self.assertIn(f"AND t.purchase_date >= '{formatted_date}'", mock_exec_rows.call_args_list[0][0][0])
-        self.assertEqual(result, {
-            "category": [{"category": "Tech", "spend": 500.0}],
-            "payment_mode": [{"mode": "Cash", "spend": 300.0}]
-        })
+        mock_get_business.assert_called_once_with(2, as_dict=True)
     
     # ---------------------------
     # Already provided tests for:
@@ -658,63 +889,105 @@ class TestDatabase(unittest.TestCase):
         self.assertNotIn("limit", args[0])
         self.assertEqual(result, dummy_result)
 
-    @patch('database.execute_and_fetch_rows')
-    def test_get_product_revenue_info(self, mock_exec_rows):
-        dummy_result = [('Laptop', 5000)]
-        mock_exec_rows.return_value = dummy_result
-        
-        bid = 1
-        result = database.get_product_revenue_info(bid, as_df=False)
-        args, _ = mock_exec_rows.call_args
-        self.assertIn("FROM transactions t", args[0])
-        self.assertIn("JOIN products p", args[0])
-        self.assertIn(f"WHERE p.bid = {bid}", args[0])
-        self.assertIn("GROUP BY t.pid", args[0])
-        self.assertEqual(result, dummy_result)
 
-    @patch('database.execute_and_fetch_rows')
-    def test_get_payment_mode_revenue_info(self, mock_exec_rows):
-        dummy_result = [('Credit Card', 7000)]
-        mock_exec_rows.return_value = dummy_result
-        
-        bid = 2
-        result = database.get_payment_mode_revenue_info(bid, as_df=False)
-        args, _ = mock_exec_rows.call_args
-        self.assertIn("FROM transactions t", args[0])
-        self.assertIn("JOIN products p", args[0])
-        self.assertIn(f"WHERE p.bid = {bid}", args[0])
-        self.assertIn("GROUP BY t.payment_mode", args[0])
-        self.assertEqual(result, dummy_result)
+class TestInsightCache(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.addCleanup(self.conn.close)
+        patcher = patch('database.get_connection', return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with patch('builtins.print'):
+            database.init_insight_cache()
+
+    def test_get_cached_insight_hit_and_miss(self):
+        database.save_cached_insight('key1', 1, 'insight', ttl=60, max_entries=10)
+
+        self.assertEqual(database.get_cached_insight('key1', ttl=60), 'insight')
+        self.assertIsNone(database.get_cached_insight('key2', ttl=60))
+        self.assertEqual(database.count_cached_insights(), 1)
+
+    @patch('database.time.time')
+    def test_get_cached_insight_expired(self, mock_time):
+        mock_time.return_value = 1000.0
+        database.save_cached_insight('key1', 1, 'insight', ttl=60, max_entries=10)
+
+        mock_time.return_value = 1061.0
+        self.assertIsNone(database.get_cached_insight('key1', ttl=60))
+
+        # expired entries are evicted by the next save
+        database.save_cached_insight('key2', 1, 'insight', ttl=60, max_entries=10)
+        self.assertEqual(database.count_cached_insights(), 1)
+
+    @patch('database.time.time')
+    def test_save_cached_insight_evicts_least_recently_used(self, mock_time):
+        for (now, key) in ((1.0, 'key1'), (2.0, 'key2')):
+            mock_time.return_value = now
+            database.save_cached_insight(key, 1, key, ttl=60, max_entries=2)
+        mock_time.return_value = 3.0
+        database.get_cached_insight('key1', ttl=60)
+
+        mock_time.return_value = 4.0
+        database.save_cached_insight('key3', 1, 'key3', ttl=60, max_entries=2)
+
+        self.assertEqual(database.get_cached_insight('key1', ttl=60), 'key1')
+        self.assertIsNone(database.get_cached_insight('key2', ttl=60))
+        self.assertEqual(database.get_cached_insight('key3', ttl=60), 'key3')
+
+    def test_insight_cache_without_table(self):
+        self.conn.execute('drop table insight_cache')
+
+        database.save_cached_insight('key1', 1, 'insight', ttl=60, max_entries=10)
+        self.assertIsNone(database.get_cached_insight('key1', ttl=60))
+        self.assertEqual(database.count_cached_insights(), 0)
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.original_path = database.DATABASE_PATH
+        patcher = patch.dict('database._connections', clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        conn = database.init_connection(os.path.join(self.tmp_dir.name, 'test.db'))
+        conn.execute('create table products (pid integer primary key, product_name text)')
+        conn.commit()
+
+    def tearDown(self):
+        with patch('builtins.print'):
+            database.close_connection()
+        database.DATABASE_PATH = self.original_path
+        self.tmp_dir.cleanup()
+
+    def _in_thread(self, target):
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(value=target()))
+        thread.start()
+        thread.join()
+        return result['value']
+
+    def test_get_connection_per_thread(self):
+        conn = database.get_connection()
+        self.assertIs(database.get_connection(), conn)
+        self.assertIsNot(self._in_thread(database.get_connection), conn)
+        self.assertEqual(conn.execute('pragma journal_mode').fetchone()[0], 'wal')
+
+    def test_readers_not_blocked_by_writer(self):
+        writer = database.get_connection()
+        writer.execute("insert into products (product_name) values ('Laptop')")
+        # the write transaction is still open while another thread reads
+        self.assertEqual(self._in_thread(lambda: database.execute_and_fetch_rows('select * from products')), [])
+        writer.commit()
+        self.assertEqual(self._in_thread(lambda: database.execute_and_fetch_rows('select * from products')), [(1, 'Laptop')])
+
+    def test_connections_of_exited_threads_are_closed(self):
+        self._in_thread(database.get_connection)
+        self.assertEqual(len(database._connections), 2)
+
+        # the next connection opened prunes the exited thread's connection
+        self._in_thread(database.get_connection)
+        self.assertEqual(len(database._connections), 2)
 
-    @patch('builtins.print')
-    @patch('database.execute_and_fetch_rows')
-    def test_get_category_and_payment_summary_with_after_date(self, mock_exec_rows, mock_print):
-        # Set up a dummy after_date and dummy return values.
-        after_date = datetime.date(2024, 2, 1)
-        dummy_category = [("Tech", 500.0)]
-        dummy_payment = [("Cash", 300.0)]
-        # The first call (category query) and second call (payment query)
-        mock_exec_rows.side_effect = [dummy_category, dummy_payment]
-        
-        result = database.get_category_and_payment_summary(1, after_date=after_date)
-        formatted_date = after_date.strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Verify that the category query includes the formatted after_date.
-        self.assertIn(f"AND t.purchase_date >= '{formatted_date}'", mock_exec_rows.call_args_list[0][0][0])
-        
-        # Verify the result dictionary.
-        expected_result = {
-            "category": [{"category": "Tech", "spend": 500.0}],
-            "payment_mode": [{"mode": "Cash", "spend": 300.0}]
-        }
-        self.assertEqual(result, expected_result)
-        
-        # Verify that print was called at least twice:
-        # One call prints the category query and one prints the result.
-        self.assertGreaterEqual(len(mock_print.call_args_list), 2)
-        # Verify that the last print call printed the expected result dictionary.
-        printed_result = mock_print.call_args_list[-1][0][0]
-        self.assertEqual(printed_result, expected_result)
-        
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,109 @@
+import asyncio
+import operator
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import executor
+
+class TestExecutor(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.dict('executor._stats', {'thread': executor._empty_stats(), 'process': executor._empty_stats()})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(executor.shutdown_executors)
+
+    def test_run_blocking_uses_worker_thread(self):
+        executor.init_executors(thread_pool_size=2, process_pool_size=0)
+
+        thread_name = asyncio.run(executor.run_blocking(lambda: threading.current_thread().name))
+
+        self.assertTrue(thread_name.startswith('api-worker'))
+        stats = executor.executor_stats()['thread']
+        self.assertEqual((stats['workers'], stats['submitted'], stats['completed'], stats['queued'], stats['active']), (2, 1, 1, 0, 0))
+
+    def test_run_blocking_queue_depth(self):
+        executor.init_executors(thread_pool_size=1, process_pool_size=0)
+        release = threading.Event()
+
+        async def scenario():
+            tasks = [asyncio.ensure_future(executor.run_blocking(release.wait)) for _ in range(3)]
+            # let the first call start on the only worker
+            while executor.executor_stats()['thread']['active'] == 0:
+                await asyncio.sleep(0.01)
+            busy_stats = executor.executor_stats()['thread']
+            release.set()
+            await asyncio.gather(*tasks)
+            return busy_stats
+
+        busy_stats = asyncio.run(scenario())
+
+        self.assertEqual((busy_stats['active'], busy_stats['queued']), (1, 2))
+        stats = executor.executor_stats()['thread']
+        self.assertEqual((stats['completed'], stats['queued']), (3, 0))
+        self.assertGreaterEqual(stats['max_queued'], 2)
+
+    def test_run_blocking_cancelled_while_queued(self):
+        executor.init_executors(thread_pool_size=1, process_pool_size=0)
+        release = threading.Event()
+
+        async def scenario():
+            running = asyncio.ensure_future(executor.run_blocking(release.wait))
+            queued = asyncio.ensure_future(executor.run_blocking(release.wait))
+            while executor.executor_stats()['thread']['active'] == 0:
+                await asyncio.sleep(0.01)
+            # e.g. the client of the queued call disconnected
+            queued.cancel()
+            await asyncio.gather(queued, return_exceptions=True)
+            release.set()
+            await running
+
+        asyncio.run(scenario())
+
+        stats = executor.executor_stats()['thread']
+        self.assertEqual((stats['submitted'], stats['completed'], stats['cancelled'], stats['queued'], stats['active']), (2, 1, 1, 0, 0))
+
+    def test_run_blocking_propagates_errors(self):
+        def fail():
+            raise ValueError('bad input')
+
+        with self.assertRaises(ValueError):
+            asyncio.run(executor.run_blocking(fail))
+        stats = executor.executor_stats()['thread']
+        self.assertEqual((stats['failed'], stats['active']), (1, 0))
+
+    def test_run_cpu_bound_without_process_pool(self):
+        executor.init_executors(thread_pool_size=1, process_pool_size=0)
+
+        self.assertEqual(asyncio.run(executor.run_cpu_bound(operator.mul, 6, 7)), 42)
+        self.assertEqual(executor.executor_stats()['thread']['completed'], 1)
+        self.assertEqual(executor.executor_stats()['process']['submitted'], 0)
+
+    def test_run_cpu_bound_with_process_pool(self):
+        executor.init_executors(thread_pool_size=1, process_pool_size=1)
+
+        self.assertEqual(asyncio.run(executor.run_cpu_bound(operator.mul, 6, 7)), 42)
+        stats = executor.executor_stats()['process']
+        self.assertEqual((stats['workers'], stats['completed'], stats['active']), (1, 1, 0))
+
+    def test_run_cpu_bound_process_queue_depth(self):
+        executor.init_executors(thread_pool_size=1, process_pool_size=1)
+
+        async def scenario():
+            tasks = [asyncio.ensure_future(executor.run_cpu_bound(time.sleep, 0.3)) for _ in range(3)]
+            await asyncio.sleep(0)
+            busy_stats = executor.executor_stats()['process']
+            await asyncio.gather(*tasks)
+            return busy_stats
+
+        busy_stats = asyncio.run(scenario())
+
+        # the calls beyond the only worker are queued
+        self.assertEqual((busy_stats['active'], busy_stats['queued']), (1, 2))
+        stats = executor.executor_stats()['process']
+        self.assertEqual((stats['completed'], stats['active'], stats['queued'], stats['max_queued']), (3, 0, 0, 2))
+
+if __name__ == '__main__':
+    unittest.main()
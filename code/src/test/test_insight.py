@@ -1,5 +1,7 @@
+import asyncio
 import unittest
-from unittest.mock import patch, MagicMock
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock, AsyncMock
 import pandas as pd
 
 
@@ -16,34 +18,41 @@ class DummyResponse:
         # Not actually used in this case, but provided for completeness.
         return getattr(self, key, default)
 
+async def collect(stream):
+    return [item async for item in stream]
+
 class TestBusinessInsightgen(unittest.TestCase):
-    @patch('business_insightgen.get_df_from_table')
+    def setUp(self):
+        # keep the tests off the insight cache of the real database
+        for name in ('get_cached_insight', 'save_cached_insight', 'count_cached_insights'):
+            patcher = patch(f'business_insightgen.{name}')
+            setattr(self, f'mock_{name}', patcher.start())
+            self.addCleanup(patcher.stop)
+        self.mock_get_cached_insight.return_value = None
+        self.mock_count_cached_insights.return_value = 0
+        patcher = patch.dict(business_insightgen._insight_cache_stats, {'hits': 0, 'misses': 0, 'refreshes': 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch('business_insightgen.get_top_customers_by_business_spend')
+    @patch('business_insightgen.get_avg_category_sentiment')
+    @patch('business_insightgen.get_products_by_bid')
+    @patch('business_insightgen.get_business_by_bid')
     @patch('business_insightgen.prompt_model')
-    def test_generate_insights(self, mock_prompt_model, mock_get_df):
-        # Set up dummy data for each call to get_df_from_table.
-        # Call 1: businesses DataFrame
-        businesses_df = pd.DataFrame([
+    def test_generate_insights(self, mock_prompt_model, mock_get_business, mock_get_products,
+                               mock_get_sentiment, mock_get_top_customers):
+        # Set up dummy data for each targeted query.
+        mock_get_business.return_value = pd.DataFrame([
             {"bid": 1, "category": "Tech", "other": "Business Info"}
         ])
-        # Call 2: products DataFrame
-        products_df = pd.DataFrame([
+        mock_get_products.return_value = pd.DataFrame([
             {"bid": 1, "pid": 10, "product_name": "Product A", "popularity": 5.0, 
              "price": 100.0, "geo_demand": "USA"}
         ])
-        # Call 3: social_media DataFrame
-        social_media_df = pd.DataFrame([
-            {"category": "Tech", "sentiment_score": 0.5}
-        ])
-        # Call 4: customers DataFrame
-        customers_df = pd.DataFrame([
-            {"cid": 100, "age": 30, "gender": "m", "annual_income": 60000, "education": "b"}
+        mock_get_sentiment.return_value = 0.5
+        mock_get_top_customers.return_value = pd.DataFrame([
+            {"cid": 100, "amount": 200.0, "age": 30, "gender": "m", "annual_income": 60000, "education": "b"}
         ])
-        # Call 5: transactions DataFrame
-        transactions_df = pd.DataFrame([
-            {"pid": 10, "cid": 100, "amount": 200.0}
-        ])
-        # Setup side_effect to return these in order.
-        mock_get_df.side_effect = [businesses_df, products_df, social_media_df, customers_df, transactions_df]
         
         # Setup prompt_model to return a normal response.
         mock_prompt_model.return_value = (True, "Generated output")
@@ -55,8 +64,11 @@ class TestBusinessInsightgen(unittest.TestCase):
         self.assertTrue(status)
         self.assertEqual(result, "Generated output")
         
-        # Verify that get_df_from_table was called 5 times.
-        self.assertEqual(mock_get_df.call_count, 5)
+        # Verify that only the business's data was queried.
+        mock_get_business.assert_called_once_with(1, as_df=True)
+        mock_get_products.assert_called_once_with(1, as_df=True)
+        mock_get_sentiment.assert_called_once_with("Tech")
+        mock_get_top_customers.assert_called_once_with(1, fraction=0.05, as_df=True)
         
         # Verify that prompt_model was called once.
         mock_prompt_model.assert_called_once()
@@ -68,37 +80,279 @@ class TestBusinessInsightgen(unittest.TestCase):
         self.assertIn("Product Data:", prompt_arg)
         self.assertIn("Social Media Data:", prompt_arg)
         self.assertIn("Action item", prompt_arg)  # Though not literal, instructions are present
+        self.assertIn("is 0.50.", prompt_arg)
+        self.assertIn("Most common gender: Male", prompt_arg)
+
+    def _patch_prompt_data(self):
+        patchers = [
+            patch('business_insightgen.get_business_by_bid', return_value=pd.DataFrame([{"bid": 1, "category": "Tech"}])),
+            patch('business_insightgen.get_products_by_bid', return_value=pd.DataFrame(columns=["pid", "product_name", "popularity", "price", "geo_demand"])),
+            patch('business_insightgen.get_avg_category_sentiment', return_value=None),
+            patch('business_insightgen.get_top_customers_by_business_spend', return_value=pd.DataFrame([
+                {"cid": 100, "amount": 200.0, "age": 30, "gender": "f", "annual_income": 60000, "education": "m"}])),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('business_insightgen.prompt_model')
+    def test_generate_insights_cache_hit(self, mock_prompt_model):
+        self._patch_prompt_data()
+        self.mock_get_cached_insight.return_value = "Cached output"
+
+        status, result = business_insightgen.generate_insights(1)
+
+        self.assertTrue(status)
+        self.assertEqual(result, "Cached output")
+        mock_prompt_model.assert_not_called()
+        self.assertEqual(business_insightgen.insight_cache_stats()['hits'], 1)
+
+    @patch('business_insightgen.prompt_model')
+    def test_generate_insights_cache_miss_is_saved(self, mock_prompt_model):
+        self._patch_prompt_data()
+        output = "\n".join(f"line {i}" for i in range(7))
+        mock_prompt_model.return_value = (True, output)
+
+        business_insightgen.generate_insights(1)
+
+        cache_key = self.mock_get_cached_insight.call_args[0][0]
+        self.mock_save_cached_insight.assert_called_once_with(cache_key, 1, output, business_insightgen.INSIGHT_CACHE_TTL,
+                                                              business_insightgen.INSIGHT_CACHE_MAX_ENTRIES)
+        self.assertEqual(business_insightgen.insight_cache_stats()['misses'], 1)
+
+    @patch('business_insightgen.prompt_model')
+    def test_generate_insights_force_refresh(self, mock_prompt_model):
+        self._patch_prompt_data()
+        mock_prompt_model.return_value = (True, "\n".join(f"line {i}" for i in range(7)))
+
+        business_insightgen.generate_insights(1, force_refresh=True)
+
+        self.mock_get_cached_insight.assert_not_called()
+        mock_prompt_model.assert_called_once()
+        self.mock_save_cached_insight.assert_called_once()
+        self.assertEqual(business_insightgen.insight_cache_stats()['refreshes'], 1)
+
+    @patch('business_insightgen.prompt_model')
+    def test_generate_insights_failures_not_cached(self, mock_prompt_model):
+        self._patch_prompt_data()
+        for response in ((False, "API error"), (True, "too short")):
+            mock_prompt_model.return_value = response
+            business_insightgen.generate_insights(1)
+
+        self.mock_save_cached_insight.assert_not_called()
+
+    def test_generate_insights_async(self):
+        self._patch_prompt_data()
+        backend = llm_chat.FakeBackend()
+        llm_chat.set_llm_backend(backend)
+        self.addCleanup(llm_chat.set_llm_backend, None)
+        self.addCleanup(llm_chat.shutdown_llm_gateway)
+
+        status, result = asyncio.run(business_insightgen.generate_insights_async(1))
+
+        self.assertTrue(status)
+        self.assertEqual(result, llm_chat.FAKE_INSIGHT)
+        self.assertEqual(backend.calls, 1)
+        self.mock_save_cached_insight.assert_called_once()
+
+    def test_stream_insights(self):
+        self._patch_prompt_data()
+        llm_chat.set_llm_backend(llm_chat.FakeBackend(response=lambda prompt: "line 1\nline 2\nline 3"))
+        self.addCleanup(llm_chat.set_llm_backend, None)
+        self.addCleanup(llm_chat.shutdown_llm_gateway)
+
+        lines = asyncio.run(collect(business_insightgen.stream_insights(1)))
+
+        self.assertEqual(lines, ["line 1", "line 2", "line 3"])
+        # too short to be cached
+        self.mock_save_cached_insight.assert_not_called()
+
+    def test_stream_insights_from_cache(self):
+        self._patch_prompt_data()
+        self.mock_get_cached_insight.return_value = "line 1\nline 2"
+
+        lines = asyncio.run(collect(business_insightgen.stream_insights(1)))
+
+        self.assertEqual(lines, ["line 1", "line 2"])
+
+class FailingBackend:
+    """Raises the given errors on the first calls, then answers"""
+    def __init__(self, *errors_to_raise):
+        self.errors_to_raise = list(errors_to_raise)
+        self.calls = 0
+    async def generate(self, prompt):
+        self.calls += 1
+        if self.errors_to_raise:
+            raise self.errors_to_raise.pop(0)
+        return "Recovered output"
+
+class FailingStreamBackend:
+    """Raises the error before the first chunk or after the given chunks"""
+    def __init__(self, error, chunks=()):
+        self.error = error
+        self.chunks = list(chunks)
+        self.calls = 0
+    async def generate_stream(self, prompt):
+        self.calls += 1
+        for chunk in self.chunks:
+            yield chunk
+        raise self.error
+
+class ConcurrencyTrackingBackend:
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+    async def generate(self, prompt):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.05)
+        self.active -= 1
+        return prompt
 
 class TestLLMChat(unittest.TestCase):
-    @patch('llm_chat.client.models.generate_content')
-    def test_prompt_model_success(self, mock_generate_content):
-        # Simulate a normal response.
+    def setUp(self):
+        patcher = patch('llm_chat.LLM_RETRY_BACKOFF', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        llm_chat.init_llm_gateway(max_concurrency=2)
+        self.addCleanup(llm_chat.shutdown_llm_gateway)
+        self.addCleanup(llm_chat.set_llm_backend, None)
+
+    def test_prompt_model_success(self):
+        backend = llm_chat.FakeBackend(response=lambda prompt: prompt.upper())
+        llm_chat.set_llm_backend(backend)
+
+        status, result = llm_chat.prompt_model("Test prompt")
+
+        self.assertTrue(status)
+        self.assertEqual(result, "TEST PROMPT")
+        self.assertEqual(backend.calls, 1)
+
+    def test_prompt_model_async(self):
+        llm_chat.set_llm_backend(llm_chat.FakeBackend())
+
+        status, result = asyncio.run(llm_chat.prompt_model_async("Test prompt"))
+
+        self.assertTrue(status)
+        self.assertEqual(result, llm_chat.FAKE_INSIGHT)
+
+    @patch('google.genai.Client')
+    def test_gemini_backend(self, mock_client):
         response_mock = MagicMock()
         response_mock.text = "Test output"
-        mock_generate_content.return_value = response_mock
-        
+        mock_client.return_value.aio.models.generate_content = AsyncMock(return_value=response_mock)
+        backend = llm_chat.GeminiBackend(api_key="key")
+        # the client is only created when the backend is first used
+        mock_client.assert_not_called()
+        llm_chat.set_llm_backend(backend)
+
         prompt = "Test prompt\nLine two"
         status, result = llm_chat.prompt_model(prompt)
-        
+        llm_chat.prompt_model(prompt)
+
         self.assertTrue(status)
         self.assertEqual(result, "Test output")
+        mock_client.assert_called_once_with(api_key="key")
         # Verify that generate_content was called with splitlines() of the prompt.
-        mock_generate_content.assert_called_with(
+        mock_client.return_value.aio.models.generate_content.assert_called_with(
             model="gemini-2.0-flash", contents=prompt.splitlines()
         )
 
-    @patch('llm_chat.client.models.generate_content')
-    def test_prompt_model_api_error(self, mock_generate_content):
+    def test_prompt_model_api_error(self):
         error_message = "API error occurred"
-        dummy_response = DummyResponse(error_message)
-        # Raise APIError with our dummy response.
-        mock_generate_content.side_effect = errors.APIError(error_message, dummy_response)
-        
-        prompt = "Test prompt\nLine two"
-        status, result = llm_chat.prompt_model(prompt)
-        
+        backend = FailingBackend(errors.APIError(error_message, DummyResponse(error_message)))
+        llm_chat.set_llm_backend(backend)
+
+        status, result = llm_chat.prompt_model("Test prompt")
+
         self.assertFalse(status)
         self.assertEqual(result, error_message)
+        # client errors are not retried
+        self.assertEqual(backend.calls, 1)
+
+    def test_prompt_model_retries_transient_errors(self):
+        backend = FailingBackend(errors.ServerError(503, DummyResponse("overloaded")), errors.ClientError(429, DummyResponse("rate limited")))
+        llm_chat.set_llm_backend(backend)
+
+        with patch('llm_chat.logging'):
+            status, result = llm_chat.prompt_model("Test prompt")
+
+        self.assertTrue(status)
+        self.assertEqual(result, "Recovered output")
+        self.assertEqual(backend.calls, 3)
+
+    @patch('llm_chat.LLM_MAX_RETRIES', 0)
+    @patch('llm_chat.LLM_TIMEOUT', 0.05)
+    def test_prompt_model_timeout(self):
+        llm_chat.set_llm_backend(llm_chat.FakeBackend(delay=5))
+
+        status, result = llm_chat.prompt_model("Test prompt")
+
+        self.assertFalse(status)
+        self.assertIn("did not answer within", result)
+
+    def test_identical_prompts_are_coalesced(self):
+        backend = llm_chat.FakeBackend(delay=0.2)
+        llm_chat.set_llm_backend(backend)
+
+        with ThreadPoolExecutor(max_workers=5) as pool:
+            results = list(pool.map(llm_chat.prompt_model, ["Test prompt"] * 5))
+
+        self.assertEqual(backend.calls, 1)
+        self.assertEqual(results, [(True, llm_chat.FAKE_INSIGHT)] * 5)
+
+    def test_concurrency_limit(self):
+        backend = ConcurrencyTrackingBackend()
+        llm_chat.set_llm_backend(backend)
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            results = list(pool.map(llm_chat.prompt_model, [f"prompt {i}" for i in range(6)]))
+
+        self.assertEqual(results, [(True, f"prompt {i}") for i in range(6)])
+        self.assertEqual(backend.max_active, 2)
+
+    def test_stream_model(self):
+        llm_chat.set_llm_backend(llm_chat.FakeBackend(response="line 1\nline 2"))
+
+        chunks = asyncio.run(collect(llm_chat.stream_model("Test prompt")))
+
+        self.assertEqual(chunks, ["line 1\n", "line 2"])
+
+    @patch('google.genai.Client')
+    def test_gemini_backend_stream(self, mock_client):
+        async def stream():
+            for text in ("Test ", None, "output"):
+                chunk = MagicMock()
+                chunk.text = text
+                yield chunk
+        mock_client.return_value.aio.models.generate_content_stream = AsyncMock(return_value=stream())
+        llm_chat.set_llm_backend(llm_chat.GeminiBackend(api_key="key"))
+
+        chunks = asyncio.run(collect(llm_chat.stream_model("Test prompt")))
+
+        self.assertEqual(chunks, ["Test ", "output"])
+
+    def test_stream_model_error(self):
+        error_message = "API error occurred"
+        llm_chat.set_llm_backend(FailingStreamBackend(errors.APIError(error_message, DummyResponse(error_message))))
+
+        with self.assertRaises(llm_chat.LLMError) as cm:
+            asyncio.run(collect(llm_chat.stream_model("Test prompt")))
+
+        self.assertEqual(cm.exception.message, error_message)
+
+    def test_stream_model_retries_before_first_chunk_only(self):
+        backend = FailingStreamBackend(errors.ServerError(503, DummyResponse("overloaded")))
+        llm_chat.set_llm_backend(backend)
+        with patch('llm_chat.logging'), self.assertRaises(llm_chat.LLMError):
+            asyncio.run(collect(llm_chat.stream_model("Test prompt")))
+        self.assertEqual(backend.calls, llm_chat.LLM_MAX_RETRIES + 1)
+
+        backend = FailingStreamBackend(errors.ServerError(503, DummyResponse("overloaded")), chunks=["partial"])
+        llm_chat.set_llm_backend(backend)
+        with self.assertRaises(llm_chat.LLMError):
+            asyncio.run(collect(llm_chat.stream_model("Test prompt")))
+        self.assertEqual(backend.calls, 1)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from loan_inference import load_numpy_loan_model, export_loan_model
+
+LOAN_MODEL_PATH = 'initial_data/loan_approval_model.keras'
+LOAN_PREPROCESSOR_PATH = 'initial_data/preprocessor_loan.joblib'
+
+class TestLoanInference(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from tensorflow.keras.models import load_model
+
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.npz_path = os.path.join(cls.tmp_dir.name, 'loan_model.npz')
+        export_loan_model(LOAN_MODEL_PATH, LOAN_PREPROCESSOR_PATH, cls.npz_path)
+        cls.keras_model = load_model(LOAN_MODEL_PATH)
+        cls.sklearn_preprocessor = joblib.load(LOAN_PREPROCESSOR_PATH)
+        cls.model, cls.preprocessor = load_numpy_loan_model(cls.npz_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def _applications(self, n=50):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({column: rng.normal(self.preprocessor.mean[i], self.preprocessor.scale[i], n)
+                           for (i, column) in enumerate(self.preprocessor.numeric_columns)})
+        for (column, values) in zip(self.preprocessor.categorical_columns, self.preprocessor.categories):
+            df[column] = rng.choice(values, n)
+        # a category unseen during training is ignored by both preprocessors
+        df.loc[0, self.preprocessor.categorical_columns[0]] = 'unknown'
+        return df
+
+    def test_preprocessor_matches_column_transformer(self):
+        df = self._applications()
+        expected = self.sklearn_preprocessor.transform(df)
+        if hasattr(expected, 'toarray'):
+            expected = expected.toarray()
+
+        np.testing.assert_allclose(self.preprocessor.transform(df), expected, rtol=1e-5, atol=1e-5)
+
+    def test_model_matches_keras(self):
+        X = self.preprocessor.transform(self._applications())
+        expected = self.keras_model.predict(X, verbose=0)
+
+        np.testing.assert_allclose(self.model.predict(X), expected, rtol=1e-4, atol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
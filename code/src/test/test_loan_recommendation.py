@@ -2,11 +2,10 @@ import unittest
 from unittest.mock import patch, MagicMock
 import pandas as pd
 import numpy as np
-import joblib
-import tensorflow as tf
 
 import loan_recommendation
 from loan_recommendation import readable_loan_name, recommend_loan
+from loan_inference import NumpyLoanPreprocessor
 
 class TestLoanRecommendation(unittest.TestCase):
 
@@ -16,24 +15,53 @@ class TestLoanRecommendation(unittest.TestCase):
         # "personal_loan" becomes ["Personal", "Loan"] then joined to "Personal Loan", then " Loan" appended.
         self.assertEqual(result, "Personal Loan Loan")
     
+    def setUp(self):
+        loan_recommendation._loan_product_cache = None
+
+    def tearDown(self):
+        loan_recommendation._loan_product_cache = None
+
+    def _fake_loan_model(self, version='test'):
+        numeric_columns = [
+            'loan_amount', 'interest_rate', 'loan_term_months', 'credit_score', 'annual_income_x',
+            'debt_to_income_ratio', 'age', 'annual_income_y', 'min_interest_rate', 'max_interest_rate',
+            'min_term_months', 'max_term_months', 'min_loan_amount', 'max_loan_amount', 'processing_fee',
+            'app_month_sin', 'app_month_cos'
+        ]
+        preprocessor = NumpyLoanPreprocessor(
+            numeric_columns, np.zeros(len(numeric_columns)), np.ones(len(numeric_columns)),
+            ['gender', 'education', 'loan_type', 'purchase_category'],
+            [['f', 'm'], ['b', 'm'], ['personal_loan', 'auto'], ['electronics', 'travel']],
+        )
+        fake_model = MagicMock()
+        # Fake predict returns the scaled credit score, so the customer columns must reach the model.
+        fake_model.predict.side_effect = lambda X: X[:, [preprocessor.numeric_positions['credit_score']]] / 1000
+        return {'model': fake_model, 'preprocessor': preprocessor, 'version': version}
+
+    def _loan_products(self):
+        return pd.DataFrame([{
+            'loan_product_id': 101,
+            'loan_type': 'personal_loan',
+            'purchase_category': 'electronics',
+            'min_interest_rate': 5.0,
+            'max_interest_rate': 10.0,
+            'min_term_months': 12,
+            'max_term_months': 60,
+            'min_loan_amount': 1000,
+            'max_loan_amount': 5000,
+            'processing_fee': 2.0
+        }]).set_index('loan_product_id')
+
+    @patch('loan_recommendation.get_data_version')
     @patch('loan_recommendation.get_df_from_table')
     @patch('loan_recommendation.get_last_n_loan_applications_by_cid')
     @patch('loan_recommendation.get_customer_by_cid')
-    @patch('loan_recommendation.joblib.load')
-    @patch('loan_recommendation.load_model')
-    def test_recommend_loan(self, mock_load_model, mock_joblib_load, 
+    @patch('loan_recommendation.get_loan_model')
+    def test_recommend_loan(self, mock_get_loan_model,
                             mock_get_customer_by_cid, mock_get_last_n_loans, 
-                            mock_get_df_from_table):
-        # --- Set up fake model and preprocessor ---
-        fake_model = MagicMock()
-        # Fake predict returns an array with one prediction: 0.8 probability.
-        fake_model.predict.return_value = np.array([[0.8]])
-        mock_load_model.return_value = fake_model
-
-        fake_preprocessor = MagicMock()
-        # We need to return an array of shape (n_samples, num_features). The column order has 21 columns.
-        fake_preprocessor.transform.return_value = np.array([[0.5]*21])
-        mock_joblib_load.return_value = fake_preprocessor
+                            mock_get_df_from_table, mock_get_data_version):
+        mock_get_loan_model.return_value = self._fake_loan_model()
+        mock_get_data_version.return_value = 'loan_products:abc:1'
 
         # --- Set up fake customer data ---
         # Return a DataFrame with one customer row.
@@ -51,40 +79,12 @@ class TestLoanRecommendation(unittest.TestCase):
         # Return a DataFrame with loan application history.
         loans_df = pd.DataFrame([
             {'debt_to_income_ratio': 0.4, 'credit_score': 700},
-            {'debt_to_income_ratio': 0.5, 'credit_score': 750}
+            {'debt_to_income_ratio': 0.5, 'credit_score': 900}
         ])
         mock_get_last_n_loans.return_value = loans_df
 
         # --- Set up fake loan products data ---
-        # original_loan_products: first call to get_df_from_table with index_col.
-        original_loan_products = pd.DataFrame([{
-            'loan_product_id': 101,
-            'loan_type': 'personal_loan',
-            'purchase_category': 'electronics',
-            'min_interest_rate': 5.0,
-            'max_interest_rate': 10.0,
-            'min_term_months': 12,
-            'max_term_months': 60,
-            'min_loan_amount': 1000,
-            'max_loan_amount': 5000,
-            'processing_fee': 2.0
-        }]).set_index('loan_product_id')
-        # loan_products: second call returns similar data but with loan_product_id as a column.
-        loan_products = pd.DataFrame([{
-            'loan_product_id': 101,
-            'loan_type': 'personal_loan',
-            'purchase_category': 'electronics',
-            'min_interest_rate': 5.0,
-            'max_interest_rate': 10.0,
-            'min_term_months': 12,
-            'max_term_months': 60,
-            'min_loan_amount': 1000,
-            'max_loan_amount': 5000,
-            'processing_fee': 2.0
-        }])
-        # When recommend_loan calls get_df_from_table twice for 'loan_products',
-        # return the original_loan_products on first call and loan_products on second call.
-        mock_get_df_from_table.side_effect = [original_loan_products, loan_products]
+        mock_get_df_from_table.return_value = self._loan_products()
 
         # --- Call recommend_loan ---
         # Use n_recommendations=1 to keep it simple.
@@ -95,22 +95,114 @@ class TestLoanRecommendation(unittest.TestCase):
         self.assertEqual(len(recommended), 1)
         # Check that the loan_product_id is 101.
         self.assertEqual(recommended.iloc[0]['loan_product_id'], 101)
-        # Verify that the approval_probability column is added and equals 0.8.
+        # Verify that the approval_probability column is added and reflects the mean credit score.
         self.assertAlmostEqual(recommended.iloc[0]['approval_probability'], 0.8)
         # Verify that the loan_type_readable column is computed correctly.
         self.assertEqual(recommended.iloc[0]['loan_type_readable'], "Personal Loan Loan")
-    
+
+        # A second customer reuses the cached loan product features
+        mock_get_last_n_loans.return_value = pd.DataFrame()
+        recommended = recommend_loan(2, n_recommendations=1)
+        self.assertAlmostEqual(recommended.iloc[0]['approval_probability'], 0.65)
+        mock_get_df_from_table.assert_called_once_with('loan_products', index_col='loan_product_id')
+
+    @patch('loan_recommendation.get_data_version')
+    @patch('loan_recommendation.get_df_from_table')
+    def test_get_loan_product_features_invalidation(self, mock_get_df_from_table, mock_get_data_version):
+        mock_get_df_from_table.return_value = self._loan_products()
+        loan_model = self._fake_loan_model()
+
+        mock_get_data_version.return_value = 'loan_products:abc:1'
+        first = loan_recommendation.get_loan_product_features(loan_model)
+        self.assertIs(loan_recommendation.get_loan_product_features(loan_model), first)
+
+        # loan_products was modified
+        mock_get_data_version.return_value = 'loan_products:abc:2'
+        second = loan_recommendation.get_loan_product_features(loan_model)
+        self.assertIsNot(second, first)
+
+        # another model version was loaded
+        third = loan_recommendation.get_loan_product_features(self._fake_loan_model(version='other'))
+        self.assertIsNot(third, second)
+        self.assertEqual(mock_get_df_from_table.call_count, 3)
+
+    def test_customer_loan_features(self):
+        preprocessor = self._fake_loan_model()['preprocessor']
+        frame = self._loan_products().assign(
+            loan_amount=3000, interest_rate=7.5, loan_term_months=36,
+            credit_score=700, annual_income_x=60000, debt_to_income_ratio=0.4, age=35, annual_income_y=60000,
+            gender='f', education='m', app_month_sin=0.5, app_month_cos=-0.5,
+        )
+        with patch('loan_recommendation.get_df_from_table', return_value=self._loan_products()):
+            product_features = loan_recommendation.build_loan_product_features(preprocessor)
+        customers = frame[loan_recommendation.CUSTOMER_FEATURE_COLUMNS]
+
+        X = loan_recommendation.customer_loan_features(product_features, preprocessor, customers)
+
+        self.assertEqual(X.shape, (1, 1, preprocessor.n_features))
+        np.testing.assert_array_equal(X[0], preprocessor.transform(frame))
+
+    @patch('loan_recommendation.get_data_version')
+    @patch('loan_recommendation.get_df_from_table')
+    @patch('loan_recommendation.get_loan_application_summaries')
+    @patch('loan_recommendation.get_customers_by_cids')
+    @patch('loan_recommendation.get_loan_model')
+    def test_recommend_loans_batch(self, mock_get_loan_model, mock_get_customers_by_cids,
+                                   mock_get_summaries, mock_get_df_from_table, mock_get_data_version):
+        loan_model = self._fake_loan_model()
+        mock_get_loan_model.return_value = loan_model
+        mock_get_data_version.return_value = 'loan_products:abc:1'
+        loan_products = pd.concat([self._loan_products(), self._loan_products().rename(index={101: 102}).assign(loan_type='auto')])
+        mock_get_df_from_table.return_value = loan_products
+        mock_get_customers_by_cids.return_value = pd.DataFrame([
+            {'cid': 1, 'annual_income': 60000, 'age': 35, 'gender': 'm', 'education': 'b'},
+            {'cid': 2, 'annual_income': 40000, 'age': 50, 'gender': 'f', 'education': 'm'},
+        ])
+        # customer 2 has no loan applications and gets the default credit score
+        mock_get_summaries.return_value = pd.DataFrame([{'cid': 1, 'debt_to_income_ratio': 0.45, 'credit_score': 800.0}])
+
+        result = loan_recommendation.recommend_loans_batch([2, 1, 3], n_recommendations=2, batch_size=1)
+
+        self.assertEqual(result['cid'].tolist(), [2, 2, 1, 1])
+        self.assertEqual(result['loan_product_id'].tolist(), [101, 102, 101, 102])
+        np.testing.assert_allclose(result['approval_probability'], [0.65, 0.65, 0.8, 0.8])
+        self.assertEqual(result['loan_type_readable'].tolist(), ["Personal Loan Loan", "Auto Loan"] * 2)
+        self.assertEqual(loan_model['model'].predict.call_count, 2)
+
+    @patch('loan_recommendation.get_customers_by_cids')
+    @patch('loan_recommendation.get_loan_model')
+    def test_recommend_loans_batch_no_customers(self, mock_get_loan_model, mock_get_customers_by_cids):
+        mock_get_customers_by_cids.return_value = pd.DataFrame()
+
+        result = loan_recommendation.recommend_loans_batch([3])
+        self.assertTrue(result.empty)
+        self.assertIn('cid', result.columns)
+
     def test_recommend_loan_customer_not_found(self):
         # To simulate a "customer not found" scenario without triggering an IndexError,
         # we return a DataFrame with one row that is an empty Series.
         empty_series = pd.Series({}, dtype=object)
         # Note: The DataFrame itself is not empty (has one row), but the row (Series) is empty.
         df = pd.DataFrame([empty_series])
-        with patch('loan_recommendation.get_customer_by_cid') as mock_get_customer:
+        with patch('loan_recommendation.get_customer_by_cid') as mock_get_customer, patch('loan_recommendation.get_loan_model'):
             mock_get_customer.return_value = df
             with self.assertRaises(ValueError) as context:
                 recommend_loan(999)
             self.assertIn("Customer not found", str(context.exception))
 
+    @patch('loan_recommendation.get_loan_product_features')
+    @patch('loan_recommendation.recommend_loan')
+    @patch('loan_recommendation.get_sample_cid')
+    @patch('loan_recommendation.get_loan_model')
+    def test_warm_up_loan_model(self, mock_get_loan_model, mock_get_sample_cid, mock_recommend_loan, mock_get_features):
+        mock_get_sample_cid.return_value = 3
+        loan_recommendation.warm_up_loan_model()
+        mock_recommend_loan.assert_called_once_with(3)
+
+        mock_get_sample_cid.return_value = None
+        loan_recommendation.warm_up_loan_model()
+        mock_recommend_loan.assert_called_once()
+        mock_get_features.assert_called_once_with(mock_get_loan_model.return_value)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,136 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+import numpy as np
+
+import loan_inference
+import model_registry
+
+class TestModelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.model_path = os.path.join(self.tmp_dir.name, 'model.keras')
+        self.preprocessor_path = os.path.join(self.tmp_dir.name, 'preprocessor.joblib')
+        for path in (self.model_path, self.preprocessor_path):
+            with open(path, 'wb') as f:
+                f.write(b'v1')
+        model_registry._loan_model = None
+
+    def tearDown(self):
+        model_registry._loan_model = None
+        self.tmp_dir.cleanup()
+
+    @patch('joblib.load')
+    @patch('model_registry._load_keras_model')
+    def test_get_loan_model_loads_once(self, mock_load_model, mock_joblib_load):
+        model_registry.load_loan_model('keras', (self.model_path, self.preprocessor_path))
+        first = model_registry.get_loan_model()
+        second = model_registry.get_loan_model()
+
+        self.assertIs(first, second)
+        self.assertEqual(mock_load_model.call_count, 1)
+        self.assertEqual(mock_joblib_load.call_count, 1)
+        self.assertIs(first['model'], mock_load_model.return_value)
+
+    @patch('joblib.load')
+    @patch('model_registry._load_keras_model')
+    def test_get_loan_model_hot_reloads_changed_artifacts(self, mock_load_model, mock_joblib_load):
+        mock_load_model.side_effect = [MagicMock(name='v1'), MagicMock(name='v2')]
+        first = model_registry.load_loan_model('keras', (self.model_path, self.preprocessor_path))
+
+        with open(self.model_path, 'wb') as f:
+            f.write(b'version 2')
+        second = model_registry.get_loan_model()
+
+        self.assertIsNot(first['model'], second['model'])
+        self.assertNotEqual(first['version'], second['version'])
+        self.assertEqual(model_registry.loan_model_info()['version'], second['version'])
+
+    @patch('joblib.load')
+    @patch('model_registry._load_keras_model')
+    def test_get_loan_model_keeps_serving_when_reload_fails(self, mock_load_model, mock_joblib_load):
+        first = model_registry.load_loan_model('keras', (self.model_path, self.preprocessor_path))
+        mock_load_model.side_effect = OSError('truncated file')
+
+        with open(self.model_path, 'wb') as f:
+            f.write(b'partial')
+        with patch('model_registry.logging'):
+            served = model_registry.get_loan_model()
+            # the failed artifacts are not retried on every call
+            model_registry.get_loan_model()
+
+        self.assertIs(served, first)
+        self.assertEqual(mock_load_model.call_count, 2)
+
+    @patch('model_registry.load_numpy_loan_model')
+    def test_load_loan_model_numpy_backend(self, mock_load_numpy):
+        mock_load_numpy.return_value = (MagicMock(name='model'), MagicMock(name='preprocessor'))
+        registry_entry = model_registry.load_loan_model('numpy', (self.model_path,))
+
+        mock_load_numpy.assert_called_once_with(self.model_path)
+        self.assertIs(registry_entry['model'], mock_load_numpy.return_value[0])
+        self.assertEqual(model_registry.loan_model_info()['backend'], 'numpy')
+        self.assertEqual(model_registry.loan_model_info()['paths'], [self.model_path])
+
+    def test_load_loan_model_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            model_registry.load_loan_model('onnx', (self.model_path,))
+
+    @patch.dict(os.environ, {'LOAN_MODEL_BACKEND': 'keras'})
+    def test_default_backend_from_environment(self):
+        self.assertEqual(model_registry.default_backend(), 'keras')
+
+    def _write_export(self, source_digests=None):
+        npz_path = os.path.join(self.tmp_dir.name, 'model.npz')
+        arrays = {} if source_digests is None else {'source_digests': np.array(source_digests)}
+        np.savez(npz_path, **arrays)
+        return npz_path
+
+    def test_is_numpy_export_stale(self):
+        sources = (self.model_path, self.preprocessor_path)
+        digests = [loan_inference.file_digest(path) for path in sources]
+
+        self.assertFalse(model_registry.is_numpy_export_stale(self._write_export(digests), sources))
+        # retrained without exporting
+        with open(self.model_path, 'wb') as f:
+            f.write(b'v2')
+        self.assertTrue(model_registry.is_numpy_export_stale(self._write_export(digests), sources))
+
+        # an export without digests is stale when it is older than the Keras artifacts
+        npz_path = self._write_export()
+        self.assertFalse(model_registry.is_numpy_export_stale(npz_path, sources))
+        os.utime(npz_path, ns=(0, 0))
+        self.assertTrue(model_registry.is_numpy_export_stale(npz_path, sources))
+        # without the Keras artifacts there is nothing to compare with
+        self.assertFalse(model_registry.is_numpy_export_stale(npz_path, (os.path.join(self.tmp_dir.name, 'missing.keras'),)))
+
+    @patch('joblib.load')
+    @patch('model_registry._load_keras_model')
+    @patch('model_registry.load_numpy_loan_model')
+    def test_stale_export_falls_back_to_keras(self, mock_load_numpy, mock_load_model, mock_joblib_load):
+        mock_load_numpy.return_value = (MagicMock(name='model'), MagicMock(name='preprocessor'))
+        npz_path = self._write_export([loan_inference.file_digest(path) for path in (self.model_path, self.preprocessor_path)])
+
+        with patch('model_registry.LOAN_MODEL_NPZ_PATH', npz_path), \
+             patch.dict('model_registry.LOAN_MODEL_ARTIFACTS', {'numpy': (npz_path,), 'keras': (self.model_path, self.preprocessor_path)}), \
+             patch.dict(os.environ, {}, clear=False):
+            os.environ.pop('LOAN_MODEL_BACKEND', None)
+            self.assertEqual(model_registry.get_loan_model()['backend'], 'numpy')
+
+            # a retraining that did not export the model is served with Keras, and says so
+            with open(self.model_path, 'wb') as f:
+                f.write(b'version 2')
+            with self.assertLogs(level='WARNING') as logs:
+                registry_entry = model_registry.get_loan_model()
+
+        self.assertEqual(registry_entry['backend'], 'keras')
+        self.assertIs(registry_entry['model'], mock_load_model.return_value)
+        self.assertIn('was not exported from the current Keras model', logs.output[0])
+
+    def test_loan_model_info_without_model(self):
+        self.assertIsNone(model_registry.loan_model_info())
+
+if __name__ == '__main__':
+    unittest.main()
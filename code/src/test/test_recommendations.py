@@ -1,11 +1,23 @@
+import os
+import sqlite3
+import tempfile
 import unittest
 from unittest.mock import patch
+import numpy as np
 import pandas as pd
+import database
+import recommendations
 from recommendations import (
     product_similarity,
     customer_similarity,
     sentiment_scores,
     get_product_recommendations,
+    rebuild_product_similarity_store,
+    load_product_similarity_store,
+    get_product_similarity_store,
+    is_product_similarity_stale,
+    product_similarity_row,
+    _make_product_similarity_store,
 )
 
 class TestRecommendations(unittest.TestCase):
@@ -60,6 +72,7 @@ class TestRecommendations(unittest.TestCase):
 
         # Fake transactions (1 transaction per category)
         transactions = pd.DataFrame({
+            'tid': [1 + i for i in range(8)],
             'cid': [1] * 8,
             'pid': [101 + i for i in range(8)],
             'amount': [10 * (i + 1) for i in range(8)],
@@ -107,6 +120,44 @@ class TestRecommendations(unittest.TestCase):
         # Debugging print (Uncomment if needed)
         # print("Final DataFrame columns:", sim_df.columns)    
     
+    @patch('recommendations.get_data_version', return_value='products:a:1|businesses:b:1')
+    @patch('recommendations.product_similarity')
+    def test_product_similarity_store_roundtrip(self, mock_product_similarity, mock_get_data_version):
+        mock_product_similarity.return_value = pd.DataFrame(
+            [[1.0, 0.8], [0.8, 1.0]], index=[101, 102], columns=[101, 102])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'product_similarity.npz')
+            with patch('recommendations._product_similarity_store', None):
+                built = rebuild_product_similarity_store(path)
+                loaded = load_product_similarity_store(path)
+
+        # the persisted store is a compact float32 matrix with the pid index and build version
+        self.assertEqual(loaded['matrix'].dtype, np.float32)
+        self.assertEqual(list(loaded['pids']), [101, 102])
+        self.assertEqual(loaded['version'], built['version'])
+        self.assertFalse(is_product_similarity_stale(loaded))
+        self.assertAlmostEqual(product_similarity_row(102, loaded)[101], 0.8, places=6)
+
+        # a write to products bumps the data version, making the store stale
+        mock_get_data_version.return_value = 'products:a:2|businesses:b:1'
+        self.assertTrue(is_product_similarity_stale(loaded))
+
+    @patch('recommendations.rebuild_product_similarity_store')
+    @patch('recommendations.get_data_version', return_value='products:a:1|businesses:b:1')
+    def test_get_product_similarity_store_serves_from_memory(self, mock_get_data_version, mock_rebuild):
+        store = _make_product_similarity_store(
+            np.array([101]), np.ones((1, 1), dtype=np.float32),
+            recommendations.product_similarity_version(), '2025-01-01T00:00:00')
+
+        with patch('recommendations._product_similarity_store', store):
+            self.assertIs(get_product_similarity_store(), store)
+            mock_rebuild.assert_not_called()
+
+            mock_get_data_version.return_value = 'products:a:2|businesses:b:1'
+            get_product_similarity_store()
+            mock_rebuild.assert_called_once()
+
     @patch('recommendations.get_avg_recent_sentiment')
     def test_sentiment_scores(self, mock_get_avg):
         # Create a fake sentiment DataFrame
@@ -116,18 +167,125 @@ class TestRecommendations(unittest.TestCase):
         result = sentiment_scores(n=10)
         pd.testing.assert_frame_equal(result, fake_df)
 
-    @patch('recommendations.np.random.rand', return_value=0.5)
-    @patch('recommendations.sentiment_scores')
-    @patch('recommendations.customer_similarity')
-    @patch('recommendations.get_last_n_transactions_for_all_customers')
-    @patch('recommendations.get_last_n_transactions_for_customer')
-    @patch('recommendations.get_df_from_table')
-    @patch('recommendations.product_similarity')
-    def test_get_product_recommendations(
-        self, mock_product_similarity, mock_get_df, mock_get_last_n_trans_customer,
-        mock_last_n_trans_all, mock_customer_similarity, mock_sentiment_scores,
-        mock_rand
-    ):
+    def _customer_store(self):
+        customers = pd.DataFrame({
+            'cid': [1, 2, 3],
+            'name': ['A', 'B', 'C'],
+            'age': [30, 31, 60],
+            'gender': ['f', 'f', 'm'],
+            'location': ['L1', 'L2', 'L3'],
+            'annual_income': [50000, 52000, 200000],
+            'education': ['b', 'b', 'p'],
+            'occupation': ['eng', 'eng', 'ceo']
+        }).set_index('cid')
+        transactions = pd.DataFrame({
+            'tid': [1, 2, 3],
+            'cid': [1, 2, 3],
+            'pid': [101, 101, 102],
+            'amount': [100.0, 110.0, 900.0],
+            'purchase_date': ['2024-01-01', '2024-01-02', '2024-01-03'],
+            'payment_mode': ['card'] * 3
+        })
+        products = pd.DataFrame({'bid': [1, 2], 'pid': [101, 102], 'popularity': [1, 2], 'price': [100, 900], 'geo_demand': ['USA'] * 2})
+        businesses = pd.DataFrame({'bid': [1, 2], 'category': ['Dining', 'Travel'], 'business_name': ['B1', 'B2'], 'revenue': [1, 2], 'num_employees': [1, 2]})
+        with patch('recommendations.get_df_from_table', side_effect=[customers, transactions, products, businesses]), \
+             patch('recommendations.get_data_version', return_value='v'):
+            return recommendations.build_customer_embedding_store()
+
+    def test_top_k_similar_customers(self):
+        store = self._customer_store()
+        # memory is linear: one embedding row per customer
+        self.assertEqual(store['embeddings'].shape[0], 3)
+
+        cids, similarities = recommendations.top_k_similar_customers(1, 2, store)
+        # the customer itself is excluded and the most similar customer comes first
+        self.assertEqual(list(cids), [2, 3])
+        self.assertGreater(similarities[0], similarities[1])
+
+        # the top-k neighbours agree with the dense similarity matrix
+        dense = store['embeddings'] @ store['embeddings'].T
+        self.assertAlmostEqual(similarities[0], dense[0, 1], places=5)
+
+    def test_update_customer_embeddings(self):
+        store = self._customer_store()
+        before = store['embeddings'].copy()
+
+        with patch('recommendations._customer_embedding_store', store), \
+             patch('recommendations.get_data_version', return_value='w'), \
+             patch('recommendations.execute_and_fetch_rows', return_value=[(4, 3, 101, 50.0, '2024-02-01')]) as mock_execute:
+            recommendations.update_customer_embeddings([(3, 101, 50.0, '2024-02-01', 'card')])
+
+        # only the transactions after the store's last one are read
+        self.assertEqual(mock_execute.call_args.kwargs['params'], (3,))
+        self.assertEqual((store['last_tid'], store['transactions_version']), (4, 'w'))
+        # only the affected customer's vector changes
+        self.assertTrue((store['embeddings'][:2] == before[:2]).all())
+        self.assertFalse((store['embeddings'][2] == before[2]).all())
+        self.assertEqual(store['spend_count'][2, store['category_positions']['Dining']], 1)
+
+    def _customer_database(self):
+        conn = sqlite3.connect(':memory:')
+        self.addCleanup(conn.close)
+        with patch('database.get_connection', return_value=conn), patch('database.bulk_load_csv'), patch('builtins.print'):
+            for init_table in (database.init_customers, database.init_businesses, database.init_products, database.init_transactions,
+                               database.init_data_versions):
+                init_table()
+        conn.executemany('insert into customers (cid, age, gender, annual_income, education) values (?, ?, ?, ?, ?)',
+                         [(1, 30, 'f', 50000, 'b'), (2, 31, 'f', 52000, 'b'), (3, 60, 'm', 200000, 'p')])
+        conn.executemany('insert into businesses (bid, category) values (?, ?)', [(1, 'Dining'), (2, 'Travel')])
+        conn.executemany('insert into products (pid, bid) values (?, ?)', [(101, 1), (102, 2)])
+        conn.executemany('insert into transactions (cid, pid, amount, purchase_date) values (?, ?, ?, ?)',
+                         [(1, 101, 100.0, '2024-01-01'), (2, 101, 110.0, '2024-01-02'), (3, 102, 900.0, '2024-01-03')])
+        conn.commit()
+        return conn
+
+    def test_customer_embedding_store_follows_transactions_of_other_processes(self):
+        conn = self._customer_database()
+
+        with patch('database.get_connection', return_value=conn), patch('recommendations._customer_embedding_store', None):
+            store = recommendations.get_customer_embedding_store()
+            self.assertEqual(list(recommendations.top_k_similar_customers(3, 1, store)[0]), [1])
+
+            # committed by another process: the transaction listener of this one is not called
+            with patch('database._transaction_listeners', []):
+                database.insert_transactions([(3, 101, 10000.0, '2024-02-01', 'card'), (3, 101, 10000.0, '2024-02-02', 'card')])
+
+            self.assertIs(recommendations.get_customer_embedding_store(), store)
+            self.assertEqual(store['spend_count'][2, store['category_positions']['Dining']], 2)
+            self.assertEqual(list(recommendations.top_k_similar_customers(3, 1, store)[0]), [2])
+
+            # the listener of the inserting process does not count them again
+            recommendations.update_customer_embeddings([])
+            self.assertEqual(store['spend_count'][2, store['category_positions']['Dining']], 2)
+
+    def test_customer_embedding_store_keeps_its_transaction_window(self):
+        conn = self._customer_database()
+
+        with patch('database.get_connection', return_value=conn), patch('recommendations._customer_embedding_store', None):
+            store = recommendations.get_customer_embedding_store(n_transactions=2)
+            dining, travel = store['category_positions']['Dining'], store['category_positions']['Travel']
+            # the oldest purchase, of customer 1, is outside the window
+            self.assertEqual(store['spend_count'][:, dining].tolist(), [0, 1, 0])
+
+            # a back-dated purchase stays outside the window
+            database.insert_transactions([(1, 101, 50.0, '2023-12-01', 'card')])
+            self.assertIs(recommendations.get_customer_embedding_store(n_transactions=2), store)
+            self.assertEqual(store['spend_count'][:, dining].tolist(), [0, 1, 0])
+
+            # a new purchase pushes out the oldest one of the window
+            database.insert_transactions([(1, 102, 70.0, '2024-02-01', 'card')])
+            store = recommendations.get_customer_embedding_store(n_transactions=2)
+            self.assertEqual(store['spend_count'][:, dining].tolist(), [0, 0, 0])
+            self.assertEqual(store['spend_count'][:, travel].tolist(), [1, 0, 1])
+            self.assertEqual(store['spend_sum'][0, travel], 70.0)
+
+            # the same as a rebuild of the window
+            rebuilt = recommendations.build_customer_embedding_store(n_transactions=2)
+            np.testing.assert_array_equal(store['spend_count'], rebuilt['spend_count'])
+            np.testing.assert_array_equal(store['spend_sum'], rebuilt['spend_sum'])
+
+    def _patch_scoring_inputs(self, mock_get_product_similarity_store, mock_get_df, mock_get_last_n_transactions,
+                              mock_similar_customers, mock_sentiment_scores):
         # Prepare fake products and businesses for get_df_from_table.
         products_df = pd.DataFrame({
             'pid': [101, 102],
@@ -145,47 +303,43 @@ class TestRecommendations(unittest.TestCase):
         # First call returns products_df, second returns businesses_df.
         mock_get_df.side_effect = [products_df.copy(), businesses_df.copy()]
 
-        # Prepare fake recent transactions for the customer.
-        recent_transactions = pd.DataFrame({
-            'tid': [1],
-            'cid': [1],
-            'pid': [101],
-            'amount': [100],
-            'purchase_date': ['2024-01-01'],
-            'payment_mode': ['card']
-        })
-        mock_get_last_n_trans_customer.return_value = recent_transactions
-    
-        # Prepare fake last-n transactions for all customers.
-        fake_last_n = pd.DataFrame({
-            'tid': [2],
-            'cid': [1],
-            'pid': [102],
-            'amount': [150],
-            'purchase_date': ['2024-01-02'],
-            'payment_mode': ['cash']
-        })
-        # Provide a dict with keys for both customer 1 and 2 to avoid KeyError.
-        mock_last_n_trans_all.return_value = {1: fake_last_n, 2: pd.DataFrame(columns=['pid'])}
-
-        # Fake customer similarity matrix: a simple 2x2 matrix.
-        fake_customer_sim = pd.DataFrame({
-            1: [1.0, 0.9],
-            2: [0.9, 1.0]
-        }, index=[1, 2])
-        mock_customer_similarity.return_value = fake_customer_sim
-
-        # Fake product similarity matrix.
-        fake_product_sim = pd.DataFrame({
-            101: {101: 1.0, 102: 0.8},
-            102: {101: 0.8, 102: 1.0}
+        # Customer 1 bought product 101, customer 2 bought product 102.
+        mock_get_last_n_transactions.return_value = pd.DataFrame({
+            'tid': [1, 2],
+            'cid': [1, 2],
+            'pid': [101, 102],
+            'amount': [100, 150],
+            'purchase_date': ['2024-01-01', '2024-01-02'],
+            'payment_mode': ['card', 'cash']
         })
-        mock_product_similarity.return_value = fake_product_sim
+
+        # Customers 1 and 2 are each other's most similar customer.
+        mock_similar_customers.side_effect = lambda cids, k, store: (
+            np.array([[2 if cid == 1 else 1] for cid in cids]), np.full((len(cids), 1), 0.9, dtype=np.float32))
+
+        # Fake product similarity store.
+        fake_product_sim = _make_product_similarity_store(
+            np.array([101, 102]), np.array([[1.0, 0.8], [0.8, 1.0]], dtype=np.float32), 'v', '2025-01-01T00:00:00')
+        mock_get_product_similarity_store.return_value = fake_product_sim
 
         # Fake sentiment scores: one row per category.
         fake_sentiment = pd.DataFrame({'avg_sentiment': [0.5]}, index=['Tech'])
         mock_sentiment_scores.return_value = fake_sentiment
 
+    @patch('recommendations.np.random.rand', return_value=0.5)
+    @patch('recommendations.sentiment_scores')
+    @patch('recommendations.similar_customers')
+    @patch('recommendations.get_customer_embedding_store')
+    @patch('recommendations.get_last_n_transactions_for_customers')
+    @patch('recommendations.get_df_from_table')
+    @patch('recommendations.get_product_similarity_store')
+    def test_get_product_recommendations(
+        self, mock_get_product_similarity_store, mock_get_df, mock_get_last_n_transactions,
+        mock_get_customer_embedding_store, mock_similar_customers, mock_sentiment_scores, mock_rand
+    ):
+        self._patch_scoring_inputs(mock_get_product_similarity_store, mock_get_df, mock_get_last_n_transactions,
+                                   mock_similar_customers, mock_sentiment_scores)
+
         # Call the recommendation function.
         recs = get_product_recommendations(
             cid=1,
@@ -207,6 +361,77 @@ class TestRecommendations(unittest.TestCase):
         self.assertIn('business_name', recs.columns)
         # Check that 'score' exists
         self.assertIn('score', recs.columns)
+        # Product 102 is similar to the purchased product and was bought by the similar customer
+        self.assertEqual(recs.iloc[0]['pid'], 102)
+        self.assertAlmostEqual(recs.iloc[0]['score'], 0.8 * 0.5 + 0.9 * 0.5 + 0.5 * 0.3, places=5)
+
+    @patch('recommendations.np.random.rand', return_value=0.5)
+    @patch('recommendations.sentiment_scores')
+    @patch('recommendations.similar_customers')
+    @patch('recommendations.get_customer_embedding_store')
+    @patch('recommendations.get_last_n_transactions_for_customers')
+    @patch('recommendations.get_df_from_table')
+    @patch('recommendations.get_product_similarity_store')
+    def test_score_products_batch(
+        self, mock_get_product_similarity_store, mock_get_df, mock_get_last_n_transactions,
+        mock_get_customer_embedding_store, mock_similar_customers, mock_sentiment_scores, mock_rand
+    ):
+        self._patch_scoring_inputs(mock_get_product_similarity_store, mock_get_df, mock_get_last_n_transactions,
+                                   mock_similar_customers, mock_sentiment_scores)
+
+        products_df, scores = recommendations.score_products(
+            [1, 2], n_transactions=1, n_customers=1, n_similar_products=1, repeat_prob=0.3)
+
+        # one row of scores per customer, one column per product
+        self.assertEqual(scores.shape, (2, 2))
+        self.assertEqual(list(products_df.index), [101, 102])
+        # each customer's own purchase is penalised, the other product gets the similarity scores
+        repeat_score = 0.5 * 0.3 * 0.2
+        other_score = 0.8 * 0.5 + 0.9 * 0.5 + 0.5 * 0.3
+        np.testing.assert_allclose(scores, [[repeat_score, other_score], [other_score, repeat_score]], rtol=1e-5)
+
+    @patch('recommendations.init_recommendations')
+    @patch('recommendations.save_recommendations')
+    @patch('recommendations.score_products')
+    def test_precompute_recommendations(self, mock_score_products, mock_save_recommendations, mock_init_recommendations):
+        products_df = pd.DataFrame({'product_name': ['ProdA', 'ProdB', 'ProdC']}, index=pd.Index([101, 102, 103], name='pid'))
+        mock_score_products.side_effect = lambda cids, **kwargs: (products_df, np.array([[0.1, 0.9, 0.5]] * len(cids)))
+
+        with patch('builtins.print'):
+            processed = recommendations.precompute_recommendations(cids=[1, 2, 3], n_recommendations=2, batch_size=2)
+
+        self.assertEqual(processed, 3)
+        # customers are scored and written in batches
+        self.assertEqual(mock_score_products.call_count, 2)
+        self.assertEqual(mock_save_recommendations.call_count, 2)
+        rows, cids = mock_save_recommendations.call_args_list[0][0]
+        self.assertEqual(list(cids), [1, 2])
+        self.assertEqual([(cid, rank, pid) for (cid, rank, pid, _, _) in rows], [(1, 1, 102), (1, 2, 103), (2, 1, 102), (2, 2, 103)])
+
+    @patch('recommendations.score_products')
+    def test_get_batch_recommendations(self, mock_score_products):
+        products_df = pd.DataFrame({'product_name': ['ProdA', 'ProdB']}, index=pd.Index([101, 102], name='pid'))
+        mock_score_products.return_value = (products_df, np.array([[0.1, 0.9], [0.8, 0.2]]))
+
+        results = recommendations.get_batch_recommendations([1, 2], n_recommendations=1)
+
+        mock_score_products.assert_called_once()
+        self.assertEqual(list(results[1]['pid']), [102])
+        self.assertEqual(list(results[2]['pid']), [101])
+
+    @patch('recommendations.get_product_similarity_store')
+    @patch('recommendations.get_product_recommendations')
+    @patch('recommendations.get_sample_cid')
+    def test_warm_up_recommendations(self, mock_get_sample_cid, mock_get_product_recommendations, mock_get_store):
+        mock_get_sample_cid.return_value = 3
+        recommendations.warm_up_recommendations()
+        mock_get_product_recommendations.assert_called_once_with(3)
+
+        # without customers only the similarity store can be built
+        mock_get_sample_cid.return_value = None
+        recommendations.warm_up_recommendations()
+        mock_get_product_recommendations.assert_called_once()
+        mock_get_store.assert_called_once_with()
 
 if __name__ == '__main__':
     unittest.main()
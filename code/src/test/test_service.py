@@ -1,6 +1,8 @@
 import unittest
 from unittest.mock import patch, Mock
-from service import search_products_service, authenticate_user_service, get_business_insight, get_business_kpi
+import asyncio
+from service import search_products_service, authenticate_user_service, get_business_insight, stream_business_insight, get_business_kpi
+from llm_chat import LLMError
 from models import LoginData, BusinessInsight, ProductRevenue, PaymentModeRevenue, BusinessChart
 from fastapi import HTTPException
 import pandas as pd
@@ -10,8 +12,8 @@ class TestService(unittest.TestCase):
     def test_search_products_service(self):
         expected_result = [{'pid': 1, 'bid': 1, 'product_name': 'Test', 'business_name': 'Test', 'popularity': 1.0, 'price': 10.0, 'geo_demand': 'US', 'category': 'Test'}]
         # Mock the search_products_by_name function
-        with patch('service.search_products_by_name') as mock_search:
-            mock_search.return_value = pd.DataFrame(expected_result)
+        with patch('service.TYPEAHEAD_ENABLED', False), patch('service.search_products_by_name') as mock_search:
+            mock_search.return_value = expected_result
 
             # Call the search_products_service function
             result = search_products_service('Test')
@@ -19,6 +21,16 @@ class TestService(unittest.TestCase):
             # Assert the expected result
             self.assertEqual(result, expected_result)
 
+    def test_search_products_service_typeahead(self):
+        expected_result = [{'pid': 1, 'bid': 1, 'product_name': 'Test', 'business_name': 'Test', 'popularity': 1.0, 'price': 10.0, 'geo_demand': 'US', 'category': 'Test'}]
+        with patch('service.TYPEAHEAD_ENABLED', True), patch('service.search_typeahead', return_value=expected_result) as mock_search, \
+             patch('service.search_products_by_name') as mock_sql_search:
+            result = search_products_service('Te', limit=5)
+
+        self.assertEqual(result, expected_result)
+        mock_search.assert_called_once_with('Te', 5)
+        mock_sql_search.assert_not_called()
+
     def test_authenticate_user_service(self):
         user_info = {
             "cid": 1,
@@ -52,37 +64,65 @@ class TestService(unittest.TestCase):
             self.assertEqual(result, (False, None))
 
     def test_get_business_insight(self):
-        # Mock the generate_insights and get_product_revenue_info functions
-        with patch('service.generate_insights') as mock_generate:
+        # Mock the generate_insights_async and get_product_revenue_info functions
+        with patch('service.generate_insights_async') as mock_generate:
             mock_generate.return_value = (True, "Action Item 1\nAction Item 2\nAction Item 3\n\nQuestion 1\nQuestion 2\nQuestion 3")
 
             # Call the get_business_insight function
-            result = get_business_insight(1)
+            result = asyncio.run(get_business_insight(1))
 
             # Assert the expected result
             self.assertEqual(result, BusinessInsight(action_items=['Action Item 1', 'Action Item 2', 'Action Item 3'], questions=['Question 1', 'Question 2', 'Question 3']))
 
     def test_get_business_insight_service_unavailable(self):
-        # Mock the generate_insights function
-        with patch('service.generate_insights') as mock_generate:
+        # Mock the generate_insights_async function
+        with patch('service.generate_insights_async') as mock_generate:
             mock_generate.return_value = (False, "Service is not available. Please try again later.")
 
             # Call the get_business_insight function
             with self.assertRaises(HTTPException) as cm:
-                get_business_insight(1)
+                asyncio.run(get_business_insight(1))
 
             # Assert the expected HTTPException status code and detail
             self.assertEqual(cm.exception.status_code, 503)
             self.assertEqual(cm.exception.detail, "Service is not available. Please try again later.")
 
+    def _stream_events(self, lines=(), error=None):
+        async def mock_stream_insights(bid, force_refresh=False):
+            for line in lines:
+                yield line
+            if error is not None:
+                raise error
+
+        async def collect():
+            return [event async for event in stream_business_insight(1)]
+
+        with patch('service.stream_insights', mock_stream_insights):
+            return asyncio.run(collect())
+
+    def test_stream_business_insight(self):
+        events = self._stream_events(["Action Item 1", "Action Item 2", "Action Item 3", "", "Question 1", "Question 2", "Question 3"])
+
+        self.assertEqual(len(events), 7)
+        self.assertEqual(events[0], 'event: item\ndata: {"kind":"action_item","index":0,"text":"Action Item 1"}\n\n')
+        self.assertEqual(events[5], 'event: item\ndata: {"kind":"question","index":2,"text":"Question 3"}\n\n')
+        self.assertEqual(events[-1], 'event: done\ndata: {}\n\n')
+
+    def test_stream_business_insight_errors(self):
+        events = self._stream_events(["Action Item 1"], error=LLMError("quota exceeded"))
+        self.assertEqual(events[-1], 'event: error\ndata: {"detail": "quota exceeded"}\n\n')
+
+        events = self._stream_events(["Action Item 1", "Action Item 2"])
+        self.assertTrue(events[-1].startswith('event: error\n'))
+
     def test_get_business_insight_service_insufficient_insights(self):
-        # Mock the generate_insights function
-        with patch('service.generate_insights') as mock_generate:
+        # Mock the generate_insights_async function
+        with patch('service.generate_insights_async') as mock_generate:
             mock_generate.return_value = (True, "Action Item 1\nAction Item 2\n")
 
             # Call the get_business_insight function
             with self.assertRaises(HTTPException) as cm:
-                get_business_insight(1)
+                asyncio.run(get_business_insight(1))
 
             # Assert the expected HTTPException status code and detail
             self.assertEqual(cm.exception.status_code, 503)
@@ -0,0 +1,126 @@
+import subprocess
+import sys
+import types
+import unittest
+from unittest.mock import ANY, Mock, patch
+import startup
+
+IMPORTTIME_OUTPUT = '''import time: self [us] | cumulative | imported package
+import time:       100 |        100 |   encodings.aliases
+import time:       100 |        200 | site
+import time:       300 |        300 |     pandas
+import time:       100 |        400 |   database
+import time:       500 |        500 |   fastapi
+import time:        30 |        930 | main
+'''
+
+class TestStartup(unittest.TestCase):
+
+    def setUp(self):
+        for patcher in (patch.dict('startup._startup_times', {'stages': {}, 'imports': {}}),
+                        patch.dict('startup._warmup_state', clear=True),
+                        patch('startup._warmup_started', False)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_lazy_import_records_first_import(self):
+        module = types.ModuleType('heavy_module')
+        with patch.dict(sys.modules), patch('startup.importlib.import_module', return_value=module) as mock_import:
+            self.assertIs(startup.lazy_import('heavy_module'), module)
+            sys.modules['heavy_module'] = module
+            self.assertIs(startup.lazy_import('heavy_module'), module)
+
+        mock_import.assert_called_once_with('heavy_module')
+        self.assertEqual(list(startup.startup_report()['imports']), ['heavy_module'])
+
+    def test_preload_imports(self):
+        with patch.dict('startup.HEAVY_IMPORTS', {'a': ('json',), 'b': ('csv', 'email')}, clear=True), \
+             patch('startup.lazy_import') as mock_lazy_import:
+            self.assertEqual(startup.preload_imports([]), [])
+            self.assertEqual(startup.preload_imports(['b']), ['csv', 'email'])
+            self.assertEqual(startup.preload_imports('all'), ['json', 'csv', 'email'])
+            with patch('startup.PRELOAD_IMPORTS', ' a, '):
+                self.assertEqual(startup.preload_imports(), ['json'])
+            with self.assertRaises(ValueError):
+                startup.preload_imports(['c'])
+        self.assertEqual(mock_lazy_import.call_count, 6)
+
+    @patch('startup.lazy_import')
+    def test_preload_imports_default(self, mock_lazy_import):
+        # the 'imports' warmup stage imports the modules of the other stages
+        modules = startup.preload_imports()
+
+        self.assertIn('pandas', modules)
+        self.assertIn('sklearn.preprocessing', modules)
+        self.assertNotIn('google.genai', modules)
+
+    def test_startup_stage(self):
+        with self.assertRaises(RuntimeError):
+            with startup.startup_stage('failing'):
+                raise RuntimeError('boom')
+        with startup.startup_stage('connection'):
+            pass
+
+        # failed stages are timed as well
+        self.assertEqual(list(startup.startup_report()['stages']), ['failing', 'connection'])
+
+    def test_warmup(self):
+        calls = []
+        stages = [('model', lambda: calls.append('model')), ('broken', Mock(side_effect=RuntimeError('no data'))),
+                  ('cache', lambda: calls.append('cache'))]
+        self.assertFalse(startup.readiness()['ready'])
+
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(startup.start_warmup(stages, 'all', mode='startup'))
+
+        # a failed stage does not stop the following ones, but keeps the API unready
+        self.assertEqual(calls, ['model', 'cache'])
+        status = startup.readiness()
+        self.assertFalse(status['ready'])
+        self.assertEqual({name: state['state'] for (name, state) in status['subsystems'].items()},
+                         {'model': 'warm', 'broken': 'failed', 'cache': 'warm'})
+        self.assertEqual(status['subsystems']['broken']['error'], 'no data')
+        self.assertIn('warmup.model', startup.startup_report()['stages'])
+
+    def test_warmup_selected_stages(self):
+        calls = []
+        stages = [('model', lambda: calls.append('model')), ('cache', lambda: calls.append('cache'))]
+
+        with patch('startup.WARMUP_STAGES', 'cache'):
+            startup.start_warmup(stages, mode='background').join()
+        self.assertEqual(calls, ['cache'])
+        self.assertEqual(startup.readiness(), {'ready': True, 'subsystems': {'cache': {'state': 'warm', 'seconds': ANY, 'error': None}}})
+
+        with self.assertRaises(ValueError):
+            startup.start_warmup(stages, ['other'], mode='startup')
+        with self.assertRaises(ValueError):
+            startup.start_warmup(stages, mode='later')
+
+    def test_warmup_off(self):
+        stage = Mock()
+
+        startup.start_warmup([('model', stage)], mode='off')
+
+        stage.assert_not_called()
+        self.assertEqual(startup.readiness(), {'ready': True, 'subsystems': {}})
+
+    @patch('startup.subprocess.run')
+    def test_module_import_times(self, mock_run):
+        mock_run.return_value = subprocess.CompletedProcess([], 0, stdout='', stderr=IMPORTTIME_OUTPUT)
+
+        import_times = startup.module_import_times('main')
+
+        # only the module and what it imports directly, not the interpreter startup
+        self.assertEqual(import_times, [('main', 0.00093), ('fastapi', 0.0005), ('database', 0.0004)])
+        self.assertEqual(mock_run.call_args[0][0][1:], ['-X', 'importtime', '-c', 'import main'])
+
+    def test_api_modules_do_not_import_heavy_subsystems(self):
+        code = 'import sys, main; print(",".join(name for name in ("pandas", "sklearn", "scipy", "google.genai", "tensorflow") if name in sys.modules))'
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=startup.os.path.dirname(startup.__file__),
+                                env=dict(startup.os.environ, GOOGLE_API_KEY='x'))
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), '')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import sqlite3
+import unittest
+from unittest.mock import patch
+import database
+import typeahead
+
+class TestTypeahead(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self.addCleanup(self.conn.close)
+        patcher = patch('database.get_connection', return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with patch('database.bulk_load_csv'), patch('builtins.print'):
+            database.init_businesses()
+            database.init_products()
+            database.init_data_versions()
+            database.init_product_search()
+        self.conn.execute("insert into businesses (bid, business_name, category) values (1, 'Gallagher PLC', 'Electronics'), (2, 'Smart Foods', 'Food')")
+        self.conn.executemany("insert into products (pid, bid, product_name, popularity, price, geo_demand) values (?, ?, ?, ?, 10.0, 'Town')",
+                              [(1, 1, 'Smartphone', 7.0), (2, 1, 'Smartwatch', 9.6), (3, 2, 'Organic Tea', 9.9),
+                               (4, 1, 'Gaming Console', 5.0), (5, 1, 'Smart TV', 1.0), (6, 2, 'Crème Brûlée', 2.0)])
+
+        typeahead._typeahead_index = None
+        self.addCleanup(setattr, typeahead, '_typeahead_index', None)
+
+    def _pids(self, query, limit=50):
+        return [product['pid'] for product in typeahead.search_typeahead(query, limit)]
+
+    def test_search_typeahead_matches_sql_search(self):
+        for query in ('s', 'smart', 'SMARTW', 'electro', 'gaming cons', 'gam console', 'foods', 'creme', 'tea!', '', 'zzz'):
+            expected = [row[0] for row in database.search_products_by_name(query)]
+            self.assertEqual(self._pids(query), expected, query)
+
+    def test_search_backends_return_the_same_results(self):
+        # earlier words that only prefix a word of the name, words split by punctuation or with diacritics,
+        # and more matches than search_products_by_name sorts at once
+        self.conn.executemany("insert into products (pid, bid, product_name, popularity, price, geo_demand) values (?, ?, ?, ?, 10.0, 'Town')",
+                              [(7, 2, 'Smartphone Tea', 8.0), (8, 1, 'Smart-Watch Band', 3.0), (9, 2, 'Brûlée Smart Tea', None)]
+                              + [(pid, 1, f'Smart Plug {pid}', 4.0) for pid in range(10, 20)])
+        import service
+
+        for query in ('smart tea', 'sm', 'smart', 'watch', 'smart wat', 'brulee', 'tea', 'smart plug 1', 'electronics s'):
+            with patch('database.SEARCH_CANDIDATE_LIMIT', 5):
+                with patch('service.TYPEAHEAD_ENABLED', False):
+                    expected = service.search_products_service(query, 8)
+                with patch('service.TYPEAHEAD_ENABLED', True):
+                    typeahead._typeahead_index = None
+                    self.assertEqual(service.search_products_service(query, 8), expected, query)
+
+    def test_search_typeahead_records(self):
+        (product,) = typeahead.search_typeahead('tea', 5)
+
+        self.assertEqual(product, {'pid': 3, 'bid': 2, 'product_name': 'Organic Tea', 'popularity': 9.9, 'price': 10.0,
+                                   'geo_demand': 'Town', 'category': 'Food', 'business_name': 'Smart Foods'})
+        # the records are plain Python values, ready for the response models
+        self.assertIs(type(product['pid']), int)
+        self.assertEqual(self._pids('smart', limit=2), [2, 1])
+
+    def test_search_typeahead_caches_results(self):
+        first = typeahead.search_typeahead('Smart', 10)
+
+        with patch('typeahead.np.flatnonzero') as mock_flatnonzero:
+            # the same words are served from the cache without searching again
+            self.assertIs(typeahead.search_typeahead('smart ', 10), first)
+        mock_flatnonzero.assert_not_called()
+
+        with patch('typeahead.TYPEAHEAD_CACHE_SIZE', 1):
+            typeahead.search_typeahead('tea', 10)
+        self.assertEqual(list(typeahead.get_typeahead_index()['cache']), [(('tea',), 10)])
+
+    def test_typeahead_index_is_rebuilt_after_changes(self):
+        index = typeahead.get_typeahead_index()
+        self.conn.execute("insert into products (pid, bid, product_name, popularity) values (7, 2, 'Smart Oven', 8.0)")
+        self.conn.execute("update businesses set business_name = 'Fresh Foods' where bid = 2")
+
+        with patch('typeahead.TYPEAHEAD_VERSION_CHECK_INTERVAL', 0):
+            # the current index is searched until the rebuild finishes
+            self.assertIs(typeahead.get_typeahead_index(), index)
+            with typeahead._typeahead_lock:
+                rebuilt = typeahead.get_typeahead_index(check_version=False)
+
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(self._pids('smart'), [2, 7, 1, 5])
+        self.assertEqual(self._pids('fresh'), [3, 7, 6])
+
+    def test_typeahead_index_is_not_rebuilt_between_checks(self):
+        index = typeahead.get_typeahead_index()
+        self.conn.execute("insert into products (pid, bid, product_name, popularity) values (7, 2, 'Smart Oven', 8.0)")
+
+        with patch('typeahead.get_data_version') as mock_get_data_version:
+            self.assertIs(typeahead.get_typeahead_index(), index)
+        mock_get_data_version.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
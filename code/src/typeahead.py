@@ -0,0 +1,235 @@
+from startup import lazy_import
+from database import get_data_version, execute_and_fetch_rows
+from collections import OrderedDict
+import numpy as np
+import bisect
+import datetime
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+
+# answer /search_products from the in-memory index instead of the product_search table
+TYPEAHEAD_ENABLED = os.environ.get('TYPEAHEAD_ENABLED', '1') == '1'
+# recent query results kept by each index
+TYPEAHEAD_CACHE_SIZE = int(os.environ.get('TYPEAHEAD_CACHE_SIZE', 4096))
+# seconds between two checks of the data versions of products and businesses, so that searching does not query SQLite
+TYPEAHEAD_VERSION_CHECK_INTERVAL = float(os.environ.get('TYPEAHEAD_VERSION_CHECK_INTERVAL', 1.0))
+# columns whose words are searched; the product name also ranks the results
+TYPEAHEAD_COLUMNS = ('product_name', 'business_name', 'category')
+
+_WORD_PATTERN = re.compile(r'[^\W_]+')
+
+_typeahead_index = None
+_typeahead_lock = threading.Lock()
+
+def normalize_words(text):
+    """Splits a text into lower case words without diacritics, like the product_search FTS5 tokenizer
+    """
+
+    if not isinstance(text, str):
+        return []
+    text = text.lower()
+    if not text.isascii():
+        text = ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c))
+    return _WORD_PATTERN.findall(text)
+
+def _column_terms(codes, unique_words, vocabulary):
+    """Maps the rows of a column to the ids of their words
+
+    Keyword arguments:
+    codes -- position of the value of every row in unique_words, -1 for missing values
+    unique_words -- words of every distinct value of the column
+    vocabulary -- id of every word
+    Return: tuple of (row positions, term ids), one pair per word of each row
+    """
+
+    unique_terms = [[vocabulary[word] for word in words] for words in unique_words]
+    lengths = np.array([len(terms) for terms in unique_terms] + [0], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    flat_terms = np.array([term for terms in unique_terms for term in terms], dtype=np.int32)
+
+    # missing values have code -1, i.e. the empty entry appended to lengths
+    counts = lengths[codes]
+    rows = np.repeat(np.arange(len(codes)), counts)
+    first = np.repeat(offsets[codes] - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    return rows, flat_terms[first + np.arange(len(rows))]
+
+def _postings(rows, terms, n_terms):
+    """Groups the row positions by term
+
+    Return: tuple of (row positions sorted by term then position, start of every term in them)
+    """
+
+    order = np.lexsort((rows, terms))
+    starts = np.searchsorted(terms[order], np.arange(n_terms + 1))
+    return rows[order].astype(np.int32), starts
+
+def build_typeahead_index():
+    """Reads the products and their businesses into an in-memory prefix index, so that typeahead searches
+    do not query the database.
+
+    Return: dictionary with the product columns in popularity order, the sorted vocabulary and the postings
+    of every word, the data version it was built from and its result cache
+    """
+
+    pd = lazy_import('pandas')
+    # read the version first so that writes during the build leave the index stale instead of silently fresh
+    version = get_data_version('products', 'businesses')
+    products = execute_and_fetch_rows('''
+    SELECT p.*, b.category, b.business_name
+    FROM products p
+    JOIN businesses b ON p.bid = b.bid
+    ''', as_df=True)
+    # most popular first, so that the first matching rows are the best ones
+    products = products.sort_values(['popularity', 'pid'], ascending=[False, True], na_position='last', kind='stable', ignore_index=True)
+
+    # every distinct value is tokenized once
+    column_words = {}
+    for column in TYPEAHEAD_COLUMNS:
+        codes, uniques = pd.factorize(products[column])
+        column_words[column] = (codes, [normalize_words(value) for value in uniques])
+
+    # the terms are numbered in sorted order, so that the words starting with a prefix are one range of ids
+    words = sorted({word for (_, unique_words) in column_words.values() for value_words in unique_words for word in value_words})
+    vocabulary = {word: i for (i, word) in enumerate(words)}
+    column_terms = {column: _column_terms(codes, unique_words, vocabulary) for (column, (codes, unique_words)) in column_words.items()}
+    any_rows = np.concatenate([rows for (rows, _) in column_terms.values()])
+    any_terms = np.concatenate([terms for (_, terms) in column_terms.values()])
+
+    # string columns are stored as codes into their distinct values, which keeps a large catalog small
+    columns = {}
+    for column in products.columns:
+        if products[column].dtype == object:
+            codes, uniques = pd.factorize(products[column])
+            columns[column] = (codes.astype(np.int32), list(uniques) + [None])
+        else:
+            columns[column] = (products[column].to_numpy(), None)
+
+    index = {
+        'size': len(products),
+        'columns': columns,
+        'words': words,
+        'name_postings': _postings(*column_terms['product_name'], len(words)),
+        'any_postings': _postings(any_rows, any_terms, len(words)),
+        'version': version,
+        'built_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'checked_at': time.monotonic(),
+        'cache': OrderedDict(),
+        'cache_lock': threading.Lock(),
+    }
+    logging.info('Typeahead index built for %d products and %d words (version %s)', index['size'], len(words), version)
+    return index
+
+def _is_stale(index):
+    now = time.monotonic()
+    if now - index['checked_at'] < TYPEAHEAD_VERSION_CHECK_INTERVAL:
+        return False
+    index['checked_at'] = now
+    return index['version'] != get_data_version('products', 'businesses')
+
+def _rebuild_typeahead_index():
+    global _typeahead_index
+
+    try:
+        _typeahead_index = build_typeahead_index()
+    except Exception:
+        logging.exception('Rebuilding the typeahead index failed')
+    finally:
+        _typeahead_lock.release()
+
+def get_typeahead_index(check_version=True):
+    """Gets the typeahead index, building it on first use.
+
+    Keyword arguments:
+    check_version -- rebuild the index if the products or businesses tables changed since it was built,
+                     checked at most every TYPEAHEAD_VERSION_CHECK_INTERVAL seconds (default: True)
+    Return: the index
+    """
+
+    global _typeahead_index
+
+    index = _typeahead_index
+    if index is None:
+        with _typeahead_lock:
+            if _typeahead_index is None:
+                _typeahead_index = build_typeahead_index()
+            return _typeahead_index
+
+    # a stale index keeps being searched while it is rebuilt in the background
+    if check_version and _is_stale(index) and _typeahead_lock.acquire(blocking=False):
+        threading.Thread(target=_rebuild_typeahead_index, name='typeahead-rebuild', daemon=True).start()
+    return index
+
+def _term_mask(index, postings, word, prefix):
+    rows, starts = index[postings]
+    words = index['words']
+    first = bisect.bisect_left(words, word)
+    if prefix:
+        # the words starting with the prefix sort between the prefix and the prefix followed by the last character
+        last = bisect.bisect_left(words, word + '\U0010ffff', first)
+    else:
+        last = first + 1 if first < len(words) and words[first] == word else first
+
+    mask = np.zeros(index['size'], dtype=bool)
+    mask[rows[starts[first]:starts[last]]] = True
+    return mask
+
+def _matching_rows(index, postings, words):
+    mask = _term_mask(index, postings, words[-1], prefix=True)
+    for word in words[:-1]:
+        mask &= _term_mask(index, postings, word, prefix=False)
+    return mask
+
+def _record(index, row):
+    record = {}
+    for (column, (values, uniques)) in index['columns'].items():
+        if uniques is not None:
+            record[column] = uniques[values[row]]
+        else:
+            value = values[row].item()
+            # missing numbers are read as NaN, but the database returns None
+            record[column] = None if value != value else value
+    return record
+
+def search_typeahead(query: str, limit: int, index=None):
+    """Searches the products like search_products_by_name, but in memory: the products whose name, business name
+    or category contain the words of the query, the last one possibly incomplete. Products whose name has all
+    the words come first, then the most popular. Recent results are cached until the index is rebuilt.
+
+    Keyword arguments:
+    query -- text typed by the user
+    limit -- maximum number of products returned
+    index -- typeahead index (default: the in-memory index)
+    Return: list of product dictionaries, shared with the cache
+    """
+
+    if index is None:
+        index = get_typeahead_index()
+
+    words = tuple(normalize_words(query))
+    key = (words, limit)
+    with index['cache_lock']:
+        results = index['cache'].get(key)
+        if results is not None:
+            index['cache'].move_to_end(key)
+            return results
+
+    if not words:
+        results = []
+    else:
+        name_match = _matching_rows(index, 'name_postings', words)
+        # the rows are in popularity order, and a product whose name has every word matches them all
+        other_match = _matching_rows(index, 'any_postings', words) & ~name_match
+        rows = np.flatnonzero(name_match)[:limit]
+        if len(rows) < limit:
+            rows = np.concatenate((rows, np.flatnonzero(other_match)[:limit - len(rows)]))
+        results = [_record(index, row) for row in rows]
+
+    with index['cache_lock']:
+        index['cache'][key] = results
+        if len(index['cache']) > TYPEAHEAD_CACHE_SIZE:
+            index['cache'].popitem(last=False)
+    return results